@@ -12,6 +12,7 @@ command_list = [
     'refine_explicit',
     'package_models',
     'quickmodel',
+    'benchmark',
 ]
 
 from . import general
@@ -27,4 +28,5 @@ from . import refine_implicit
 from . import solvate
 from . import refine_explicit
 from . import package_models
-from . import quickmodel
\ No newline at end of file
+from . import quickmodel
+from . import benchmark
\ No newline at end of file
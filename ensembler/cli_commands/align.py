@@ -1,6 +1,3 @@
-import ensembler
-import ensembler.modeling
-
 helpstring_header = """\
 Pairwise alignment of target sequences onto template sequences.
 
@@ -44,6 +41,8 @@ docopt_helpstring = '\n\n'.join(helpstring_unique_options)
 
 
 def dispatch(args):
+    import ensembler.modeling
+
     if args['--verbose']:
         loglevel = 'debug'
     else:
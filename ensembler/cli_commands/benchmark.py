@@ -0,0 +1,70 @@
+helpstring_header = """\
+Benchmark Ensembler stages against a synthetic project, built from the example project bundled
+with the Ensembler tests.
+
+The synthetic project is created in a temporary directory (or the directory given by
+--benchmark_dir), with the requested number of targets and templates. Each stage is then timed,
+with OpenMM restricted to the CPU platform, and the results are written in JSON format.
+
+Stages: align, cluster, solvate, metadata, inspect, mktraj
+
+Options:"""
+
+helpstring_unique_options = [
+    """\
+  --ntargets <n>               Number of synthetic targets (default: 2)""",
+
+    """\
+  --ntemplates <n>             Number of synthetic templates (default: 2)""",
+
+    """\
+  --stages <stages>            Stages to benchmark (comma-separated), e.g. "--stages align,inspect"
+                               (default: all stages)""",
+
+    """\
+  --benchmark_dir <dir>        Directory in which to create the synthetic project, which is kept
+                               afterwards (default: a temporary directory, which is deleted)""",
+
+    """\
+  --results <filepath>         File to which to write the results (default: benchmark.json)""",
+]
+
+helpstring_nonunique_options = [
+    """\
+  -v --verbose                 """,
+]
+
+helpstring = '\n\n'.join([helpstring_header, '\n\n'.join(helpstring_unique_options), '\n\n'.join(helpstring_nonunique_options)])
+docopt_helpstring = '\n\n'.join(helpstring_unique_options)
+
+
+def dispatch(args):
+    import ensembler.tools.benchmark
+
+    dispatch_args = {}
+
+    if args['--ntargets']:
+        dispatch_args['ntargets'] = int(args['--ntargets'])
+
+    if args['--ntemplates']:
+        dispatch_args['ntemplates'] = int(args['--ntemplates'])
+
+    if args['--stages']:
+        dispatch_args['stages'] = args['--stages'].split(',')
+
+    if args['--benchmark_dir']:
+        dispatch_args['project_dir'] = args['--benchmark_dir']
+
+    if args['--results']:
+        results_filepath = args['--results']
+    else:
+        results_filepath = 'benchmark.json'
+
+    if args['--verbose']:
+        loglevel = 'debug'
+    else:
+        loglevel = 'info'
+
+    ensembler.tools.benchmark.run_benchmarks(
+        results_filepath=results_filepath, loglevel=loglevel, **dispatch_args
+    )
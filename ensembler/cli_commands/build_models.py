@@ -1,6 +1,3 @@
-import ensembler
-import ensembler.modeling
-
 helpstring_header = """\
 Generate models by mapping target sequences onto template structures, using Modeller
 (salilab.org/modeller).
@@ -46,6 +43,8 @@ docopt_helpstring = '\n\n'.join(helpstring_unique_options)
 
 
 def dispatch(args):
+    import ensembler.modeling
+
     if args['--targetsfile']:
         with open(args['--targetsfile'], 'r') as targetsfile:
             targets = [line.strip() for line in targetsfile.readlines() if line[0] != '#']
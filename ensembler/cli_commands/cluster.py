@@ -1,6 +1,3 @@
-import ensembler
-import ensembler.modeling
-
 helpstring_header = """\
 Filter out non-unique models by clustering on RMSD.
 
@@ -34,6 +31,8 @@ helpstring = '\n\n'.join([helpstring_header,  '\n\n'.join(helpstring_unique_opti
 docopt_helpstring = '\n\n'.join(helpstring_unique_options)
 
 def dispatch(args):
+    import ensembler.modeling
+
     if args['--targetsfile']:
         with open(args['--targetsfile'], 'r') as targetsfile:
             targets = [line.strip() for line in targetsfile.readlines() if line[0] != '#']
@@ -1,6 +1,3 @@
-import ensembler
-import ensembler.initproject
-
 helpstring_header = """\
 Gather target protein data from a specified resource, such as UniProt or a TargetExplorer database.
 
@@ -63,6 +60,11 @@ helpstring_unique_options = [
                                  and excludes "Protein kinase; truncated" and "Protein kinase;
                                  inactive\"""",
 
+    """\
+  --stream_uniprot_xml           Parse the UniProt XML one entry at a time as it is received,
+                                 rather than reading it into memory as a whole. Recommended for
+                                 very large (e.g. proteome-scale) queries.""",
+
     """\
   -v --verbose                   """,
 ]
@@ -72,6 +74,8 @@ docopt_helpstring = '\n\n'.join(helpstring_unique_options)
 
 
 def dispatch(args):
+    import ensembler.initproject
+
     if args['--verbose']:
         loglevel = 'debug'
     else:
@@ -85,7 +89,7 @@ def dispatch(args):
     elif args['--gather_from'].lower() == 'uniprot':
         required_args = ['--query']
         ensembler.cli.validate_args(args, required_args)
-        ensembler.initproject.GatherTargetsFromUniProt(args['--query'], uniprot_domain_regex=args['--uniprot_domain_regex'], loglevel=loglevel)
+        ensembler.initproject.GatherTargetsFromUniProt(args['--query'], uniprot_domain_regex=args['--uniprot_domain_regex'], stream_uniprot_xml=args.get('--stream_uniprot_xml', False), loglevel=loglevel)
 
     else:
         raise Exception('--gather_from flag must be set to either "uniprot" or "targetexplorer"')
\ No newline at end of file
@@ -1,6 +1,4 @@
 import ast
-import ensembler
-import ensembler.initproject
 
 helpstring_header = """\
 Gather template protein data from a specified resource, such as UniProt or a TargetExplorer
@@ -74,6 +72,11 @@ helpstring_nonunique_options = [
                                  and excludes "Protein kinase; truncated" and "Protein kinase;
                                  inactive\"""",
 
+    """\
+  --stream_uniprot_xml           Parse the UniProt XML one entry at a time as it is received,
+                                 rather than reading it into memory as a whole. Recommended for
+                                 very large (e.g. proteome-scale) queries.""",
+
     """\
   -v --verbose                   """,
 ]
@@ -83,6 +86,22 @@ helpstring_unique_options = [
   --structure_paths <path>       Local directories within which to search for PDB and SIFTS files
                                  (comma-separated)""",
 
+    """\
+  --structure_cache <path>       Shared directory in which downloaded PDB and SIFTS files are
+                                 cached, and linked into the project (default: the
+                                 ENSEMBLER_STRUCTURE_CACHE environment variable, if set)""",
+
+    """\
+  --structure_cache_max_size <bytes>  Evict least recently used files from the structure cache
+                                 when it grows beyond this size (default: no limit)""",
+
+    """\
+  --uniprot_cache <path>         if --gather_from="pdb":
+                                   Shared directory in which UniProt entries are cached, so that
+                                   only entries not seen before are retrieved from UniProt
+                                   (default: the ENSEMBLER_UNIPROT_CACHE environment variable, if
+                                   set)""",
+
     """\
   --chainids <chainids>          if --gather_from="pdb":
                                    Optionally specify which PDB chain IDs to parse. Use a Python
@@ -95,6 +114,8 @@ docopt_helpstring = '\n\n'.join(helpstring_unique_options)
 
 
 def dispatch(args):
+    import ensembler.initproject
+
     if args['--verbose']:
         loglevel = 'debug'
     else:
@@ -105,15 +126,20 @@ def dispatch(args):
     else:
         structure_paths = False
 
+    if args.get('--structure_cache_max_size'):
+        structure_cache_max_size = int(args['--structure_cache_max_size'])
+    else:
+        structure_cache_max_size = None
+
     if args['--gather_from'].lower() == 'targetexplorer':
         required_args = ['--dbapi_uri']
         ensembler.cli.validate_args(args, required_args)
-        ensembler.initproject.gather_templates_from_targetexplorer(args['--dbapi_uri'], search_string=args['--query'], structure_dirs=structure_paths, loglevel=loglevel)
+        ensembler.initproject.gather_templates_from_targetexplorer(args['--dbapi_uri'], search_string=args['--query'], structure_dirs=structure_paths, loglevel=loglevel, structure_cache_dir=args.get('--structure_cache'), structure_cache_max_size=structure_cache_max_size)
 
     elif args['--gather_from'].lower() == 'uniprot':
         required_args = ['--query']
         ensembler.cli.validate_args(args, required_args)
-        ensembler.initproject.gather_templates_from_uniprot(args['--query'], uniprot_domain_regex=args['--uniprot_domain_regex'], structure_dirs=structure_paths, loglevel=loglevel)
+        ensembler.initproject.gather_templates_from_uniprot(args['--query'], uniprot_domain_regex=args['--uniprot_domain_regex'], structure_dirs=structure_paths, loglevel=loglevel, structure_cache_dir=args.get('--structure_cache'), structure_cache_max_size=structure_cache_max_size, stream_uniprot_xml=args.get('--stream_uniprot_xml', False))
 
     elif args['--gather_from'].lower() == 'pdb':
         required_args = ['--query']
@@ -129,7 +155,7 @@ def dispatch(args):
         else:
             chainids = None
 
-        ensembler.initproject.gather_templates_from_pdb(pdbids, uniprot_domain_regex=args['--uniprot_domain_regex'], chainids=chainids, structure_dirs=structure_paths, loglevel=loglevel)
+        ensembler.initproject.gather_templates_from_pdb(pdbids, uniprot_domain_regex=args['--uniprot_domain_regex'], chainids=chainids, structure_dirs=structure_paths, loglevel=loglevel, structure_cache_dir=args.get('--structure_cache'), structure_cache_max_size=structure_cache_max_size, uniprot_cache_dir=args.get('--uniprot_cache'))
 
     else:
         raise Exception('--gather_from flag must be set to any of %r' % gather_from_options)
\ No newline at end of file
@@ -7,10 +7,11 @@ Usage:
   ensembler -h | --help
   ensembler init [-h | --help] [--project_dir <dir>]
   ensembler gather_targets [-h | --help] [--gather_from <method>] [--query <query>]
-      [--dbapi_uri <uri>] [--uniprot_domain_regex <regex>] [-v | --verbose]
+      [--dbapi_uri <uri>] [--uniprot_domain_regex <regex>] [--stream_uniprot_xml] [-v | --verbose]
   ensembler gather_templates [-h | --help] [--gather_from <method>] [--query <query>]
       [--dbapi_uri <uri>] [--uniprot_domain_regex <regex>] [--chainids <chainids>]
-      [--structure_paths <path>] [-v | --verbose]
+      [--structure_paths <path>] [--structure_cache <path>] [--structure_cache_max_size <bytes>]
+      [--uniprot_cache <path>] [--stream_uniprot_xml] [-v | --verbose]
   ensembler loopmodel [-h | --help] [--templates <templates>] [--templatesfile <templatesfile>]
       [--overwrite_structures] [-v | --verbose]
   ensembler align [-h | --help] [--targets <targets>] [--targetsfile <targetsfile>]
@@ -23,26 +24,34 @@ Usage:
   ensembler refine_implicit [-h | --help] [--targets <target>] [--targetsfile <targetsfile>]
       [--templates <template>] [--templatesfile <templatesfile>] [--template_seqid_cutoff <cutoff>]
       [--gpupn <gpupn>] [--openmm_platform <platform>] [--simlength <simlength>]
-      [--retry_failed_runs] [--ff <ffname>] [--water_model <modelname>] [--api_params <params>]
-      [-v | --verbose]
+      [--retry_failed_runs] [--calibrate_platform] [--ff <ffname>] [--water_model <modelname>]
+      [--api_params <params>] [--trace <filepath>] [--trace_format <format>]
+      [--profile_phases <phases>] [--metrics_dir <dir>] [--metrics_format <format>]
+      [--metrics_interval <seconds>] [--run_log] [-v | --verbose]
   ensembler solvate [-h | --help] [--targets <target>] [--targetsfile <targetsfile>]
       [--templates <template>] [--templatesfile <templatesfile>] [--template_seqid_cutoff <cutoff>]
-      [--padding <padding>] [--select_nwaters_at_percentile <value>] [--ff <ffname>]
+      [--padding <padding>] [--select_nwaters_at_percentile <value>] [--estimate_nwaters]
+      [--nwaters_calibration_samples <n>] [--save_solvated_model] [--ff <ffname>]
       [--water_model <modelname>] [-v | --verbose]
   ensembler refine_explicit [-h | --help] [--targets <target>] [--targetsfile <targetsfile>]
       [--templates <template>] [--templatesfile <templatesfile>] [--template_seqid_cutoff <cutoff>]
       [--gpupn <gpupn>] [--openmm_platform <platform>] [--simlength <simlength>]
       [--retry_failed_runs] [--write_solvated_model] [--ff <ffname>] [--water_model <modelname>]
-      [--api_params <params>] [-v | --verbose]
+      [--api_params <params>] [--trace <filepath>] [--trace_format <format>]
+      [--profile_phases <phases>] [--metrics_dir <dir>] [--metrics_format <format>]
+      [--metrics_interval <seconds>] [--run_log] [-v | --verbose]
   ensembler package_models [-h | --help] [--package_for <choice>] [--targets <target>]
       [--targetsfile <targetsfile>] [--templates <template>] [--templatesfile <templatesfile>]
-      [--template_seqid_cutoff <cutoff>] [--nfahclones <n>] [--archivefahproject] [-v | --verbose]
+      [--template_seqid_cutoff <cutoff>] [--nfahclones <n>] [--archivefahproject]
+      [--nprocesses <n>] [-v | --verbose]
   ensembler testrun_pipeline [-h | --help]
   ensembler quickmodel [-h | --help] [--targetid <id>] [--templateids <ids>]
       [--target_uniprot_entry_name <entry_name>] [--uniprot_domain_regex <regex>]
       [--template_pdbids <pdbids>] [--template_chainids <chainids>]
       [--template_uniprot_query <query>] [--template_seqid_cutoff <cutoff>] [--no-loopmodel]
       [--package_for_fah] [--nfahclones <nfahclones>] [--structure_dirs <structure_dirs>]
+  ensembler benchmark [-h | --help] [--ntargets <n>] [--ntemplates <n>] [--stages <stages>]
+      [--benchmark_dir <dir>] [--results <filepath>] [-v | --verbose]
 
 Commands:
   init                          Initialize a new Ensembler project
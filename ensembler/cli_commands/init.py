@@ -1,6 +1,3 @@
-import ensembler.utils
-import ensembler.initproject
-
 helpstring_header = """\
 Initialize Ensembler project by creating necessary subdirectories and a project metadata .yaml file.
 
@@ -16,6 +13,9 @@ required_args = []
 
 
 def dispatch(args):
+    import ensembler.utils
+    import ensembler.initproject
+
     project_dir = ensembler.utils.set_arg_with_default(args['--project_dir'], default_arg='.')
     ensembler.cli.validate_args(args, required_args)
     ensembler.initproject.InitProject(project_dir)
\ No newline at end of file
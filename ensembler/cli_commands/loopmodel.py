@@ -1,6 +1,3 @@
-import ensembler
-import ensembler.modeling
-
 helpstring_header = """\
 Use Rosetta loopmodel to reconstruct missing loops in template structures.
 
@@ -33,6 +30,8 @@ docopt_helpstring = '\n\n'.join(helpstring_unique_options)
 
 
 def dispatch(args):
+    import ensembler.modeling
+
     if args['--verbose']:
         loglevel = 'debug'
     else:
@@ -1,6 +1,3 @@
-import ensembler
-import ensembler.packaging
-
 helpstring_header = """\
 Package models for transfer or for set-up as a Folding@Home project.
 
@@ -24,6 +21,10 @@ helpstring_unique_options = [
     """\
   --archivefahproject                   If packaging for Folding@Home, choose whether to compress
                                         the results into a .tgz file.""",
+
+    """\
+  --nprocesses <n>                      If packaging for Folding@Home, the number of worker
+                                        processes used to build RUNs (per MPI rank) [default: 1].""",
 ]
 
 helpstring_nonunique_options = [
@@ -55,6 +56,8 @@ helpstring = '\n\n'.join([helpstring_header, '\n\n'.join(helpstring_unique_optio
 docopt_helpstring = '\n\n'.join(helpstring_unique_options)
 
 def dispatch(args):
+    import ensembler.packaging
+
     if args['--package_for']:
         package_for = args['--package_for']
     else:
@@ -91,6 +94,11 @@ def dispatch(args):
     else:
         archive = False
 
+    if args['--nprocesses']:
+        nprocesses = int(args['--nprocesses'])
+    else:
+        nprocesses = 1
+
     if args['--verbose']:
         loglevel = 'debug'
     else:
@@ -109,5 +117,6 @@ def dispatch(args):
             template_seqid_cutoff=template_seqid_cutoff,
             nclones=n_fah_clones,
             archive=archive,
+            nprocesses=nprocesses,
             verbose=args['--verbose'],
         )
\ No newline at end of file
@@ -1,5 +1,3 @@
-from ensembler.tools.quick_model import QuickModel
-
 helpstring_header = """\
 Model a single target with a small number of templates. This performs the entire Ensembler pipeline
 in one go.
@@ -68,6 +66,8 @@ docopt_helpstring = '\n\n'.join(helpstring_unique_options)
 
 
 def dispatch(args):
+    from ensembler.tools.quick_model import QuickModel
+
     if args['--templateids']:
         templateids = args['--templateids'].split(',')
     else:
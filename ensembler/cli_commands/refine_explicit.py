@@ -1,8 +1,3 @@
-import ensembler
-import ensembler.refinement
-from ensembler.param_parsers import parse_api_params_string, eval_quantity_string
-import simtk.unit as unit
-
 helpstring_header = """\
 Refine models by molecular dynamics simulation with explicit solvent, using OpenMM.
 
@@ -68,6 +63,36 @@ helpstring_nonunique_options = [
   --api_params <params>             See API documentation for
                                     ensembler.refinement.refine_implicit_md""",
 
+    """\
+  --trace <filepath>                Record the wall time of each phase of each simulation (e.g.
+                                    minimization, dynamics), and write the timings to this file.""",
+
+    """\
+  --trace_format <format>           Format of the --trace file {json|chrome} [default: json]
+                                    "chrome" files can be loaded in chrome://tracing.""",
+
+    """\
+  --profile_phases <phases>         Used with --trace. Profile the given phases (comma-separated)
+                                    with cProfile, e.g. "--profile_phases create_system,minimization".
+                                    Profiles are written alongside the --trace file.""",
+
+    """\
+  --metrics_dir <dir>               Periodically write per-rank progress metrics (models completed
+                                    and failed, ns/day, queue depth) to this directory, which
+                                    should be node-local, e.g. /tmp/ensembler-metrics.""",
+
+    """\
+  --metrics_format <format>         Format of the metrics files {prometheus|jsonl}
+                                    [default: prometheus]""",
+
+    """\
+  --metrics_interval <seconds>      Minimum interval between metrics writes [default: 60]""",
+
+    """\
+  --run_log                         Append log updates to a per-rank run log (in .run-logs) rather
+                                    than rewriting the log file of each model. See
+                                    ensembler.runlog.compact_run_logs.""",
+
     """\
   -v --verbose                 """,
 ]
@@ -76,6 +101,13 @@ helpstring = '\n\n'.join([helpstring_header, '\n\n'.join(helpstring_unique_optio
 docopt_helpstring = '\n\n'.join(helpstring_unique_options)
 
 def dispatch(args):
+    import ensembler.refinement
+    import ensembler.profiling
+    import ensembler.metrics
+    import ensembler.runlog
+    from ensembler.param_parsers import parse_api_params_string, eval_quantity_string
+    import simtk.unit as unit
+
     if args['--targetsfile']:
         with open(args['--targetsfile'], 'r') as targetsfile:
             targets = [line.strip() for line in targetsfile.readlines() if line[0] != '#']
@@ -114,6 +146,22 @@ def dispatch(args):
     else:
         api_params = {}
 
+    if args['--metrics_dir']:
+        ensembler.metrics.enable_metrics(
+            args['--metrics_dir'], metrics_format=args['--metrics_format'],
+            write_interval=float(args['--metrics_interval'])
+        )
+
+    if args['--run_log']:
+        ensembler.runlog.enable_run_log()
+
+    if args['--trace']:
+        if args['--profile_phases']:
+            profile_phases = args['--profile_phases'].split(',')
+        else:
+            profile_phases = False
+        ensembler.profiling.enable_tracing(profile=profile_phases)
+
     ensembler.refinement.refine_explicit_md(
         openmm_platform=args['--openmm_platform'],
         gpupn=gpupn,
@@ -127,4 +175,7 @@ def dispatch(args):
         water_model=args['--water_model'],
         verbose=args['--verbose'],
         **api_params
-    )
\ No newline at end of file
+    )
+
+    if args['--trace']:
+        ensembler.profiling.write_trace(args['--trace'], trace_format=args['--trace_format'])
@@ -1,6 +1,3 @@
-import ensembler
-import ensembler.refinement
-
 helpstring_header = """\
 Determines the number of waters to add when solvating models with explicit water molecules.
 
@@ -26,6 +23,19 @@ helpstring_unique_options = [
                                           along the distribution of the number of waters in each
                                           solvated model, with which to re-solvate all models so
                                           they have the same number of waters.""",
+
+    """\
+  --estimate_nwaters           Estimate the number of waters for each model from its bounding box
+                               and excluded volume, rather than solvating each model. This is much
+                               faster, but approximate.""",
+
+    """\
+  --nwaters_calibration_samples <n>  Used with --estimate_nwaters. Solvate a sample of n models
+                                     per target to calibrate the estimates (default: 0).""",
+
+    """\
+  --save_solvated_model        Save each solvated model (solvated-model.npz), so that it can be
+                               reused by refine_explicit rather than solvating the model again.""",
 ]
 
 helpstring_nonunique_options = [
@@ -61,6 +71,8 @@ helpstring = '\n\n'.join([helpstring_header, '\n\n'.join(helpstring_unique_optio
 docopt_helpstring = '\n\n'.join(helpstring_unique_options)
 
 def dispatch(args):
+    import ensembler.refinement
+
     if args['--targetsfile']:
         with open(args['--targetsfile'], 'r') as targetsfile:
             targets = [line.strip() for line in targetsfile.readlines() if line[0] != '#']
@@ -88,6 +100,11 @@ def dispatch(args):
     else:
         select_nwaters_at_percentile = None
 
+    if args['--nwaters_calibration_samples']:
+        nwaters_calibration_samples = int(args['--nwaters_calibration_samples'])
+    else:
+        nwaters_calibration_samples = 0
+
     if args['--verbose']:
         loglevel = 'debug'
     else:
@@ -101,6 +118,9 @@ def dispatch(args):
         ff=args['--ff'],
         water_model=args['--water_model'],
         verbose=args['--verbose'],
+        estimate_nwaters=args['--estimate_nwaters'],
+        nwaters_calibration_samples=nwaters_calibration_samples,
+        save_solvated_model=args['--save_solvated_model'],
     )
     ensembler.refinement.determine_nwaters(
         process_only_these_targets=targets,
@@ -2,10 +2,11 @@ import os
 import logging
 import sys
 import re
+import copy
+import time
 import warnings
-import numpy as np
-import Bio
-import Bio.SeqIO
+import functools
+import contextlib
 from collections import namedtuple
 
 # ========
@@ -75,6 +76,10 @@ model_filenames_by_ensembler_stage = {
     'refine_explicit_md': 'explicit-refined.pdb.gz',
 }
 
+# Content-addressed store for serialized OpenMM XML files (created within the models and
+# packaged_models directories)
+xml_store_dirname = '.xml-store'
+
 # ========
 # MPI
 # ========
@@ -124,6 +129,38 @@ try:
 except ImportError:
     mpistate = DummyMPIState()
 
+
+def get_mpi_hostnames():
+    """
+    Returns a list of the hostnames on which each MPI rank is running, indexed by rank.
+    Must be called collectively by all ranks.
+
+    Returns
+    -------
+    hostnames: list of str
+    """
+    import socket
+    hostnames = mpistate.comm.gather(socket.gethostname(), root=0)
+    hostnames = mpistate.comm.bcast(hostnames, root=0)
+    return hostnames
+
+
+def get_node_local_rank_and_size():
+    """
+    Returns the index of this MPI rank among the ranks running on the same host, and the number
+    of ranks running on this host. Must be called collectively by all ranks.
+
+    Returns
+    -------
+    local_rank: int
+    local_size: int
+    """
+    hostnames = get_mpi_hostnames()
+    hostname = hostnames[mpistate.rank]
+    local_rank = hostnames[:mpistate.rank].count(hostname)
+    local_size = hostnames.count(hostname)
+    return local_rank, local_size
+
 # ========
 # YAML
 # ========
@@ -182,16 +219,31 @@ def check_project_toplevel_dir(raise_exception=True):
 
 class LogFile:
     def __init__(self, log_filepath):
+        """
+        If the run log is enabled (see ensembler.runlog), updates are appended to the run log
+        rather than rewriting the log file.
+        """
         import socket
+        import ensembler.runlog
         self.log_filepath = log_filepath
         self.log_data = {
             'datestamp': get_utcnow_formatted(),
             'hostname': socket.gethostname(),
         }
+        self.run_log = ensembler.runlog.run_log
+        self.run_log_started = False
 
     def log(self, new_log_data={}):
         self.log_data.update(new_log_data)
 
+        if self.run_log is not None:
+            if self.run_log_started:
+                self.run_log.append(self.log_filepath, new_log_data, event='update')
+            else:
+                self.run_log.append(self.log_filepath, self.log_data, event='start')
+                self.run_log_started = True
+            return
+
         with open(self.log_filepath, 'w') as log_file:
             yaml.dump(self.log_data, log_file, default_flow_style=False, Dumper=YamlDumper)
 
@@ -266,6 +318,156 @@ def gen_metadata_filename(ensembler_stage, metadata_file_index):
     return 'meta%d.yaml' % metadata_file_index
 
 
+metadata_filename_regex = re.compile('^(.+?)([0-9]+)\.yaml$')
+
+# mtimes may be as coarse as this (in seconds) on some filesystems (e.g. NFS), so a directory or
+# file modified more recently than this may change again without its mtime changing.
+metadata_mtime_granularity = 2.0
+
+
+def recently_modified(stat_result):
+    return time.time() - stat_result.st_mtime < metadata_mtime_granularity
+
+
+class MetadataCache(object):
+    """
+    Caches the latest metadata file index for each metadata directory and file basename, and the
+    parsed contents of metadata files, so that each directory is listed (and each file parsed) at
+    most once while it is unchanged. Directory listings are revalidated against the directory
+    mtime, and file contents against the file mtime and size. Directories and files modified
+    within the last metadata_mtime_granularity seconds are not cached, since on filesystems with
+    coarse mtimes they could be modified again (e.g. by another process) without the mtime
+    changing. All cached data is discarded at the start of each batch.
+
+    Within batch_writes(), metadata files are held in memory (and are visible to subsequent reads)
+    until the batch ends, when they are all written.
+    """
+    def __init__(self):
+        self.dir_indices = {}
+        self.file_contents = {}
+        self.pending_writes = None
+
+    def get_latest_index(self, metadata_dir, file_basename):
+        """
+        Returns -1 if no metadata files found
+        """
+        metadata_dir = os.path.abspath(metadata_dir)
+        dir_stat = os.stat(metadata_dir)
+        dir_key = (dir_stat.st_ino, dir_stat.st_mtime)
+        cached = self.dir_indices.get(metadata_dir)
+        if cached is None or cached[0] != dir_key:
+            indices = {}
+            for filename in os.listdir(metadata_dir):
+                match = metadata_filename_regex.match(filename)
+                if match:
+                    basename, index = match.group(1), int(match.group(2))
+                    indices[basename] = max(index, indices.get(basename, -1))
+            cached = (dir_key, indices)
+            if not recently_modified(dir_stat):
+                self.dir_indices[metadata_dir] = cached
+        latest_index = cached[1].get(file_basename, -1)
+
+        if self.pending_writes:
+            for filepath in self.pending_writes:
+                if os.path.dirname(filepath) != metadata_dir:
+                    continue
+                match = metadata_filename_regex.match(os.path.basename(filepath))
+                if match and match.group(1) == file_basename:
+                    latest_index = max(latest_index, int(match.group(2)))
+        return latest_index
+
+    def load(self, filepath):
+        """
+        Returns the parsed contents of a metadata file, or None if it does not exist. The returned
+        object can be modified without affecting the cache.
+        """
+        filepath = os.path.abspath(filepath)
+        if self.pending_writes and filepath in self.pending_writes:
+            return copy.deepcopy(self.pending_writes[filepath][1])
+        try:
+            file_stat = os.stat(filepath)
+        except OSError:
+            return None
+        file_key = (file_stat.st_ino, file_stat.st_mtime, file_stat.st_size)
+        cached = self.file_contents.get(filepath)
+        if cached is None or cached[0] != file_key:
+            with open(filepath) as metadata_file:
+                contents = yaml.load(metadata_file, Loader=YamlLoader)
+            cached = (file_key, contents)
+            if not recently_modified(file_stat):
+                self.file_contents[filepath] = cached
+        return copy.deepcopy(cached[1])
+
+    def write(self, filepath, text, contents):
+        """
+        Parameters
+        ----------
+        filepath : str
+        text : str
+            YAML text to be written
+        contents : dict
+            The data represented by text
+        """
+        filepath = os.path.abspath(filepath)
+        if self.pending_writes is not None:
+            self.pending_writes[filepath] = (text, copy.deepcopy(contents))
+            return
+        with open(filepath, 'w') as ofile:
+            ofile.write(text)
+        self.invalidate(os.path.dirname(filepath))
+
+    def invalidate(self, metadata_dir=None):
+        """
+        Discards the cached directory listing for metadata_dir, or all cached data if metadata_dir
+        is None.
+        """
+        if metadata_dir is None:
+            self.dir_indices = {}
+            self.file_contents = {}
+        else:
+            self.dir_indices.pop(os.path.abspath(metadata_dir), None)
+
+    @contextlib.contextmanager
+    def batch_writes(self):
+        """
+        Context manager within which metadata writes are deferred, and then written together when
+        the context exits (including on an exception, so that the metadata for any targets
+        completed before the exception is kept). Nested batches are written when the outermost
+        batch exits.
+        """
+        if self.pending_writes is not None:
+            yield
+            return
+        self.invalidate()
+        self.pending_writes = {}
+        try:
+            yield
+        finally:
+            pending_writes = self.pending_writes
+            self.pending_writes = None
+            for filepath in sorted(pending_writes):
+                self.write(filepath, pending_writes[filepath][0], pending_writes[filepath][1])
+
+
+metadata_cache = MetadataCache()
+
+
+def batch_metadata_writes(fn):
+    """
+    Decorator which defers the metadata writes made by a stage function until it returns (see
+    MetadataCache.batch_writes).
+
+    Only for stages which are quick to run for each target (e.g. cluster_models). Deferred writes
+    are lost if the process is killed (e.g. at the end of a batch job's walltime), so long-running
+    stages should write their metadata as each target is completed.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with metadata_cache.batch_writes():
+            return fn(*args, **kwargs)
+    return wrapper
+
+
 class ProjectMetadata:
     """
     Examples
@@ -293,10 +495,8 @@ class ProjectMetadata:
 
     def add_prev_metadata(self, project_stage):
         latest_metadata_filepath = self.determine_latest_metadata_filepath(project_stage)
-        if os.path.exists(latest_metadata_filepath):
-            with open(latest_metadata_filepath) as latest_metadata_file:
-                prev_metadata = yaml.load(latest_metadata_file, Loader=YamlLoader)
-        else:
+        prev_metadata = metadata_cache.load(latest_metadata_filepath)
+        if prev_metadata is None:
             prev_metadata = {project_stage: None}
         self.add_data(prev_metadata[project_stage], project_stage=project_stage)
 
@@ -331,18 +531,8 @@ class ProjectMetadata:
         :return: int
         """
         metadata_dir = self.metadata_dir_mapper(project_stage, target_id=self.target_id)
-        dir_contents = os.listdir(metadata_dir)
         metadata_file_basename = self.metadata_file_basename_mapper(project_stage)
-        metadata_file_regex = re.compile('%s([0-9]+)\.yaml' % metadata_file_basename)
-        metadata_file_indices = []
-        for filename in dir_contents:
-            match = re.search(metadata_file_regex, filename)
-            if match:
-                metadata_file_indices.append(int(match.groups()[0]))
-        if len(metadata_file_indices) > 0:
-            return max(metadata_file_indices)
-        else:
-            return -1
+        return metadata_cache.get_latest_index(metadata_dir, metadata_file_basename)
 
     def gen_metadata_filepath_from_dir_index_and_file_basename(self, dirpath, file_basename, index):
         metadata_filepath = os.path.join(dirpath, '%s%d.yaml' % (file_basename, index))
@@ -386,11 +576,14 @@ class ProjectMetadata:
         latest_metadata_file_index = self.determine_latest_metadata_file_index(self.project_stage)
         self.add_iteration_number_to_metadata(latest_metadata_file_index+1)
         metadata_filepath = self.gen_metadata_filepath_from_dir_index_and_file_basename(metadata_dir, metadata_file_basename, latest_metadata_file_index+1)
-        with open(metadata_filepath, 'w') as ofile:
-            for stage in project_stages:
-                if stage in self.data.keys():
-                    subdict = {stage: self.data[stage]}
-                    yaml.dump(subdict, ofile, default_flow_style=False, Dumper=YamlDumper)
+        text = ''
+        written_data = {}
+        for stage in project_stages:
+            if stage in self.data.keys():
+                subdict = {stage: self.data[stage]}
+                text += yaml.dump(subdict, default_flow_style=False, Dumper=YamlDumper)
+                written_data.update(subdict)
+        metadata_cache.write(metadata_filepath, text, written_data)
 
 
 def encode_url_query(uniprot_query):
@@ -470,6 +663,7 @@ def construct_fasta_str(id, seq):
 
 
 def get_targets():
+    import Bio.SeqIO
     targets_fasta_filename = os.path.abspath(os.path.join(
         ensembler.core.default_project_dirnames.targets, 'targets.fa'
     ))
@@ -478,6 +672,7 @@ def get_targets():
 
 
 def get_templates_resolved_seq():
+    import Bio.SeqIO
     templates_resolved_seq_fasta_filename = os.path.abspath(os.path.join(
         ensembler.core.default_project_dirnames.templates, 'templates-resolved-seq.fa'
     ))
@@ -486,6 +681,7 @@ def get_templates_resolved_seq():
 
 
 def get_templates_full_seq():
+    import Bio.SeqIO
     templates_full_seq_fasta_filename = os.path.abspath(os.path.join(
         ensembler.core.default_project_dirnames.templates, 'templates-full-seq.fa'
     ))
@@ -563,6 +759,7 @@ def select_templates_by_seqid_cutoff(targetid, seqid_cutoff=None):
     :param seqid_cutoff:
     :return:
     """
+    import numpy as np
     seqid_filepath = os.path.join(ensembler.core.default_project_dirnames.models, targetid, 'sequence-identities.txt')
     with open(seqid_filepath) as seqid_file:
         seqid_lines_split = [line.split() for line in seqid_file.read().splitlines()]
@@ -5,6 +5,7 @@ import os
 import re
 
 from lxml import etree
+import numpy as np
 import Bio.SeqUtils
 import Bio.SeqIO
 from Bio.Seq import Seq
@@ -15,6 +16,7 @@ import ensembler
 import ensembler.targetexplorer
 import ensembler.uniprot
 import ensembler.pdb
+import ensembler.structure_cache
 from ensembler.utils import file_exists_and_not_empty
 from ensembler.core import mpistate, logger
 
@@ -164,14 +166,20 @@ class GatherTargetsFromUniProt(GatherTargets):
     residue spans: list of [start, end]
         0-based numbering in coordinates of UniProt canonical sequence
     uniprotxml: lxml.etree.Element
-        XML returned from UniProt query
+        XML returned from UniProt query (None if stream_uniprot_xml is set)
+
+    If stream_uniprot_xml is set, the UniProt XML is parsed incrementally as it is received, one
+    <entry> at a time, rather than being read into memory as a whole. This keeps memory use flat
+    for very large (e.g. proteome-scale) queries.
     """
-    def __init__(self, uniprot_query_string, uniprot_domain_regex=None, save_uniprot_xml=False, loglevel=None, run_main=True):
+    def __init__(self, uniprot_query_string, uniprot_domain_regex=None, save_uniprot_xml=False, stream_uniprot_xml=False, loglevel=None, run_main=True):
         ensembler.utils.set_loglevel(loglevel)
         super(GatherTargetsFromUniProt, self).__init__()
         self.uniprot_query_string = uniprot_query_string
         self.uniprot_domain_regex = uniprot_domain_regex
         self._save_uniprot_xml = save_uniprot_xml
+        self._stream_uniprot_xml = stream_uniprot_xml
+        self.uniprotxml = None
         if run_main:
             self._gather_targets()
 
@@ -183,54 +191,78 @@ class GatherTargetsFromUniProt(GatherTargets):
         if self._save_uniprot_xml:
             get_uniprot_xml_args['write_to_filepath'] = 'targets-uniprot.xml'
 
-        self.uniprotxml = ensembler.uniprot.get_uniprot_xml(self.uniprot_query_string, **get_uniprot_xml_args)
+        if self._stream_uniprot_xml:
+            uniprot_entries = ensembler.uniprot.iter_uniprot_query_entries(self.uniprot_query_string, **get_uniprot_xml_args)
+        else:
+            self.uniprotxml = ensembler.uniprot.get_uniprot_xml(self.uniprot_query_string, **get_uniprot_xml_args)
+            uniprot_entries = self.uniprotxml.findall('entry')
+
+        unique_domain_names = UniqueDomainNames(self.uniprot_query_string, self.uniprot_domain_regex)
+        nentries = self._extract_targets_from_uniprot_entries(uniprot_entries, unique_domain_names=unique_domain_names)
 
-        logger.info('Number of entries returned from initial UniProt search: %r\n' % len(self.uniprotxml))
-        log_unique_domain_names(self.uniprot_query_string, self.uniprotxml)
+        logger.info('Number of entries returned from initial UniProt search: %r\n' % nentries)
+        unique_domain_names.log_query_domain_names()
         if self.uniprot_domain_regex:
-            log_unique_domain_names_selected_by_regex(self.uniprot_domain_regex, self.uniprotxml)
+            unique_domain_names.log_regex_domain_names()
         fasta_ofilepath = os.path.join(ensembler.core.default_project_dirnames.targets, 'targets.fa')
-        self._extract_targets_from_uniprot_xml()
         if write_output_files:
             Bio.SeqIO.write(self.targets, fasta_ofilepath, 'fasta')
             self._write_metadata()
 
     def _extract_targets_from_uniprot_xml(self):
-        targets = []
-        residue_spans = []
-        domain_descriptions = []
-        for entry in self.uniprotxml.findall('entry'):
-            entry_name = entry.find('name').text
-            fullseq = ensembler.core.sequnwrap(entry.find('sequence').text)
-            if self.uniprot_domain_regex:
-                selected_domains = entry.xpath(
-                    'feature[@type="domain"][match_regex(@description, "%s")]' % self.uniprot_domain_regex,
-                    extensions={(None, 'match_regex'): ensembler.core.xpath_match_regex_case_sensitive}
-                )
-
-                domain_iter = 0
-                for domain in selected_domains:
-                    targetid = '%s_D%d' % (entry_name, domain_iter)
-                    # domain span override
-                    if targetid in self.manual_overrides.target.domain_spans:
-                        start, end = [int(x) - 1 for x in self.manual_overrides.target.domain_spans[targetid].split('-')]
-                    else:
-                        start, end = [int(domain.find('location/begin').get('position')) - 1,
-                                      int(domain.find('location/end').get('position')) - 1]
-                    targetseq = fullseq[start:end + 1]
-                    targets.append(SeqRecord(Seq(targetseq), id=targetid, description=targetid))
-                    residue_spans.append([start, end])
-                    domain_descriptions.append(domain.get('description'))
-                    domain_iter += 1
+        self._extract_targets_from_uniprot_entries(self.uniprotxml.findall('entry'))
+
+    def _extract_targets_from_uniprot_entries(self, uniprot_entries, unique_domain_names=None):
+        """
+        Parameters
+        ----------
+        uniprot_entries: iterable of lxml.etree.Element
+        unique_domain_names: UniqueDomainNames or None
+            If given, domain names are also recorded for logging while iterating over the entries.
+
+        Returns
+        -------
+        nentries: int
+        """
+        self.targets = []
+        self.residue_spans = []
+        self.domain_descriptions = []
+        nentries = 0
+        for entry in uniprot_entries:
+            nentries += 1
+            if unique_domain_names is not None:
+                unique_domain_names.add_entry(entry)
+            self._extract_targets_from_uniprot_entry(entry)
+        return nentries
+
+    def _extract_targets_from_uniprot_entry(self, entry):
+        entry_name = entry.find('name').text
+        fullseq = ensembler.core.sequnwrap(entry.find('sequence').text)
+        if self.uniprot_domain_regex:
+            selected_domains = entry.xpath(
+                'feature[@type="domain"][match_regex(@description, "%s")]' % self.uniprot_domain_regex,
+                extensions={(None, 'match_regex'): ensembler.core.xpath_match_regex_case_sensitive}
+            )
 
-            else:
-                targetid = entry_name
-                targets.append(SeqRecord(Seq(fullseq), id=targetid, description=targetid))
-                residue_spans.append([0, len(fullseq)-1])
+            domain_iter = 0
+            for domain in selected_domains:
+                targetid = '%s_D%d' % (entry_name, domain_iter)
+                # domain span override
+                if targetid in self.manual_overrides.target.domain_spans:
+                    start, end = [int(x) - 1 for x in self.manual_overrides.target.domain_spans[targetid].split('-')]
+                else:
+                    start, end = [int(domain.find('location/begin').get('position')) - 1,
+                                  int(domain.find('location/end').get('position')) - 1]
+                targetseq = fullseq[start:end + 1]
+                self.targets.append(SeqRecord(Seq(targetseq), id=targetid, description=targetid))
+                self.residue_spans.append([start, end])
+                self.domain_descriptions.append(domain.get('description'))
+                domain_iter += 1
 
-        self.targets = targets
-        self.residue_spans = residue_spans
-        self.domain_descriptions = domain_descriptions
+        else:
+            targetid = entry_name
+            self.targets.append(SeqRecord(Seq(fullseq), id=targetid, description=targetid))
+            self.residue_spans.append([0, len(fullseq)-1])
 
     def _write_metadata(self):
         uniprot_metadata = gen_uniprot_metadata(self.uniprot_query_string, self.uniprot_domain_regex)
@@ -263,40 +295,76 @@ def gen_pdb_metadata(pdbids, uniprot_domain_regex, chainids):
     return metadata
 
 
-def log_unique_domain_names(uniprot_query_string, uniprotxml):
-    # Example query string: 'domain:"Protein kinase" AND reviewed:yes'
-    domain_match = re.search('domain:([\"\'].*[\"\'])', uniprot_query_string)
-    if domain_match and len(domain_match.groups()) > 0:
-        query_string_domain_selection = domain_match.groups()[0].replace('\'', '').replace('\"', '')
-        uniprot_query_string_domains = uniprotxml.xpath(
-            'entry/feature[@type="domain"][match_regex(@description, "%s")]' % query_string_domain_selection,
-            extensions={
-                (None, 'match_regex'): ensembler.core.xpath_match_regex_case_insensitive
-            }
-        )
-        uniprot_unique_domain_names = set([domain.get('description') for domain in uniprot_query_string_domains])
-        logger.info('Set of unique domain names selected by the domain selector \'%s\' during the initial UniProt search:\n%s\n'
-                    % (query_string_domain_selection, uniprot_unique_domain_names))
+class UniqueDomainNames(object):
+    """Collects the set of unique domain names found in UniProt entries, for logging.
 
-    else:
-        uniprot_domains = uniprotxml.xpath('entry/feature[@type="domain"]')
-        uniprot_unique_domain_names = set([domain.get('description') for domain in uniprot_domains])
-        logger.info('Set of unique domain names returned from the initial UniProt search using the query string \'%s\':\n%s\n'
-                    % (uniprot_query_string, uniprot_unique_domain_names))
+    Entries are added one at a time, so that this can be used while streaming UniProt XML.
+    """
+    def __init__(self, uniprot_query_string, uniprot_domain_regex=None):
+        self.uniprot_query_string = uniprot_query_string
+        self.uniprot_domain_regex = uniprot_domain_regex
+        # Example query string: 'domain:"Protein kinase" AND reviewed:yes'
+        self.query_string_domain_selection = None
+        domain_match = re.search('domain:([\"\'].*[\"\'])', uniprot_query_string)
+        if domain_match and len(domain_match.groups()) > 0:
+            self.query_string_domain_selection = domain_match.groups()[0].replace('\'', '').replace('\"', '')
+        self.query_domain_names = set()
+        self.regex_domain_names = set()
+
+    def add_entry(self, entry):
+        if self.query_string_domain_selection is not None:
+            query_domains = entry.xpath(
+                'feature[@type="domain"][match_regex(@description, "%s")]' % self.query_string_domain_selection,
+                extensions={
+                    (None, 'match_regex'): ensembler.core.xpath_match_regex_case_insensitive
+                }
+            )
+        else:
+            query_domains = entry.xpath('feature[@type="domain"]')
+        self.query_domain_names.update([domain.get('description') for domain in query_domains])
+
+        if self.uniprot_domain_regex:
+            regex_matched_domains = entry.xpath(
+                'feature[@type="domain"][match_regex(@description, "%s")]' % self.uniprot_domain_regex,
+                extensions={(None, 'match_regex'): ensembler.core.xpath_match_regex_case_sensitive}
+            )
+            self.regex_domain_names.update([domain.get('description') for domain in regex_matched_domains])
+
+    def log_query_domain_names(self):
+        if self.query_string_domain_selection is not None:
+            logger.info('Set of unique domain names selected by the domain selector \'%s\' during the initial UniProt search:\n%s\n'
+                        % (self.query_string_domain_selection, self.query_domain_names))
+        else:
+            logger.info('Set of unique domain names returned from the initial UniProt search using the query string \'%s\':\n%s\n'
+                        % (self.uniprot_query_string, self.query_domain_names))
+
+    def log_regex_domain_names(self):
+        logger.info('Unique domain names selected after searching with the case-sensitive regex string \'%s\':\n%s\n'
+            % (self.uniprot_domain_regex, self.regex_domain_names))
+
+
+def iter_and_record_domain_names(uniprot_entries, unique_domain_names):
+    for entry in uniprot_entries:
+        unique_domain_names.add_entry(entry)
+        yield entry
+
+
+def log_unique_domain_names(uniprot_query_string, uniprotxml):
+    unique_domain_names = UniqueDomainNames(uniprot_query_string)
+    for entry in uniprotxml.findall('entry'):
+        unique_domain_names.add_entry(entry)
+    unique_domain_names.log_query_domain_names()
 
 
 def log_unique_domain_names_selected_by_regex(uniprot_domain_regex, uniprotxml):
-    regex_matched_domains = uniprotxml.xpath(
-        'entry/feature[@type="domain"][match_regex(@description, "%s")]' % uniprot_domain_regex,
-        extensions={(None, 'match_regex'): ensembler.core.xpath_match_regex_case_sensitive}
-    )
-    regex_matched_domains_unique_names = set([domain.get('description') for domain in regex_matched_domains])
-    logger.info('Unique domain names selected after searching with the case-sensitive regex string \'%s\':\n%s\n'
-        % (uniprot_domain_regex, regex_matched_domains_unique_names))
+    unique_domain_names = UniqueDomainNames('', uniprot_domain_regex)
+    for entry in uniprotxml.findall('entry'):
+        unique_domain_names.add_entry(entry)
+    unique_domain_names.log_regex_domain_names()
 
 
 @ensembler.utils.notify_when_done
-def gather_templates_from_targetexplorer(dbapi_uri, search_string='', structure_dirs=None, loglevel=None):
+def gather_templates_from_targetexplorer(dbapi_uri, search_string='', structure_dirs=None, loglevel=None, structure_cache_dir=None, structure_cache_max_size=None):
     """Gather protein template data from a TargetExplorer DB network API.
     Pass the URI for the database API and a search string.
     The search string uses SQLAlchemy syntax and standard TargetExplorer
@@ -312,8 +380,7 @@ def gather_templates_from_targetexplorer(dbapi_uri, search_string='', structure_
     manual_overrides = ensembler.core.ManualOverrides()
     templates_json = get_targetexplorer_templates_json(dbapi_uri, search_string)
     selected_pdbchains = extract_template_pdbchains_from_targetexplorer_json(templates_json, manual_overrides=manual_overrides)
-    for pdbchain in selected_pdbchains:
-        get_pdb_and_sifts_files(pdbchain['pdbid'], structure_dirs)
+    get_pdb_and_sifts_files_for_pdbids([pdbchain['pdbid'] for pdbchain in selected_pdbchains], structure_dirs, structure_cache_dir=structure_cache_dir, structure_cache_max_size=structure_cache_max_size)
 
     selected_templates = extract_template_pdb_chain_residues(selected_pdbchains)
     write_template_seqs_to_fasta_file(selected_templates)
@@ -322,21 +389,32 @@ def gather_templates_from_targetexplorer(dbapi_uri, search_string='', structure_
 
 
 @ensembler.utils.notify_when_done
-def gather_templates_from_uniprot(uniprot_query_string, uniprot_domain_regex=None, structure_dirs=None, pdbids=None, chainids=None, loglevel=None):
+def gather_templates_from_uniprot(uniprot_query_string, uniprot_domain_regex=None, structure_dirs=None, pdbids=None, chainids=None, loglevel=None, structure_cache_dir=None, stream_uniprot_xml=False, structure_cache_max_size=None):
     """# Searches UniProt for a set of template proteins with a user-defined
-    query string, then saves IDs, sequences and structures."""
+    query string, then saves IDs, sequences and structures.
+    If stream_uniprot_xml is set, UniProt entries are parsed one at a time as they are received,
+    rather than reading the entire XML document into memory."""
     ensembler.utils.set_loglevel(loglevel)
     manual_overrides = ensembler.core.ManualOverrides()
     selected_pdbchains = None
     if mpistate.rank == 0:
-        uniprotxml = ensembler.uniprot.get_uniprot_xml(uniprot_query_string)
-        log_unique_domain_names(uniprot_query_string, uniprotxml)
-        if uniprot_domain_regex is not None:
-            log_unique_domain_names_selected_by_regex(uniprot_domain_regex, uniprotxml)
+        if stream_uniprot_xml:
+            unique_domain_names = UniqueDomainNames(uniprot_query_string, uniprot_domain_regex)
+            uniprot_entries = iter_and_record_domain_names(
+                ensembler.uniprot.iter_uniprot_query_entries(uniprot_query_string), unique_domain_names
+            )
+            selected_pdbchains = extract_template_pdbchains_from_uniprot_xml(uniprot_entries, uniprot_domain_regex=uniprot_domain_regex, manual_overrides=manual_overrides, specified_pdbids=pdbids, specified_chainids=chainids)
+            unique_domain_names.log_query_domain_names()
+            if uniprot_domain_regex is not None:
+                unique_domain_names.log_regex_domain_names()
+        else:
+            uniprotxml = ensembler.uniprot.get_uniprot_xml(uniprot_query_string)
+            log_unique_domain_names(uniprot_query_string, uniprotxml)
+            if uniprot_domain_regex is not None:
+                log_unique_domain_names_selected_by_regex(uniprot_domain_regex, uniprotxml)
 
-        selected_pdbchains = extract_template_pdbchains_from_uniprot_xml(uniprotxml, uniprot_domain_regex=uniprot_domain_regex, manual_overrides=manual_overrides, specified_pdbids=pdbids, specified_chainids=chainids)
-        for pdbchain in selected_pdbchains:
-            get_pdb_and_sifts_files(pdbchain['pdbid'], structure_dirs)
+            selected_pdbchains = extract_template_pdbchains_from_uniprot_xml(uniprotxml, uniprot_domain_regex=uniprot_domain_regex, manual_overrides=manual_overrides, specified_pdbids=pdbids, specified_chainids=chainids)
+        get_pdb_and_sifts_files_for_pdbids([pdbchain['pdbid'] for pdbchain in selected_pdbchains], structure_dirs, structure_cache_dir=structure_cache_dir, structure_cache_max_size=structure_cache_max_size)
 
     selected_pdbchains = mpistate.comm.bcast(selected_pdbchains, root=0)
     logger.debug('Selected PDB chains: {0}'.format([pdbchain['templateid'] for pdbchain in selected_pdbchains]))
@@ -348,24 +426,25 @@ def gather_templates_from_uniprot(uniprot_query_string, uniprot_domain_regex=Non
 
 
 @ensembler.utils.notify_when_done
-def gather_templates_from_pdb(pdbids, uniprot_domain_regex=None, chainids=None, structure_dirs=None, loglevel=None):
+def gather_templates_from_pdb(pdbids, uniprot_domain_regex=None, chainids=None, structure_dirs=None, loglevel=None, structure_cache_dir=None, uniprot_cache_dir=None, structure_cache_max_size=None):
     """
     :param pdbids: list of str
     :param uniprot_domain_regex: str
     :param chainids: dict {pdbid (str): [chainid (str)]}
     :param structure_dirs: list of str
+    :param structure_cache_dir: str
+    :param structure_cache_max_size: int (bytes) - least recently used files are evicted from the structure cache beyond this size
+    :param uniprot_cache_dir: str - UniProt entry cache (see ensembler.uniprot.UniProtClient)
     :return:
     """
     ensembler.utils.set_loglevel(loglevel)
     manual_overrides = ensembler.core.ManualOverrides()
     selected_pdbchains = None
     if mpistate.rank == 0:
-        for pdbid in pdbids:
-            get_pdb_and_sifts_files(pdbid, structure_dirs)
+        get_pdb_and_sifts_files_for_pdbids(pdbids, structure_dirs, structure_cache_dir=structure_cache_dir, structure_cache_max_size=structure_cache_max_size)
         uniprot_acs = extract_uniprot_acs_from_sifts_files(pdbids)
         logger.debug('Extracted UniProt ACs: {0}'.format(uniprot_acs))
-        uniprot_ac_query_string = ensembler.uniprot.build_uniprot_query_string_from_acs(uniprot_acs)
-        uniprotxml = ensembler.uniprot.get_uniprot_xml(uniprot_ac_query_string)
+        uniprotxml = ensembler.uniprot.UniProtClient(cache_dir=uniprot_cache_dir).get_uniprot_xml(uniprot_acs)
         selected_pdbchains = extract_template_pdbchains_from_uniprot_xml(uniprotxml, uniprot_domain_regex=uniprot_domain_regex, manual_overrides=manual_overrides, specified_pdbids=pdbids, specified_chainids=chainids)
 
     selected_pdbchains = mpistate.comm.bcast(selected_pdbchains, root=0)
@@ -423,10 +502,30 @@ def extract_template_pdbchains_from_targetexplorer_json(targetexplorer_json, man
     return selected_pdbchains
 
 
-def attempt_symlink_structure_files(pdbid, project_structures_dir, structure_dirs, structure_type='pdb'):
+def list_structure_dirs(structure_dirs):
+    """
+    List the contents of each structure directory once, so that lookups for each PDB ID do not
+    require a filesystem call per directory.
+
+    :param structure_dirs: list of str
+    :return: dict {structure_dir (str): set of filenames}
+    """
+    structure_dir_contents = {}
+    for structure_dir in structure_dirs:
+        if os.path.isdir(structure_dir):
+            structure_dir_contents[structure_dir] = set(os.listdir(structure_dir))
+        else:
+            structure_dir_contents[structure_dir] = set()
+    return structure_dir_contents
+
+
+def attempt_symlink_structure_files(pdbid, project_structures_dir, structure_dirs, structure_type='pdb', structure_dir_contents=None):
     project_structure_filepath = os.path.join(project_structures_dir, structure_type, pdbid + structure_type_file_extension_mapper[structure_type])
     for structure_dir in structure_dirs:
-        structure_filepath = os.path.join(structure_dir, pdbid + structure_type_file_extension_mapper[structure_type])
+        structure_filename = pdbid + structure_type_file_extension_mapper[structure_type]
+        if structure_dir_contents is not None and structure_filename not in structure_dir_contents[structure_dir]:
+            continue
+        structure_filepath = os.path.join(structure_dir, structure_filename)
         if os.path.exists(structure_filepath):
             if file_exists_and_not_empty(structure_filepath) > 0:
                 if os.path.exists(project_structure_filepath):
@@ -457,31 +556,122 @@ def download_sifts_file(pdbid, project_sifts_filepath):
 
 
 def get_pdb_and_sifts_files(pdbid, structure_dirs=None):
+    get_pdb_and_sifts_files_for_pdbids([pdbid], structure_dirs=structure_dirs)
+
+
+def get_pdb_and_sifts_files_for_pdbids(pdbids, structure_dirs=None, ndownload_threads=8, structure_cache_dir=None, structure_cache_max_size=None):
+    """
+    Symlink PDB and SIFTS files from a shared structure cache or from structure_dirs where
+    available, and download the remainder concurrently. If a structure cache is used (either
+    structure_cache_dir, or the directory set by the ENSEMBLER_STRUCTURE_CACHE environment
+    variable), downloaded files are moved into the cache and symlinked into the project.
+
+    :param pdbids: list of str
+    :param structure_dirs: list of str
+    :param ndownload_threads: int
+    :param structure_cache_dir: str
+    :param structure_cache_max_size: int (bytes)
+    """
     if type(structure_dirs) != list:
         structure_dirs = []
+    if structure_cache_dir is None:
+        structure_cache_dir = ensembler.structure_cache.get_default_structure_cache_dir()
+    if structure_cache_dir:
+        structure_cache = ensembler.structure_cache.StructureCache(structure_cache_dir, max_size=structure_cache_max_size)
+    else:
+        structure_cache = None
+
     project_structures_dir = 'structures'
-    for structure_type in ['pdb', 'sifts']:
-        project_structure_filepath = os.path.join(project_structures_dir, structure_type, pdbid + structure_type_file_extension_mapper[structure_type])
-        if not file_exists_and_not_empty(project_structure_filepath):
-            attempt_symlink_structure_files(pdbid, project_structures_dir, structure_dirs, structure_type=structure_type)
-            if not os.path.exists(project_structure_filepath):
-                download_structure_file(pdbid, project_structure_filepath, structure_type=structure_type)
+    missing = []
+    for pdbid in sorted(set(pdbids)):
+        for structure_type in ['pdb', 'sifts']:
+            project_structure_filepath = os.path.join(project_structures_dir, structure_type, pdbid + structure_type_file_extension_mapper[structure_type])
+            if not file_exists_and_not_empty(project_structure_filepath):
+                missing.append((pdbid, structure_type, project_structure_filepath))
+
+    if structure_cache is not None and len(missing) > 0:
+        missing = structure_cache.link_all(missing)
+
+    downloads = []
+    structure_dir_contents = list_structure_dirs(structure_dirs)
+    for pdbid, structure_type, project_structure_filepath in missing:
+        attempt_symlink_structure_files(pdbid, project_structures_dir, structure_dirs, structure_type=structure_type, structure_dir_contents=structure_dir_contents)
+        if not os.path.exists(project_structure_filepath):
+            downloads.append((pdbid, structure_type, project_structure_filepath))
+
+    if len(downloads) == 0:
+        return
+    logger.info('Downloading %d PDB and SIFTS files...' % len(downloads))
+    fetcher = ensembler.pdb.HTTPFetcher(nthreads=ndownload_threads)
+    failures = ensembler.pdb.download_structure_files(downloads, fetcher=fetcher)
+
+    if structure_cache is not None:
+        downloaded = [download for download in downloads if tuple(download[0:2]) not in failures]
+        structure_cache.add_all(downloaded, move=True)
+        structure_cache.link_all(downloaded)
+
+    if len(failures) > 0:
+        raise Exception('Failed to download structure files: %s' % ', '.join(
+            ['%s (%s)' % (pdbid, structure_type) for pdbid, structure_type in sorted(failures)]
+        ))
 
 
 def extract_template_pdb_chain_residues(selected_pdbchains):
-    selected_templates = None
+    """
+    PDB entries are distributed across MPI ranks. Each SIFTS file is parsed (or loaded from its
+    residue table cache) once, and used for all selected chains from that PDB entry. The results
+    are gathered in the original order of selected_pdbchains.
+    """
     if mpistate.rank == 0:
         logger.info('Extracting residues from PDB chains...')
-        selected_templates = []
-        for pdbchain in selected_pdbchains:
-            extracted_pdb_template_seq_data = extract_pdb_template_seq(pdbchain)
-            if extracted_pdb_template_seq_data is not None:
-                selected_templates.append(extracted_pdb_template_seq_data)
+
+    pdbchain_groups = group_indices_by_pdbid([pdbchain['pdbid'] for pdbchain in selected_pdbchains])
+    extracted_sublist = []
+    for group_index in range(mpistate.rank, len(pdbchain_groups), mpistate.size):
+        pdbid, pdbchain_indices = pdbchain_groups[group_index]
+        sifts_filepath = os.path.join('structures', 'sifts', pdbid + '.xml.gz')
+        sifts_residue_table = load_sifts_residue_table(sifts_filepath)
+        for pdbchain_index in pdbchain_indices:
+            extracted_sublist.append((
+                pdbchain_index,
+                extract_pdb_template_seq(selected_pdbchains[pdbchain_index], sifts_residue_table=sifts_residue_table)
+            ))
+
+    extracted_gathered = mpistate.comm.gather(extracted_sublist, root=0)
+
+    selected_templates = None
+    if mpistate.rank == 0:
+        extracted_by_pdbchain_index = {}
+        for rank_extracted_sublist in extracted_gathered:
+            extracted_by_pdbchain_index.update(rank_extracted_sublist)
+        selected_templates = [
+            extracted_by_pdbchain_index[pdbchain_index] for pdbchain_index in range(len(selected_pdbchains))
+            if extracted_by_pdbchain_index[pdbchain_index] is not None
+        ]
         logger.info('%d templates selected.\n' % len(selected_templates))
     selected_templates = mpistate.comm.bcast(selected_templates, root=0)
     return selected_templates
 
 
+def group_indices_by_pdbid(pdbids):
+    """
+    Group list indices by PDB ID, so that per-entry files need only be read once.
+
+    :param pdbids: list of str
+    :return: list of (pdbid, [index (int)]), in order of first appearance
+    >>> group_indices_by_pdbid(['1OPL', '2H8H', '1OPL'])
+    [('1OPL', [0, 2]), ('2H8H', [1])]
+    """
+    groups = []
+    group_by_pdbid = {}
+    for index, pdbid in enumerate(pdbids):
+        if pdbid not in group_by_pdbid:
+            group_by_pdbid[pdbid] = (pdbid, [])
+            groups.append(group_by_pdbid[pdbid])
+        group_by_pdbid[pdbid][1].append(index)
+    return groups
+
+
 def parse_sifts_xml(sifts_filepath):
     with gzip.open(sifts_filepath, 'rb') as sifts_file:
         parser = etree.XMLParser(huge_tree=True)
@@ -512,56 +702,49 @@ def add_pdb_modified_xml_tags_to_residues(siftsxml):
         mr.append(residue_detail_modified)
 
 
-def extract_pdb_template_seq(pdbchain):
-    """Extract data from PDB chain"""
+def extract_pdb_template_seq(pdbchain, sifts_residue_table=None):
+    """Extract data from PDB chain
+
+    :param pdbchain: dict
+    :param sifts_residue_table: dict (optional) - as returned by parse_sifts_residue_table; parsed
+    from the project SIFTS file if not given
+    """
     templateid = pdbchain['templateid']
     chainid = pdbchain['chainid']
     pdbid = pdbchain['pdbid']
     residue_span = pdbchain['residue_span']   # UniProt coords
 
-    sifts_filepath = os.path.join('structures', 'sifts', pdbid + '.xml.gz')
-    siftsxml = parse_sifts_xml(sifts_filepath)
-
-    add_pdb_modified_xml_tags_to_residues(siftsxml)
-
-    # domain_span_sifts_coords = [
-    #     int(siftsxml.find('entity/segment/listResidue/residue/crossRefDb[@dbSource="UniProt"][@dbChainId="%s"][@dbResNum="%d"]/..' % (chainid, residue_span[0])).get('dbResNum')),
-    #     int(siftsxml.find('entity/segment/listResidue/residue/crossRefDb[@dbSource="UniProt"][@dbChainId="%s"][@dbResNum="%d"]/..' % (chainid, residue_span[1])).get('dbResNum')),
-    # ]
-
-    # An alternative approach would be to just take the UniProt sequence specified by the domain span
-    selected_residues = siftsxml.xpath(
-        'entity/segment/listResidue/residue/crossRefDb[@dbSource="PDB"][@dbChainId="%s"]'
-        '[../crossRefDb[@dbSource="UniProt"][@dbResNum >= "%d"][@dbResNum <= "%d"]]' % (chainid, residue_span[0], residue_span[1])
-    )
-
-    # now extract PDB residues which have the correct PDB chain ID, are resolved, have a UniProt crossref and are within the UniProt domain bounds, and do not have "PDB modified", "Conflict" or "Engineered mutation" tags.
-    selected_resolved_residues = siftsxml.xpath(
-        'entity/segment/listResidue/residue/crossRefDb[@dbSource="PDB"][@dbChainId="%s"][not(../residueDetail[contains(text(),"Not_Observed")])]'
-        '[../crossRefDb[@dbSource="UniProt"][@dbResNum >= "%d"][@dbResNum <= "%d"]][not(../residueDetail[contains(text(),"modified")])]'
-        '[not(../residueDetail[contains(text(),"Conflict")])][not(../residueDetail[contains(text(),"mutation")])]' % (chainid, residue_span[0], residue_span[1])
-    )
-
-    # second stage of filtering to remove residues which conflict with the UniProt resname, but are not annotated as such
-    selected_resolved_residues = [r for r in selected_resolved_residues if Bio.SeqUtils.seq1(r.get('dbResName')) == r.find('../crossRefDb[@dbSource="UniProt"]').get('dbResName')]
+    if sifts_residue_table is None:
+        sifts_filepath = os.path.join('structures', 'sifts', pdbid + '.xml.gz')
+        sifts_residue_table = load_sifts_residue_table(sifts_filepath)
 
-    # all_pdb_domain_residues = siftsxml.xpath(
-    #     'entity/segment/listResidue/residue/crossRefDb[@dbSource="PDB"][@dbChainId="%s"][../crossRefDb[@dbSource="UniProt"][@dbResNum >= "%d"][@dbResNum <= "%d"]]' % (chainid, residue_span[0], residue_span[1])
-    # )
+    chain_residues = sifts_residue_table.get(chainid)
+    if chain_residues is None:
+        return
 
-    if len(selected_resolved_residues) == 0 or len(selected_residues) == 0:
+    # Select PDB residues which have the correct PDB chain ID and a UniProt crossref within the
+    # UniProt domain bounds. An alternative approach would be to just take the UniProt sequence
+    # specified by the domain span.
+    # Of those, select residues which are resolved and do not have "PDB modified", "Conflict" or
+    # "Engineered mutation" tags, or which conflict with the UniProt resname but are not annotated
+    # as such.
+    selected_mask, selected_resolved_mask = select_sifts_domain_residues(chain_residues, residue_span)
+    nselected = np.count_nonzero(selected_mask)
+    nselected_resolved = np.count_nonzero(selected_resolved_mask)
+
+    if nselected_resolved == 0 or nselected == 0:
         return
 
     # calculate the ratio of resolved residues - if less than a certain amount, discard pdbchain
-    ratio_resolved = float(len(selected_resolved_residues)) / float(len(selected_residues))
+    ratio_resolved = float(nselected_resolved) / float(nselected)
     if ratio_resolved < ensembler.core.template_acceptable_ratio_resolved_residues:
         return
 
     # make a single-letter aa code sequence
-    full_seq = ''.join([residue.find('../crossRefDb[@dbSource="UniProt"]').get('dbResName') for residue in selected_residues])
-    full_pdbresnums = [residue.get('dbResNum') for residue in selected_residues]
-    template_seq_resolved = ''.join([residue.find('../crossRefDb[@dbSource="UniProt"]').get('dbResName') for residue in selected_resolved_residues])
-    template_pdbresnums_resolved = [residue.get('dbResNum') for residue in selected_resolved_residues]
+    full_seq = ''.join(chain_residues['uniprot_resnames'][selected_mask])
+    full_pdbresnums = [str(resnum) for resnum in chain_residues['pdb_resnums'][selected_mask]]
+    template_seq_resolved = ''.join(chain_residues['uniprot_resnames'][selected_resolved_mask])
+    template_pdbresnums_resolved = [str(resnum) for resnum in chain_residues['pdb_resnums'][selected_resolved_mask]]
 
     # store data
     template_data = TemplateData(
@@ -577,6 +760,197 @@ def extract_pdb_template_seq(pdbchain):
     return template_data
 
 
+# Residue types which are treated as modified, even if the SIFTS file lacks a "PDB modified" tag
+# (see add_pdb_modified_xml_tags_to_residues).
+sifts_untagged_modified_resnames = ['TPO', 'PTR', 'SEP']
+
+
+def parse_sifts_residue_table(sifts_filepath):
+    """
+    Parse a SIFTS file in a single streaming pass, building a table of residues for each PDB chain.
+
+    Each residue which has a PDB crossref is recorded (in document order) in the table for the
+    chain given by that crossref. uniprot_resnums and uniprot_resnames are taken from the first
+    UniProt crossref of each residue, and all_uniprot_resnums holds the resnums of every UniProt
+    crossref (e.g. for residues mapped to more than one UniProt entry).
+
+    :param sifts_filepath: str (.xml.gz)
+    :return: dict {chainid (str): {column name (str): np.array}}, with columns:
+        pdb_resnums (str), pdb_resnames_seq1 (str), uniprot_resnums (float; NaN if no UniProt
+        crossref), all_uniprot_resnums (float, of shape (nresidues, max UniProt crossrefs per
+        residue); padded with NaN), uniprot_resnames (str; '' if no UniProt crossref), observed,
+        modified, conflict, mutation (bool)
+    """
+    rows_by_chain = {}
+    seq1_cache = {}
+
+    with gzip.open(sifts_filepath, 'rb') as sifts_file:
+        for event, residue in etree.iterparse(sifts_file, events=('end',), tag='{*}residue', huge_tree=True):
+            pdb_crossref = None
+            uniprot_crossrefs = []
+            residue_details = []
+            for child in residue:
+                child_tag = child.tag.rsplit('}', 1)[-1] if isinstance(child.tag, str) else None
+                if child_tag == 'crossRefDb':
+                    db_source = child.get('dbSource')
+                    if db_source == 'PDB' and pdb_crossref is None:
+                        pdb_crossref = child
+                    elif db_source == 'UniProt':
+                        uniprot_crossrefs.append(child)
+                elif child_tag == 'residueDetail':
+                    residue_details.append(child.text or '')
+
+            if pdb_crossref is not None:
+                pdb_resname = pdb_crossref.get('dbResName')
+                if pdb_resname not in seq1_cache:
+                    seq1_cache[pdb_resname] = Bio.SeqUtils.seq1(pdb_resname)
+                uniprot_resnums = []
+                for uniprot_crossref in uniprot_crossrefs:
+                    try:
+                        uniprot_resnums.append(float(uniprot_crossref.get('dbResNum')))
+                    except (TypeError, ValueError):
+                        # non-numeric resnums never match a domain span (as with an XPath comparison)
+                        uniprot_resnums.append(np.nan)
+                if uniprot_crossrefs:
+                    uniprot_resname = uniprot_crossrefs[0].get('dbResName')
+                else:
+                    uniprot_resname = ''
+                rows_by_chain.setdefault(pdb_crossref.get('dbChainId'), []).append((
+                    pdb_crossref.get('dbResNum'),
+                    seq1_cache[pdb_resname],
+                    uniprot_resnums,
+                    uniprot_resname,
+                    not any(['Not_Observed' in detail for detail in residue_details]),
+                    residue.get('dbResName') in sifts_untagged_modified_resnames or any(['modified' in detail for detail in residue_details]),
+                    any(['Conflict' in detail for detail in residue_details]),
+                    any(['mutation' in detail for detail in residue_details]),
+                ))
+
+            # Free memory used by processed elements.
+            residue.clear()
+            while residue.getprevious() is not None:
+                del residue.getparent()[0]
+
+    residue_table = {}
+    for chainid, rows in rows_by_chain.items():
+        row_columns = list(zip(*rows))
+        all_uniprot_resnums = np.empty((len(rows), max([1] + [len(resnums) for resnums in row_columns[2]])))
+        all_uniprot_resnums.fill(np.nan)
+        for row_index, resnums in enumerate(row_columns[2]):
+            all_uniprot_resnums[row_index, :len(resnums)] = resnums
+        residue_table[chainid] = {
+            'pdb_resnums': np.array(row_columns[0]),
+            'pdb_resnames_seq1': np.array(row_columns[1]),
+            'uniprot_resnums': all_uniprot_resnums[:, 0].copy(),
+            'all_uniprot_resnums': all_uniprot_resnums,
+            'uniprot_resnames': np.array(row_columns[3]),
+            'observed': np.array(row_columns[4], dtype=bool),
+            'modified': np.array(row_columns[5], dtype=bool),
+            'conflict': np.array(row_columns[6], dtype=bool),
+            'mutation': np.array(row_columns[7], dtype=bool),
+        }
+    return residue_table
+
+
+# Increment if the columns or semantics of the SIFTS residue table change, so that cached tables are
+# regenerated.
+sifts_residue_table_format_version = 2
+
+
+def gen_sifts_residue_table_cache_filepath(sifts_filepath):
+    """
+    The residue table cache is stored next to the SIFTS file, e.g. structures/sifts/4AF3.residues.npz
+    """
+    if sifts_filepath.endswith('.xml.gz'):
+        sifts_filepath = sifts_filepath[:-len('.xml.gz')]
+    return sifts_filepath + '.residues.npz'
+
+
+def load_sifts_residue_table(sifts_filepath, use_cache=True):
+    """
+    Load the residue table for a SIFTS file (see parse_sifts_residue_table), using the cached table
+    stored alongside the SIFTS file if it is up to date. The cache is keyed by the size and
+    modification time of the SIFTS file (following symlinks), and is regenerated if either changes.
+
+    :param sifts_filepath: str (.xml.gz)
+    :param use_cache: bool
+    :return: dict {chainid (str): {column name (str): np.array}}
+    """
+    if not use_cache:
+        return parse_sifts_residue_table(sifts_filepath)
+
+    sifts_stat = os.stat(sifts_filepath)
+    sifts_key = np.array([sifts_residue_table_format_version, sifts_stat.st_size, sifts_stat.st_mtime])
+    cache_filepath = gen_sifts_residue_table_cache_filepath(sifts_filepath)
+
+    if os.path.exists(cache_filepath):
+        try:
+            residue_table = read_sifts_residue_table_cache(cache_filepath, sifts_key)
+        except Exception as e:
+            logger.debug('Could not read SIFTS residue table cache %s: %s' % (cache_filepath, e))
+            residue_table = None
+        if residue_table is not None:
+            return residue_table
+
+    residue_table = parse_sifts_residue_table(sifts_filepath)
+    try:
+        write_sifts_residue_table_cache(cache_filepath, residue_table, sifts_key)
+    except (IOError, OSError) as e:
+        logger.debug('Could not write SIFTS residue table cache %s: %s' % (cache_filepath, e))
+    return residue_table
+
+
+def write_sifts_residue_table_cache(cache_filepath, residue_table, sifts_key):
+    arrays = {'sifts_key': sifts_key}
+    for chainid, chain_residues in residue_table.items():
+        for column_name, column in chain_residues.items():
+            arrays['%s.%s' % (chainid, column_name)] = column
+    temp_filepath = cache_filepath + '.%d.tmp' % os.getpid()
+    with open(temp_filepath, 'wb') as cache_file:
+        np.savez(cache_file, **arrays)
+    os.rename(temp_filepath, cache_filepath)
+
+
+def read_sifts_residue_table_cache(cache_filepath, sifts_key):
+    """
+    :return: dict, or None if the cache does not match the given SIFTS file key
+    """
+    residue_table = {}
+    with np.load(cache_filepath) as cache:
+        if not np.array_equal(cache['sifts_key'], sifts_key):
+            return None
+        for array_name in cache.files:
+            if array_name == 'sifts_key':
+                continue
+            chainid, column_name = array_name.rsplit('.', 1)
+            residue_table.setdefault(chainid, {})[column_name] = cache[array_name]
+    return residue_table
+
+
+def select_sifts_domain_residues(chain_residues, residue_span):
+    """
+    :param chain_residues: dict - residue table for a single chain (see parse_sifts_residue_table)
+    :param residue_span: [int, int] - UniProt coords (inclusive)
+    :return: (selected_mask, selected_resolved_mask) - np.array (bool)
+
+    A residue is selected if any of its UniProt crossrefs is within the span.
+    """
+    all_uniprot_resnums = chain_residues['all_uniprot_resnums']
+    with np.errstate(invalid='ignore'):
+        selected_mask = np.any(
+            (all_uniprot_resnums >= residue_span[0]) & (all_uniprot_resnums <= residue_span[1]), axis=1
+        )
+    selected_resolved_mask = (
+        selected_mask
+        & chain_residues['observed']
+        & ~chain_residues['modified']
+        & ~chain_residues['conflict']
+        & ~chain_residues['mutation']
+        & (chain_residues['pdb_resnames_seq1'] == chain_residues['uniprot_resnames'])
+    )
+    return selected_mask, selected_resolved_mask
+
+
 @ensembler.utils.mpirank0only_and_end_with_barrier
 def write_template_seqs_to_fasta_file(selected_templates):
     templates_resolved_seqs = [SeqRecord(Seq(template.resolved_seq), id=template.templateid, description=template.templateid) for template in selected_templates]
@@ -585,13 +959,24 @@ def write_template_seqs_to_fasta_file(selected_templates):
     Bio.SeqIO.write(templates_full_seqs, os.path.join('templates', 'templates-full-seq.fa'), 'fasta')
 
 
-@ensembler.utils.mpirank0only_and_end_with_barrier
 def extract_template_structures_from_pdb_files(selected_templates):
-    logger.info('Writing template structures...')
-    for template in selected_templates:
-        pdb_filename = os.path.join(ensembler.core.default_project_dirnames.structures_pdb, template.pdbid + '.pdb.gz')
-        template_resolved_filename = os.path.join(ensembler.core.default_project_dirnames.templates_structures_resolved, template.templateid + '.pdb')
-        ensembler.pdb.extract_residues_by_resnum(template_resolved_filename, pdb_filename, template)
+    """
+    PDB entries are distributed across MPI ranks, and all templates from each PDB entry are
+    extracted in a single pass over its PDB file.
+    """
+    if mpistate.rank == 0:
+        logger.info('Writing template structures...')
+    template_groups = group_indices_by_pdbid([template.pdbid for template in selected_templates])
+    for group_index in range(mpistate.rank, len(template_groups), mpistate.size):
+        pdbid, template_indices = template_groups[group_index]
+        pdb_filename = os.path.join(ensembler.core.default_project_dirnames.structures_pdb, pdbid + '.pdb.gz')
+        templates = [selected_templates[template_index] for template_index in template_indices]
+        template_resolved_filenames = [
+            os.path.join(ensembler.core.default_project_dirnames.templates_structures_resolved, template.templateid + '.pdb')
+            for template in templates
+        ]
+        ensembler.pdb.extract_templates_from_pdb(template_resolved_filenames, pdb_filename, templates)
+    mpistate.comm.Barrier()
 
 
 @ensembler.utils.mpirank0only_and_end_with_barrier
@@ -644,7 +1029,9 @@ def extract_template_pdbchains_from_uniprot_xml(uniprotxml, uniprot_domain_regex
     """
     Parameters
     ----------
-    uniprotxml: lxml.etree.Element
+    uniprotxml: lxml.etree.Element, or iterable of lxml.etree.Element
+        UniProt XML, or an iterable of UniProt <entry> elements (e.g. from
+        ensembler.uniprot.iter_uniprot_query_entries)
     uniprot_domain_regex: str
     manual_overrides: ensembler.core.TemplateManualOverrides
     specified_pdbids: list of str
@@ -667,61 +1054,56 @@ def extract_template_pdbchains_from_uniprot_xml(uniprotxml, uniprot_domain_regex
             }
         ]
     """
+    if etree.iselement(uniprotxml):
+        uniprot_entries = uniprotxml.findall('entry')
+    else:
+        uniprot_entries = uniprotxml
     selected_pdbchains = []
-    all_uniprot_entries = uniprotxml.findall('entry')
-    for entry in all_uniprot_entries:
-        entry_name = entry.find('name').text
-        if uniprot_domain_regex:
-            selected_domains = entry.xpath(
-                'feature[@type="domain"][match_regex(@description, "%s")]' % uniprot_domain_regex,
-                extensions={(None, 'match_regex'): ensembler.core.xpath_match_regex_case_sensitive}
-            )
+    for entry in uniprot_entries:
+        selected_pdbchains += extract_template_pdbchains_from_uniprot_entry(
+            entry, uniprot_domain_regex=uniprot_domain_regex, manual_overrides=manual_overrides,
+            specified_pdbids=specified_pdbids, specified_chainids=specified_chainids
+        )
 
-            domain_iter = 0
-            for domain in selected_domains:
-                domain_id = '%s_D%d' % (entry_name, domain_iter)
-                domain_span = [int(domain.find('location/begin').get('position')), int(domain.find('location/end').get('position'))]
-                if manual_overrides and domain_id in manual_overrides.template.domain_spans:
-                    domain_span = [int(x) for x in manual_overrides.template.domain_spans[domain_id].split('-')]
-                domain_len = domain_span[1] - domain_span[0] + 1
-                if manual_overrides and manual_overrides.template.min_domain_len is not None and domain_len < manual_overrides.template.min_domain_len:
-                    continue
-                if manual_overrides and manual_overrides.template.max_domain_len is not None and domain_len > manual_overrides.template.max_domain_len:
-                    continue
+    logger.info('%d PDB chains selected.' % len(selected_pdbchains))
+    return selected_pdbchains
 
-                domain_iter += 1
-                pdbs = domain.getparent().xpath(
-                    'dbReference[@type="PDB"]/property[@type="method"][@value="X-ray" or @value="NMR"]/..'
-                )
 
-                for pdb in pdbs:
-                    pdbid = pdb.get('id')
-                    if manual_overrides and pdbid in manual_overrides.template.skip_pdbs:
-                        continue
-                    if specified_pdbids and pdbid not in specified_pdbids:
-                        continue
-                    pdb_chain_span_nodes = pdb.findall('property[@type="chains"]')
-
-                    for pdb_chain_span_node in pdb_chain_span_nodes:
-                        chain_span_string = pdb_chain_span_node.get('value')
-                        chain_spans = ensembler.uniprot.parse_uniprot_pdbref_chains(chain_span_string)
-
-                        for chainid in chain_spans.keys():
-                            if specified_chainids and len(specified_chainids[pdbid]) > 0 and chainid not in specified_chainids[pdbid]:
-                                continue
-                            span = chain_spans[chainid]
-                            if (span[0] < domain_span[0] + 30) & (span[1] > domain_span[1] - 30):
-                                templateid = '%s_%s_%s' % (domain_id, pdbid, chainid)
-                                data = {
-                                    'templateid': templateid,
-                                    'pdbid': pdbid,
-                                    'chainid': chainid,
-                                    'residue_span': domain_span
-                                }
-                                selected_pdbchains.append(data)
+def extract_template_pdbchains_from_uniprot_entry(entry, uniprot_domain_regex=None, manual_overrides=None, specified_pdbids=None, specified_chainids=None):
+    """
+    See extract_template_pdbchains_from_uniprot_xml.
 
-        else:
-            pdbs = entry.xpath(
+    Parameters
+    ----------
+    entry: lxml.etree.Element
+        UniProt <entry> element
+
+    Returns
+    -------
+    selected_pdbchains: list of dict
+    """
+    selected_pdbchains = []
+    entry_name = entry.find('name').text
+    if uniprot_domain_regex:
+        selected_domains = entry.xpath(
+            'feature[@type="domain"][match_regex(@description, "%s")]' % uniprot_domain_regex,
+            extensions={(None, 'match_regex'): ensembler.core.xpath_match_regex_case_sensitive}
+        )
+
+        domain_iter = 0
+        for domain in selected_domains:
+            domain_id = '%s_D%d' % (entry_name, domain_iter)
+            domain_span = [int(domain.find('location/begin').get('position')), int(domain.find('location/end').get('position'))]
+            if manual_overrides and domain_id in manual_overrides.template.domain_spans:
+                domain_span = [int(x) for x in manual_overrides.template.domain_spans[domain_id].split('-')]
+            domain_len = domain_span[1] - domain_span[0] + 1
+            if manual_overrides and manual_overrides.template.min_domain_len is not None and domain_len < manual_overrides.template.min_domain_len:
+                continue
+            if manual_overrides and manual_overrides.template.max_domain_len is not None and domain_len > manual_overrides.template.max_domain_len:
+                continue
+
+            domain_iter += 1
+            pdbs = domain.getparent().xpath(
                 'dbReference[@type="PDB"]/property[@type="method"][@value="X-ray" or @value="NMR"]/..'
             )
 
@@ -741,16 +1123,45 @@ def extract_template_pdbchains_from_uniprot_xml(uniprotxml, uniprot_domain_regex
                         if specified_chainids and len(specified_chainids[pdbid]) > 0 and chainid not in specified_chainids[pdbid]:
                             continue
                         span = chain_spans[chainid]
-                        templateid = '%s_%s_%s' % (entry_name, pdbid, chainid)
-                        data = {
-                            'templateid': templateid,
-                            'pdbid': pdbid,
-                            'chainid': chainid,
-                            'residue_span': span
-                        }
-                        selected_pdbchains.append(data)
+                        if (span[0] < domain_span[0] + 30) & (span[1] > domain_span[1] - 30):
+                            templateid = '%s_%s_%s' % (domain_id, pdbid, chainid)
+                            data = {
+                                'templateid': templateid,
+                                'pdbid': pdbid,
+                                'chainid': chainid,
+                                'residue_span': domain_span
+                            }
+                            selected_pdbchains.append(data)
 
-    logger.info('%d PDB chains selected.' % len(selected_pdbchains))
+    else:
+        pdbs = entry.xpath(
+            'dbReference[@type="PDB"]/property[@type="method"][@value="X-ray" or @value="NMR"]/..'
+        )
+
+        for pdb in pdbs:
+            pdbid = pdb.get('id')
+            if manual_overrides and pdbid in manual_overrides.template.skip_pdbs:
+                continue
+            if specified_pdbids and pdbid not in specified_pdbids:
+                continue
+            pdb_chain_span_nodes = pdb.findall('property[@type="chains"]')
+
+            for pdb_chain_span_node in pdb_chain_span_nodes:
+                chain_span_string = pdb_chain_span_node.get('value')
+                chain_spans = ensembler.uniprot.parse_uniprot_pdbref_chains(chain_span_string)
+
+                for chainid in chain_spans.keys():
+                    if specified_chainids and len(specified_chainids[pdbid]) > 0 and chainid not in specified_chainids[pdbid]:
+                        continue
+                    span = chain_spans[chainid]
+                    templateid = '%s_%s_%s' % (entry_name, pdbid, chainid)
+                    data = {
+                        'templateid': templateid,
+                        'pdbid': pdbid,
+                        'chainid': chainid,
+                        'residue_span': span
+                    }
+                    selected_pdbchains.append(data)
     return selected_pdbchains
 
 
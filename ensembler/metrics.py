@@ -0,0 +1,175 @@
+"""
+Per-rank counters and gauges for monitoring long-running pipeline stages.
+
+Metrics are written periodically (at most once every write_interval seconds) to a file for each
+MPI rank, in a node-local directory, e.g. /tmp/ensembler-metrics/ensembler-metrics-rank0.prom.
+A local exporter (e.g. the Prometheus node_exporter textfile collector) or dashboard can then read
+them without touching the models directory.
+
+Formats:
+  - "prometheus": Prometheus text exposition format. Each write replaces the file atomically.
+  - "jsonl": JSON lines. Each write appends a snapshot of all metrics.
+"""
+import os
+import json
+import time
+import socket
+import ensembler.utils
+from ensembler.core import mpistate
+
+metrics_formats = {
+    'prometheus': 'prom',
+    'jsonl': 'jsonl',
+}
+
+metric_descriptions = {
+    'ensembler_models_completed_total': ('counter', 'Number of models successfully processed.'),
+    'ensembler_models_failed_total': ('counter', 'Number of models which failed.'),
+    'ensembler_ns_per_day': ('gauge', 'Simulation throughput of the current model (ns/day).'),
+    'ensembler_queue_depth': ('gauge', 'Number of models remaining to be processed by this rank for the current target.'),
+    'ensembler_last_update_timestamp_seconds': ('gauge', 'Unix time at which these metrics were written.'),
+}
+
+
+def gen_metrics_filepath(metrics_dir, metrics_format='prometheus', rank=None):
+    if rank is None:
+        rank = mpistate.rank
+    return os.path.join(metrics_dir, 'ensembler-metrics-rank%d.%s' % (rank, metrics_formats[metrics_format]))
+
+
+def escape_prometheus_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus_value(value):
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    elif value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+class MetricsRecorder(object):
+    def __init__(self, filepath=None, metrics_format='prometheus', write_interval=60., rank=None,
+                 clock=time.time):
+        """
+        Parameters
+        ----------
+        filepath : str
+            File to which metrics are written. If None, metrics are recorded but never written.
+        metrics_format : str
+            'prometheus' or 'jsonl'
+        write_interval : float
+            Minimum time between writes by maybe_write (seconds).
+        rank : int
+            default: the MPI rank
+        clock : callable
+            Returns the current time in seconds.
+        """
+        if metrics_format not in metrics_formats:
+            raise Exception('Unrecognized metrics format %s. Options: %s' % (metrics_format, ', '.join(sorted(metrics_formats))))
+        self.filepath = filepath
+        self.metrics_format = metrics_format
+        self.write_interval = write_interval
+        if rank is None:
+            rank = mpistate.rank
+        self.rank = rank
+        self.hostname = socket.gethostname()
+        self.clock = clock
+        self.values = {}
+        self.last_write_time = None
+
+    def _key(self, name, labels):
+        labels = dict(labels)
+        labels['rank'] = self.rank
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Increments a counter."""
+        key = self._key(name, labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Sets a gauge."""
+        self.values[self._key(name, labels)] = value
+
+    def get(self, name, **labels):
+        return self.values.get(self._key(name, labels))
+
+    def maybe_write(self):
+        """
+        Writes the metrics if at least write_interval seconds have passed since the last write.
+        This is cheap enough to call from within simulation loops.
+        """
+        if self.filepath is None:
+            return
+        if self.last_write_time is not None and self.clock() - self.last_write_time < self.write_interval:
+            return
+        self.write()
+
+    def write(self):
+        if self.filepath is None:
+            return
+        now = self.clock()
+        self.set('ensembler_last_update_timestamp_seconds', now)
+        if self.metrics_format == 'prometheus':
+            # Written to a temporary file and renamed, so that readers never see a partial file
+            temp_filepath = '%s.%s.tmp' % (self.filepath, os.getpid())
+            with open(temp_filepath, 'w') as metrics_file:
+                metrics_file.write(self.gen_prometheus_text())
+            os.rename(temp_filepath, self.filepath)
+        else:
+            with open(self.filepath, 'a') as metrics_file:
+                metrics_file.write(json.dumps(self.gen_json_snapshot(now)) + '\n')
+        self.last_write_time = now
+
+    def gen_prometheus_text(self):
+        lines = []
+        for name in sorted(set([key[0] for key in self.values])):
+            metric_type, description = metric_descriptions.get(name, ('untyped', None))
+            if description is not None:
+                lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for (key_name, labels), value in sorted(self.values.items(), key=lambda x: x[0]):
+                if key_name != name:
+                    continue
+                labels_text = ','.join(['%s="%s"' % (label, escape_prometheus_label_value(label_value)) for label, label_value in labels])
+                lines.append('%s{%s} %s' % (name, labels_text, format_prometheus_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def gen_json_snapshot(self, timestamp=None):
+        if timestamp is None:
+            timestamp = self.clock()
+        return {
+            'timestamp': timestamp,
+            'hostname': self.hostname,
+            'rank': self.rank,
+            'metrics': [
+                {
+                    'name': name,
+                    'type': metric_descriptions.get(name, ('untyped', None))[0],
+                    'labels': dict(labels),
+                    'value': value,
+                } for (name, labels), value in sorted(self.values.items(), key=lambda x: x[0])
+            ],
+        }
+
+
+metrics = MetricsRecorder()
+
+
+def enable_metrics(metrics_dir, metrics_format='prometheus', write_interval=60.):
+    """
+    Configures the module-level MetricsRecorder to write to a file for this MPI rank within
+    metrics_dir (which should be on a node-local filesystem), discarding any previously recorded
+    values.
+    """
+    if metrics_format not in metrics_formats:
+        raise Exception('Unrecognized metrics format %s. Options: %s' % (metrics_format, ', '.join(sorted(metrics_formats))))
+    ensembler.utils.create_dir(metrics_dir)
+    metrics.filepath = gen_metrics_filepath(metrics_dir, metrics_format=metrics_format, rank=metrics.rank)
+    metrics.metrics_format = metrics_format
+    metrics.write_interval = write_interval
+    metrics.values = {}
+    metrics.last_write_time = None
@@ -754,6 +754,7 @@ def write_build_models_metadata(target, target_setup_data, process_only_these_ta
 
 @ensembler.utils.mpirank0only_and_end_with_barrier
 @ensembler.utils.notify_when_done
+@ensembler.core.batch_metadata_writes
 def cluster_models(process_only_these_targets=None, cutoff=0.06, loglevel=None):
     """Cluster models based on RMSD, and filter out non-unique models as
     determined by a given cutoff.
@@ -1,30 +1,57 @@
 import os
-import subprocess
+import re
+import gzip
+import shutil
+import tarfile
+import traceback
+import multiprocessing
+import yaml
 import numpy as np
 import ensembler
+import ensembler.utils
 from ensembler.core import mpistate, logger
 import simtk.unit as unit
 import simtk.openmm as openmm
 
 
+fah_run_source_filenames = [
+    'explicit-system.xml',
+    'explicit-state.xml',
+    'implicit-refined.pdb.gz',
+    'explicit-refined.pdb.gz',
+    'sequence-identity.txt',
+]
+
+# Written to each model directory, so that unchanged source files are not rehashed
+fah_run_source_sha1s_cache_filename = 'fah-source-sha1s-cache.yaml'
+
+# Written to each RUN directory, recording the source files from which it was built
+fah_run_source_sha1s_filename = 'source-sha1s.yaml'
+
+
 def package_for_fah(process_only_these_targets=None,
                     process_only_these_templates=None, template_seqid_cutoff=None,
-                    verbose=False, nclones=1, archive=False):
+                    verbose=False, nclones=1, archive=False, nprocesses=1):
     '''Create the input files and directory structure necessary to start a Folding@Home project.
 
-    MPI-enabled.
+    MPI-enabled. The RUNs assigned to each MPI rank can additionally be built by a pool of
+    nprocesses worker processes.
 
     Parameters
     ----------
     archive : Bool
         A .tgz compressed archive will be created for each individual RUN directory.
+    nprocesses : int
+        Number of worker processes per MPI rank.
     '''
     models_dir = ensembler.core.default_project_dirnames.models
     packaged_models_dir = ensembler.core.default_project_dirnames.packaged_models
     projects_dir = os.path.join(packaged_models_dir, 'fah-projects')
+    xml_store_dir = os.path.join(projects_dir, ensembler.core.xml_store_dirname)
     if mpistate.rank == 0:
         if not os.path.exists(projects_dir):
             os.mkdir(projects_dir)
+        ensembler.utils.create_dir(xml_store_dir)
     mpistate.comm.Barrier()
 
     targets, templates_resolved_seq = ensembler.core.get_targets_and_templates()
@@ -34,144 +61,6 @@ def package_for_fah(process_only_these_targets=None,
     else:
         selected_template_indices = range(len(templates_resolved_seq))
 
-    def generateRun(run):
-        """
-        Build Folding@Home RUN and CLONE subdirectories from (possibly compressed) OpenMM serialized XML files.
-
-        ARGUMENTS
-
-        run (int) - run index
-        """
-
-        if verbose: print("Building RUN %d" % run)
-     
-        try:
-            import os, shutil
-            import gzip
-            
-            # Determine directory and pathnames.
-            rundir = os.path.join(project_dir, 'RUN%d' % run)
-            template_filename = os.path.join(rundir, 'template.txt')
-            seqid_filename = os.path.join(rundir, 'sequence-identity.txt')
-            system_filename = os.path.join(rundir, 'system.xml')
-            integrator_filename = os.path.join(rundir, 'integrator.xml')
-            protein_structure_filename = os.path.join(rundir, 'protein.pdb')
-            system_structure_filename = os.path.join(rundir, 'system.pdb')
-            final_state_filename = os.path.join(rundir, 'state%d.xml' % (nclones - 1))
-            protein_structure_gz_filename_source = os.path.join(source_dir, 'implicit-refined.pdb.gz')
-            system_structure_gz_filename_source = os.path.join(source_dir, 'explicit-refined.pdb.gz')
-
-            # Return if this directory has already been set up.
-            if os.path.exists(rundir): 
-                if os.path.exists(template_filename)\
-                        and os.path.exists(seqid_filename)\
-                        and os.path.exists(system_filename)\
-                        and os.path.exists(integrator_filename)\
-                        and os.path.exists(protein_structure_filename)\
-                        and os.path.exists(system_structure_filename)\
-                        and os.path.exists(final_state_filename):
-                    return
-            else:
-                # Construct run directory if it does not exist.
-                if not os.path.exists(rundir):
-                    os.makedirs(rundir)
-
-            # Write template information.
-            [filepath, template_name] = os.path.split(source_dir)
-            with open(template_filename, 'w') as outfile:
-                outfile.write(template_name + '\n')
-
-            # Write the protein and system structure pdbs
-            with gzip.open(protein_structure_gz_filename_source) as protein_structure_file_source:
-                with open(protein_structure_filename, 'w') as protein_structure_file:
-                    protein_structure_file.write(protein_structure_file_source.read())
-
-            with gzip.open(system_structure_gz_filename_source) as system_structure_file_source:
-                with open(system_structure_filename, 'w') as system_structure_file:
-                    system_structure_file.write(system_structure_file_source.read())
-
-            # Read system, integrator, and state.
-            def readFileContents(filename):
-                fullpath = os.path.join(source_dir, filename)
-
-                if os.path.exists(fullpath):
-                    infile = open(fullpath, 'r')
-                elif os.path.exists(fullpath+'.gz'):
-                    infile = gzip.open(fullpath+'.gz', 'r')
-                else:
-                    import ipdb; ipdb.set_trace()
-                    raise IOError('File %s not found' % filename)
-
-                contents = infile.read()
-                infile.close()
-                return contents
-
-            def writeFileContents(filepath, contents):
-                with open(filepath, 'w') as outfile:
-                    outfile.write(contents)
-
-            system = openmm.XmlSerializer.deserialize(readFileContents('explicit-system.xml'))
-            state = openmm.XmlSerializer.deserialize(readFileContents('explicit-state.xml'))
-
-            # Substitute default box vectors.
-            box_vectors = state.getPeriodicBoxVectors()
-            system.setDefaultPeriodicBoxVectors(*box_vectors)
-
-            # Write sequence identity.
-            contents = readFileContents('sequence-identity.txt')
-            writeFileContents(seqid_filename, contents)
-
-            # Integrator settings.
-            constraint_tolerance = 1.0e-5 
-            timestep = 2.0 * unit.femtoseconds
-            collision_rate = 1.0 / unit.picosecond
-            temperature = 300.0 * unit.kelvin
-
-            # Create new integrator to use.
-            integrator = openmm.LangevinIntegrator(temperature, collision_rate, timestep)
-            
-            # TODO: Make sure MonteCarloBarostat temperature matches set temperature.
-
-            # Serialize System.
-            writeFileContents(system_filename, openmm.XmlSerializer.serialize(system))
-
-            # Serialize Integrator
-            writeFileContents(integrator_filename, openmm.XmlSerializer.serialize(integrator))
-
-            # Create Context so we can randomize velocities.
-            platform = openmm.Platform.getPlatformByName('Reference')
-            context = openmm.Context(system, integrator, platform)
-            context.setPositions(state.getPositions())
-            context.setVelocities(state.getVelocities())
-            box_vectors = state.getPeriodicBoxVectors()
-            context.setPeriodicBoxVectors(*box_vectors)
-
-            # Create clones with different random initial velocities.
-            for clone_index in range(nclones):
-                state_filename = os.path.join(rundir, 'state%d.xml' % clone_index)
-                if os.path.exists(state_filename):
-                    continue
-                context.setVelocitiesToTemperature(temperature)
-                state = context.getState(getPositions=True, getVelocities=True, getForces=True, getEnergy=True, getParameters=True, enforcePeriodicBox=True)
-                writeFileContents(state_filename, openmm.XmlSerializer.serialize(state))
-
-            # Clean up.
-            del context, integrator, state, system
-
-        except Exception as e:
-            import traceback
-            print(traceback.format_exc())
-            print(str(e))
-
-        return
-
-
-    def archiveRun():
-        archive_filename = os.path.join(project_dir, 'RUN%d.tgz' % run_index)
-        run_dir = os.path.join(project_dir, 'RUN%d' % run_index)
-        subprocess.call(['tar', 'zcf', archive_filename, run_dir])
-
-
     for target in targets:
 
         # Process only specified targets if directed.
@@ -216,56 +105,105 @@ def package_for_fah(process_only_these_targets=None,
             if not unique_by_clustering:
                 is_valid = False
 
-            # Append if valid.
+            # Append if valid, together with hashes of the source files.
             if is_valid:
-                valid_templates.append(template)
+                source_sha1s = gen_fah_run_source_sha1s(os.path.join(models_target_dir, template.id))
+                valid_templates.append((template.id, source_sha1s))
 
-        nvalid = len(valid_templates)
-        if verbose: print("%d valid unique initial starting conditions found" % nvalid)
+        # Gather on rank 0, which assigns RUN indices.
+        valid_templates_gathered = mpistate.comm.gather(valid_templates, root=0)
 
         # ========
-        # Sort by sequence identity
-        # ========
-
-        if verbose: print("Sorting templates in order of decreasing sequence identity...")
-        sequence_identities = np.zeros([nvalid], np.float32)
-        for (template_index, template) in enumerate(valid_templates):
-            filename = os.path.join(models_target_dir, template.id, 'sequence-identity.txt')
-            with open(filename, 'r') as infile:
-                contents = infile.readline().strip()
-            sequence_identity = float(contents)
-            sequence_identities[template_index] = sequence_identity
-        sorted_indices = np.argsort(-sequence_identities)
-        valid_templates = [ valid_templates[index] for index in sorted_indices ]
-        if verbose: 
-            print("Sorted")
-            print(sequence_identities[sorted_indices])
-
-        # ========
-        # Create project directory
+        # Create project directory and assign RUNs
         # ========
 
         project_dir = os.path.join(projects_dir, target.id)
+        manifest_filepath = os.path.join(project_dir, 'manifest.yaml')
+
         if mpistate.rank == 0:
             if not os.path.exists(project_dir):
                 os.makedirs(project_dir)
 
-        mpistate.comm.Barrier()
+            source_sha1s_by_templateid = dict([
+                valid_template for valid_templates in valid_templates_gathered for valid_template in valid_templates
+            ])
+            if verbose: print("%d valid unique initial starting conditions found" % len(source_sha1s_by_templateid))
+
+            manifest = read_fah_manifest(manifest_filepath)
+            runs_to_build = assign_fah_runs(manifest, source_sha1s_by_templateid, nclones, models_target_dir)
+            if verbose: print("%d RUNs to build or update" % len(runs_to_build))
+        else:
+            runs_to_build = None
+
+        runs_to_build = mpistate.comm.bcast(runs_to_build, root=0)
 
         # ========
         # Build runs in parallel
         # ========
 
         if verbose: print("Building RUNs in parallel...")
-        for run_index in range(mpistate.rank, len(valid_templates), mpistate.size):
-            print("-------------------------------------------------------------------------")
-            print("Building RUN for template %s" % valid_templates[run_index].id)
-            print("-------------------------------------------------------------------------")
+        run_kwargs_list = []
+        for run_list_index in range(mpistate.rank, len(runs_to_build), mpistate.size):
+            run = runs_to_build[run_list_index]
+            run_kwargs_list.append({
+                'run_index': run['run'],
+                'source_dir': os.path.join(models_target_dir, run['template_id']),
+                'project_dir': project_dir,
+                'xml_store_dir': xml_store_dir,
+                'nclones': nclones,
+                'archive': archive,
+                'cpu_platform_threads': 1 if nprocesses > 1 else None,
+                'overwrite': run['changed'],
+                'source_sha1s': run['source_sha1s'],
+                'verbose': verbose,
+            })
+
+        if nprocesses > 1:
+            pool = multiprocessing.Pool(processes=nprocesses)
+            try:
+                async_results = [pool.apply_async(generate_fah_run, kwds=run_kwargs) for run_kwargs in run_kwargs_list]
+                run_successes = [async_result.get() for async_result in async_results]
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            run_successes = [generate_fah_run(**run_kwargs) for run_kwargs in run_kwargs_list]
+
+        successful_run_indices = [
+            run_kwargs['run_index'] for run_kwargs, success in zip(run_kwargs_list, run_successes) if success
+        ]
+        successful_run_indices_gathered = mpistate.comm.gather(successful_run_indices, root=0)
+
+        # ========
+        # Update manifest
+        # ========
 
-            source_dir = os.path.join(models_target_dir, valid_templates[run_index].id)
-            generateRun(run_index)
-            if archive:
-                archiveRun()
+        if mpistate.rank == 0:
+            successful_run_indices = set([
+                run_index for run_indices in successful_run_indices_gathered for run_index in run_indices
+            ])
+            manifest_runs = dict([(manifest_run['run'], manifest_run) for manifest_run in manifest['runs']])
+            for run in runs_to_build:
+                manifest_run = {
+                    'run': run['run'],
+                    'template_id': run['template_id'],
+                    'sequence_identity': run['sequence_identity'],
+                }
+                if run['run'] in successful_run_indices:
+                    manifest_run['source_sha1s'] = source_sha1s_by_templateid[run['template_id']]
+                    manifest_run['nclones'] = nclones if run['changed'] else max(nclones, run['nclones'])
+                elif run['changed'] or run['run'] not in manifest_runs:
+                    # Recorded without source hashes, so that the RUN keeps its index and is
+                    # rebuilt next time.
+                    manifest_run['source_sha1s'] = None
+                    manifest_run['nclones'] = 0
+                else:
+                    continue
+                manifest_runs[run['run']] = manifest_run
+            manifest['runs'] = [manifest_runs[run_index] for run_index in sorted(manifest_runs)]
+            write_fah_manifest(manifest_filepath, manifest)
+
+        mpistate.comm.Barrier()
 
         # TODO - get this working
 
@@ -306,5 +244,408 @@ def package_for_fah(process_only_these_targets=None,
         print('Done.')
 
 
+def generate_fah_run(run_index, source_dir, project_dir, xml_store_dir, nclones=1, archive=False,
+                     cpu_platform_threads=None, overwrite=False, source_sha1s=None, verbose=False):
+    """
+    Build a Folding@Home RUN directory, containing CLONE states, from (possibly compressed) OpenMM
+    serialized XML files.
+
+    Defined at module level so that it can be run by a multiprocessing pool.
+
+    Parameters
+    ----------
+    run_index : int
+    source_dir : str
+        model directory
+    project_dir : str
+    xml_store_dir : str
+        content-addressed store for packaged System and Integrator files
+    nclones : int
+    archive : bool
+        Create a .tgz archive of the RUN directory.
+    cpu_platform_threads : int or None
+        Number of threads used by the OpenMM CPU platform when generating clones
+        (None: OpenMM default).
+    overwrite : bool
+        Delete any existing RUN directory first (e.g. if the source model has changed).
+    source_sha1s : dict
+        Hashes of the source files (see gen_fah_run_source_sha1s). An existing RUN directory is
+        only reused if it was built from the same template and source files (see
+        check_fah_run_source); otherwise it is rebuilt.
+    verbose : bool
+
+    Returns
+    -------
+    success : bool
+    """
+    if verbose:
+        print("-------------------------------------------------------------------------")
+        print("Building RUN %d for template %s" % (run_index, os.path.basename(source_dir)))
+        print("-------------------------------------------------------------------------")
+
+    try:
+        # Determine directory and pathnames.
+        rundir = os.path.join(project_dir, 'RUN%d' % run_index)
+        template_filename = os.path.join(rundir, 'template.txt')
+        seqid_filename = os.path.join(rundir, 'sequence-identity.txt')
+        system_filename = os.path.join(rundir, 'system.xml')
+        integrator_filename = os.path.join(rundir, 'integrator.xml')
+        protein_structure_filename = os.path.join(rundir, 'protein.pdb')
+        system_structure_filename = os.path.join(rundir, 'system.pdb')
+        final_state_filename = os.path.join(rundir, 'state%d.xml' % (nclones - 1))
+        protein_structure_gz_filename_source = os.path.join(source_dir, 'implicit-refined.pdb.gz')
+        system_structure_gz_filename_source = os.path.join(source_dir, 'explicit-refined.pdb.gz')
+
+        [filepath, template_name] = os.path.split(source_dir)
+
+        if os.path.exists(rundir) and not overwrite and not check_fah_run_source(rundir, template_name, source_sha1s):
+            # e.g. a project packaged without a manifest, in which RUN indices may have been
+            # assigned to different templates
+            logger.info('RUN %d was not built from the current source files for template %s; rebuilding' % (run_index, template_name))
+            overwrite = True
+
+        if overwrite and os.path.exists(rundir):
+            shutil.rmtree(rundir)
+
+        # Return if this directory has already been set up.
+        if os.path.exists(rundir):
+            if os.path.exists(template_filename)\
+                    and os.path.exists(seqid_filename)\
+                    and os.path.exists(system_filename)\
+                    and os.path.exists(integrator_filename)\
+                    and os.path.exists(protein_structure_filename)\
+                    and os.path.exists(system_structure_filename)\
+                    and os.path.exists(final_state_filename):
+                return True
+        else:
+            # Construct run directory if it does not exist.
+            if not os.path.exists(rundir):
+                os.makedirs(rundir)
+
+        # Write template information.
+        with open(template_filename, 'w') as outfile:
+            outfile.write(template_name + '\n')
+
+        # Write the protein and system structure pdbs
+        copy_gzipped_file(protein_structure_gz_filename_source, protein_structure_filename)
+        copy_gzipped_file(system_structure_gz_filename_source, system_structure_filename)
+
+        # Write sequence identity.
+        shutil.copyfile(os.path.join(source_dir, 'sequence-identity.txt'), seqid_filename)
+
+        system_contents = read_serialized_xml(os.path.join(source_dir, 'explicit-system.xml'))
+        state_contents = read_serialized_xml(os.path.join(source_dir, 'explicit-state.xml'))
+        system = None
+        state = None
+
+        # The packaged System differs from the source System only in its default box vectors,
+        # which are taken from the source State. Since the box of each model differs, packaged
+        # Systems are in practice unique to each model, but if one has already been generated
+        # from identical inputs (e.g. when a RUN is rebuilt), it is linked rather than being
+        # deserialized and reserialized.
+        packaged_system_sha1 = ensembler.utils.sha1_hexdigest(
+            ensembler.utils.sha1_hexdigest(system_contents) + extract_periodic_box_vectors_xml(state_contents)
+        )
+        packaged_system_filepath = ensembler.utils.gen_content_addressed_filepath(xml_store_dir, packaged_system_sha1, compress=False)
+        if not os.path.exists(packaged_system_filepath):
+            system = openmm.XmlSerializer.deserialize(system_contents)
+            state = openmm.XmlSerializer.deserialize(state_contents)
+
+            # Substitute default box vectors.
+            box_vectors = state.getPeriodicBoxVectors()
+            system.setDefaultPeriodicBoxVectors(*box_vectors)
+
+            packaged_system_filepath = ensembler.utils.write_content_addressed_file(
+                xml_store_dir, openmm.XmlSerializer.serialize(system), compress=False, sha1=packaged_system_sha1
+            )
+
+        # Integrator settings.
+        timestep = 2.0 * unit.femtoseconds
+        collision_rate = 1.0 / unit.picosecond
+        temperature = 300.0 * unit.kelvin
+
+        # Create new integrator to use.
+        integrator = openmm.LangevinIntegrator(temperature, collision_rate, timestep)
+
+        # TODO: Make sure MonteCarloBarostat temperature matches set temperature.
+
+        # Link System and Integrator from the content-addressed store.
+        ensembler.utils.link_file(packaged_system_filepath, system_filename)
+        integrator_filepath = ensembler.utils.write_content_addressed_file(
+            xml_store_dir, openmm.XmlSerializer.serialize(integrator), compress=False
+        )
+        ensembler.utils.link_file(integrator_filepath, integrator_filename)
+
+        clone_indices = [
+            clone_index for clone_index in range(nclones)
+            if not os.path.exists(os.path.join(rundir, 'state%d.xml' % clone_index))
+        ]
+
+        if len(clone_indices) > 0:
+            if system is None:
+                with open(packaged_system_filepath, 'r') as packaged_system_file:
+                    system = openmm.XmlSerializer.deserialize(packaged_system_file.read())
+                state = openmm.XmlSerializer.deserialize(state_contents)
+
+            # Create Context so we can randomize velocities.
+            context = create_clone_context(system, integrator, cpu_platform_threads=cpu_platform_threads)
+            context.setPositions(state.getPositions())
+            context.setVelocities(state.getVelocities())
+            box_vectors = state.getPeriodicBoxVectors()
+            context.setPeriodicBoxVectors(*box_vectors)
+
+            # Create clones with different random initial velocities.
+            for clone_index in clone_indices:
+                state_filename = os.path.join(rundir, 'state%d.xml' % clone_index)
+                context.setVelocitiesToTemperature(temperature)
+                clone_state = context.getState(getPositions=True, getVelocities=True, getForces=True, getEnergy=True, getParameters=True, enforcePeriodicBox=True)
+                with open(state_filename, 'w') as state_file:
+                    state_file.write(openmm.XmlSerializer.serialize(clone_state))
+
+            # Clean up.
+            del context, clone_state
+
+        del integrator, state, system
+
+        if source_sha1s is not None:
+            with open(os.path.join(rundir, fah_run_source_sha1s_filename), 'w') as source_sha1s_file:
+                yaml.dump(source_sha1s, source_sha1s_file, Dumper=ensembler.core.YamlDumper, default_flow_style=False)
+
+        if archive:
+            archive_fah_run(project_dir, run_index)
+
+    except Exception as e:
+        print(traceback.format_exc())
+        print(str(e))
+        return False
+
+    return True
+
+
+def gen_fah_run_source_sha1s(source_dir):
+    """
+    Hashes of the model files from which a FAH RUN is built, used to detect changed models.
+
+    The hashes are cached in the model directory, keyed by file size and mtime, so that only
+    changed files are rehashed.
+
+    Returns
+    -------
+    source_sha1s : dict
+        {filename: sha1}
+    """
+    cache_filepath = os.path.join(source_dir, fah_run_source_sha1s_cache_filename)
+    cache = {}
+    if os.path.exists(cache_filepath):
+        try:
+            with open(cache_filepath) as cache_file:
+                cache = yaml.load(cache_file, Loader=ensembler.core.YamlLoader) or {}
+        except yaml.YAMLError:
+            cache = {}
+
+    source_sha1s = {}
+    updated_cache = {}
+    for filename in fah_run_source_filenames:
+        filepath = os.path.join(source_dir, filename)
+        if not os.path.exists(filepath) and os.path.exists(filepath + '.gz'):
+            filepath += '.gz'
+        stat = os.stat(filepath)
+        cache_entry = cache.get(filename)
+        if cache_entry is not None and cache_entry.get('path') == os.path.basename(filepath)\
+                and cache_entry.get('size') == stat.st_size and cache_entry.get('mtime') == stat.st_mtime:
+            sha1 = cache_entry['sha1']
+        else:
+            sha1 = ensembler.utils.sha1_of_file(filepath)
+        source_sha1s[filename] = sha1
+        updated_cache[filename] = {'path': os.path.basename(filepath), 'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1}
+
+    if updated_cache != cache:
+        try:
+            temp_filepath = '%s.%d.tmp' % (cache_filepath, os.getpid())
+            with open(temp_filepath, 'w') as cache_file:
+                yaml.dump(updated_cache, cache_file, Dumper=ensembler.core.YamlDumper, default_flow_style=False)
+            os.rename(temp_filepath, cache_filepath)
+        except (IOError, OSError) as e:
+            logger.debug('Could not write source hash cache %s: %s' % (cache_filepath, e))
+    return source_sha1s
+
+
+def check_fah_run_source(rundir, template_id, source_sha1s=None):
+    """
+    Check whether an existing RUN directory was built from the given template and, if
+    source_sha1s is given, from source files with those hashes. RUN directories built without a
+    record of their source hashes fail the latter check.
+
+    Returns
+    -------
+    matches : bool
+    """
+    template_filename = os.path.join(rundir, 'template.txt')
+    if not os.path.exists(template_filename):
+        return False
+    with open(template_filename) as template_file:
+        if template_file.read().strip() != template_id:
+            return False
+    if source_sha1s is not None:
+        source_sha1s_filepath = os.path.join(rundir, fah_run_source_sha1s_filename)
+        if not os.path.exists(source_sha1s_filepath):
+            return False
+        with open(source_sha1s_filepath) as source_sha1s_file:
+            if yaml.load(source_sha1s_file, Loader=ensembler.core.YamlLoader) != source_sha1s:
+                return False
+    return True
+
+
+def read_fah_manifest(manifest_filepath):
+    """
+    The packaging manifest for a FAH project records, for each RUN, the template it was built from,
+    the hashes of the source model files, and the number of clones generated.
+
+    Returns
+    -------
+    manifest : dict
+        {'runs': [{'run': int, 'template_id': str, 'sequence_identity': float,
+                   'source_sha1s': dict, 'nclones': int}, ...]}
+    """
+    if not os.path.exists(manifest_filepath):
+        return {'runs': []}
+    with open(manifest_filepath) as manifest_file:
+        manifest = yaml.load(manifest_file, Loader=ensembler.core.YamlLoader)
+    if not manifest or not manifest.get('runs'):
+        return {'runs': []}
+    return manifest
+
+
+def write_fah_manifest(manifest_filepath, manifest):
+    temp_filepath = manifest_filepath + '.tmp'
+    with open(temp_filepath, 'w') as manifest_file:
+        yaml.dump(manifest, manifest_file, Dumper=ensembler.core.YamlDumper, default_flow_style=False)
+    os.rename(temp_filepath, manifest_filepath)
+
+
+def assign_fah_runs(manifest, source_sha1s_by_templateid, nclones, models_target_dir=None):
+    """
+    Determine which RUNs need to be built or updated, given the existing packaging manifest.
+
+    RUNs already in the manifest keep their indices. New templates are appended, in order of
+    decreasing sequence identity (read from models_target_dir). RUNs whose source files have
+    changed are rebuilt, and RUNs with fewer than nclones clones are extended. Templates which are
+    no longer valid keep their RUN entries, so that RUN indices are never reassigned.
+
+    Parameters
+    ----------
+    manifest : dict
+    source_sha1s_by_templateid : dict
+        {templateid: source_sha1s} for valid templates
+    nclones : int
+    models_target_dir : str
+
+    Returns
+    -------
+    runs_to_build : list of dict
+        [{'run': int, 'template_id': str, 'sequence_identity': float, 'nclones': int,
+          'changed': bool, 'source_sha1s': dict}, ...]
+    """
+    runs_to_build = []
+    manifest_templateids = set()
+    for manifest_run in manifest['runs']:
+        templateid = manifest_run['template_id']
+        manifest_templateids.add(templateid)
+        if templateid not in source_sha1s_by_templateid:
+            continue
+        changed = manifest_run.get('source_sha1s') != source_sha1s_by_templateid[templateid]
+        if changed or manifest_run.get('nclones', 0) < nclones:
+            runs_to_build.append({
+                'run': manifest_run['run'],
+                'template_id': templateid,
+                'sequence_identity': manifest_run.get('sequence_identity'),
+                'nclones': manifest_run.get('nclones', 0),
+                'changed': changed,
+                'source_sha1s': source_sha1s_by_templateid[templateid],
+            })
+
+    new_templateids = [templateid for templateid in source_sha1s_by_templateid if templateid not in manifest_templateids]
+    sequence_identities = []
+    for templateid in new_templateids:
+        filename = os.path.join(models_target_dir, templateid, 'sequence-identity.txt')
+        with open(filename, 'r') as infile:
+            sequence_identities.append(float(infile.readline().strip()))
+    sorted_indices = np.argsort(-np.array(sequence_identities, np.float32), kind='mergesort')
+
+    next_run_index = max([manifest_run['run'] for manifest_run in manifest['runs']] + [-1]) + 1
+    for index in sorted_indices:
+        runs_to_build.append({
+            'run': next_run_index,
+            'template_id': new_templateids[index],
+            'sequence_identity': sequence_identities[index],
+            'nclones': 0,
+            'changed': False,
+            'source_sha1s': source_sha1s_by_templateid[new_templateids[index]],
+        })
+        next_run_index += 1
+
+    return runs_to_build
+
+
+def create_clone_context(system, integrator, cpu_platform_threads=None):
+    """
+    Create a Context for generating clone velocities, using the CPU platform if available (which is
+    much faster than the Reference platform for large explicit-solvent systems).
+    """
+    try:
+        platform = openmm.Platform.getPlatformByName('CPU')
+        platform_properties = {}
+        if cpu_platform_threads is not None:
+            platform_properties['CpuThreads'] = str(cpu_platform_threads)
+        return openmm.Context(system, integrator, platform, platform_properties)
+    except Exception:
+        platform = openmm.Platform.getPlatformByName('Reference')
+        return openmm.Context(system, integrator, platform)
+
+
+def archive_fah_run(project_dir, run_index):
+    """
+    Create a .tgz archive of a RUN directory, with the same member paths as `tar zcf` would create
+    if run from the current directory.
+    """
+    archive_filename = os.path.join(project_dir, 'RUN%d.tgz' % run_index)
+    run_dir = os.path.join(project_dir, 'RUN%d' % run_index)
+    with tarfile.open(archive_filename, 'w:gz') as archive_file:
+        archive_file.add(run_dir)
+
+
+def copy_gzipped_file(source_gz_filepath, dest_filepath):
+    """
+    Decompress a gzipped file to dest_filepath, in chunks rather than reading it into memory.
+    """
+    with gzip.open(source_gz_filepath, 'rb') as source_file:
+        with open(dest_filepath, 'wb') as dest_file:
+            shutil.copyfileobj(source_file, dest_file)
+
+
+def read_serialized_xml(filepath):
+    """
+    Read a serialized OpenMM XML file, which may be gzipped ([filepath].gz).
+    """
+    if os.path.exists(filepath):
+        with open(filepath, 'r') as infile:
+            return infile.read()
+    elif os.path.exists(filepath+'.gz'):
+        with gzip.open(filepath+'.gz', 'r') as infile:
+            return infile.read()
+    else:
+        raise IOError('File %s not found' % filepath)
+
+
+def extract_periodic_box_vectors_xml(state_contents):
+    """
+    Extract the PeriodicBoxVectors element from a serialized OpenMM State, without deserializing it.
+    """
+    match = re.search(r'<PeriodicBoxVectors>.*?</PeriodicBoxVectors>', state_contents, re.DOTALL)
+    if match is None:
+        raise Exception('PeriodicBoxVectors not found in serialized State')
+    return match.group(0)
+
+
 def package_for_transfer(process_only_these_targets=None):
     raise Exception('Not implemented yet.')
\ No newline at end of file
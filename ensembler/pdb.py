@@ -2,12 +2,27 @@ import sys
 if sys.version_info > (3, 0):
     from urllib.request import urlopen
     from urllib.error import URLError
-    from io import StringIO
+    from urllib.parse import urlparse, urljoin
+    import http.client as httplib
 else:
     from urllib2 import urlopen, URLError
-    from StringIO import StringIO
+    from urlparse import urlparse, urljoin
+    import httplib
+import os
+import io
 import gzip
+import zlib
+import shutil
 import re
+import time
+import socket
+import threading
+from multiprocessing.pool import ThreadPool
+from ensembler.core import logger
+
+
+pdb_download_base_url = 'http://www.rcsb.org/pdb/files/'
+sifts_download_base_url = 'https://ftp.ebi.ac.uk/pub/databases/msd/sifts/xml/'
 
 
 def extract_residues_by_resnum(output_file, pdb_input_file, template):
@@ -17,43 +32,80 @@ def extract_residues_by_resnum(output_file, pdb_input_file, template):
     output_file: string or gzip.file_like
     pdb_input_file: string or gzip.file_like
     """
-    if type(pdb_input_file) in [str, unicode]:
-        with gzip.open(pdb_input_file, 'r') as pdb_file:
-            pdbtext = pdb_file.readlines()
-    else:
-        pdbtext = pdb_input_file.readlines()
-
-    # list of resnum strings e.g. ['9', '29', '30B'] must be converted as follows to match the PDB format:
-    # ['   9 ', '  29 ', '  30B']
-    desired_resnums = ['%4s ' % r if re.match('[0-9]', r[-1]) else '%5s' % r for r in template.resolved_pdbresnums]
-
-    if type(output_file) in [str, unicode]:
-        ofile = open(output_file, 'w')
-    else:
-        ofile = output_file
+    extract_templates_from_pdb([output_file], pdb_input_file, [template])
+
+
+def gen_pdb_format_resnum(resnum):
+    """
+    Convert a resnum string to the format used in columns 23-27 of PDB ATOM records, e.g.
+    '9' -> '   9 ', '29' -> '  29 ', '30B' -> '  30B'
+    """
+    if re.match('[0-9]', resnum[-1]):
+        return '%4s ' % resnum
+    return '%5s' % resnum
+
+
+def extract_templates_from_pdb(output_files, pdb_input_file, templates):
+    """
+    Extract the resolved residues of one or more templates from a single PDB file, reading the PDB
+    file only once.
+
+    Parameters
+    ----------
+    output_files: list of (string or file_like)
+        One output file for each template.
+    pdb_input_file: string or gzip.file_like
+    templates: list of TemplateData
+        All templates should be derived from the same PDB entry.
+    """
+    # map (chainid, PDB-format resnum) to the indices of the templates which include that residue
+    template_indices_by_residue = {}
+    ndesired_resnums = []
+    for template_index, template in enumerate(templates):
+        desired_resnums = [gen_pdb_format_resnum(r) for r in template.resolved_pdbresnums]
+        ndesired_resnums.append(len(desired_resnums))
+        for resnum in set(desired_resnums):
+            template_indices_by_residue.setdefault((template.chainid, resnum), []).append(template_index)
+
+    ofiles = []
+    resnums_extracted = [set() for template in templates]
     try:
-        resnums_extracted = {}
-        model_index = 0
-        for line in pdbtext:
-            # For PDBs containing multiple MODELs (e.g. NMR structures), extract data only from the first model, ignore others.
-            if line[0:6] == 'MODEL ':
-                model_index += 1
-                if model_index == 2:
-                    break
-            if line[0:6] in ['ATOM  ', 'HETATM']:
-                resnum = line[22:27]
-                chainid = line[21]
-                if chainid == template.chainid:
-                    if resnum in desired_resnums:
-                        ofile.write(line)
-                        resnums_extracted[resnum] = 1
+        for output_file in output_files:
+            if type(output_file) in [str, unicode]:
+                ofiles.append(open(output_file, 'w'))
+            else:
+                ofiles.append(output_file)
+
+        if type(pdb_input_file) in [str, unicode]:
+            pdb_file = gzip.open(pdb_input_file, 'r')
+        else:
+            pdb_file = pdb_input_file
+        try:
+            model_index = 0
+            for line in pdb_file:
+                # For PDBs containing multiple MODELs (e.g. NMR structures), extract data only from the first model, ignore others.
+                if line[0:6] == 'MODEL ':
+                    model_index += 1
+                    if model_index == 2:
+                        break
+                if line[0:6] in ('ATOM  ', 'HETATM'):
+                    residue_key = (line[21], line[22:27])
+                    for template_index in template_indices_by_residue.get(residue_key, ()):
+                        ofiles[template_index].write(line)
+                        resnums_extracted[template_index].add(residue_key[1])
+        finally:
+            if pdb_file is not pdb_input_file:
+                pdb_file.close()
     finally:
-        if type(output_file) in [str, unicode]:
-            ofile.close()
-    if len(resnums_extracted) != len(desired_resnums):
-        raise Exception(
+        for output_file, ofile in zip(output_files, ofiles):
+            if type(output_file) in [str, unicode]:
+                ofile.close()
+
+    for template_index, template in enumerate(templates):
+        if len(resnums_extracted[template_index]) != ndesired_resnums[template_index]:
+            raise Exception(
                 'Number of residues (%d) extracted from PDB (%s) for template (%s) does not match desired number of residues (%d).' % (
-                    len(resnums_extracted), template.pdbid, template.templateid, len(desired_resnums)
+                    len(resnums_extracted[template_index]), template.pdbid, template.templateid, ndesired_resnums[template_index]
                 )
             )
 
@@ -62,8 +114,7 @@ def retrieve_sifts(pdb_id):
     """Retrieves a SIFTS .xml file, given a PDB ID. Works by modifying the PDBe download URL.
     Also removes annoying namespace stuff.
     """
-    sifts_download_base_url='ftp://ftp.ebi.ac.uk/pub/databases/msd/sifts/xml/'
-    url = sifts_download_base_url + pdb_id.lower() + '.xml.gz'
+    url = gen_sifts_url(pdb_id)
     try:
         response = urlopen(url)
     except URLError:
@@ -71,35 +122,88 @@ def retrieve_sifts(pdb_id):
         raise
 
     sifts_page = response.read(100000000) # Max 100MB
-    # Decompress string
-    sifts_page = gzip.GzipFile(fileobj=StringIO(sifts_page)).read()
+    return process_sifts_page(sifts_page)
 
-    # Removing all attribs from the entry tag, and the rdf tag and contents
-    sifts_page_processed = ''
+
+def process_sifts_page(sifts_gz_page):
+    """Decompresses a downloaded SIFTS .xml.gz file, and removes annoying namespace stuff.
+    """
+    processed_file = io.BytesIO()
+    process_sifts_stream(io.BytesIO(sifts_gz_page), processed_file)
+    sifts_page_processed = processed_file.getvalue()
+    if not isinstance(sifts_page_processed, str):
+        sifts_page_processed = sifts_page_processed.decode('utf-8')
+    return sifts_page_processed
+
+
+def gzip_stream_ended(decompressor):
+    """Returns True if a zlib gzip decompressor has reached the end of its stream (in which case
+    the CRC and length in the gzip trailer have been checked).
+    """
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
+    # Python 2 decompressors have no eof attribute. Once the stream has ended, any further input
+    # is not decompressed, but held in unused_data.
+    if decompressor.unused_data:
+        return True
+    try:
+        decompressor.decompress(b'\0')
+    except zlib.error:
+        return False
+    return len(decompressor.unused_data) > 0
+
+
+def iter_gunzipped_lines(gz_file, chunk_size=1024*1024):
+    """Decompresses gzipped data read incrementally from a file-like object (which need not be
+    seekable, e.g. an HTTP response), yielding one line (bytes, without the line ending) at a time.
+    Raises EOFError if the data is truncated.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    remainder = b''
+    while True:
+        chunk = gz_file.read(chunk_size)
+        if not chunk:
+            break
+        data = decompressor.decompress(chunk)
+        # handle concatenated gzip members
+        while decompressor.unused_data:
+            unused_data = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += decompressor.decompress(unused_data)
+        lines = (remainder + data).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line.rstrip(b'\r')
+    if not gzip_stream_ended(decompressor):
+        raise EOFError('Compressed data ended before the end-of-stream marker was reached')
+    remainder += decompressor.flush()
+    if remainder:
+        for line in remainder.split(b'\n'):
+            yield line.rstrip(b'\r')
+
+
+def process_sifts_stream(sifts_gz_file, output_file):
+    """Streaming version of process_sifts_page: reads a gzipped SIFTS file from a file-like object,
+    removes the attributes of the entry tag and the rdf tag and contents, and writes the resulting
+    (uncompressed) XML to output_file, e.g. a gzip.GzipFile. Memory use does not depend on the size
+    of the SIFTS file.
+    """
     skip_rdf_tag_flag = False
-    for line in sifts_page.splitlines():
-        if line[0:6] == '<entry':
-            sifts_page_processed += '<entry>' + '\n'
-        elif line[0:7] == '  <rdf:':
+    for line in iter_gunzipped_lines(sifts_gz_file):
+        if line[0:6] == b'<entry':
+            output_file.write(b'<entry>\n')
+        elif line[0:7] == b'  <rdf:':
             skip_rdf_tag_flag = True
-            pass
-        elif line[0:8] == '  </rdf:':
+        elif line[0:8] == b'  </rdf:':
             skip_rdf_tag_flag = False
-            pass
-        else:
-            if skip_rdf_tag_flag:
-                continue
-            sifts_page_processed += line + '\n'
-    return sifts_page_processed
+        elif not skip_rdf_tag_flag:
+            output_file.write(line + b'\n')
 
 
 def retrieve_pdb(pdb_id,compressed='no'):
     """Retrieves a PDB file, given a PDB ID. Works by modifying the PDB download URL.
     """
-    pdb_download_base_url='http://www.rcsb.org/pdb/files/'
-    url = pdb_download_base_url + pdb_id + '.pdb'
-    if compressed == 'yes':
-        url += '.gz'
+    url = gen_pdb_url(pdb_id, compressed=(compressed == 'yes'))
     response = urlopen(url)
     pdb_file = response.read(10000000) # Max 10MB
     return pdb_file
@@ -108,4 +212,248 @@ def retrieve_pdb(pdb_id,compressed='no'):
 def extract_uniprot_acs_from_sifts_xml(siftsxml):
     uniprot_crossrefs = siftsxml.findall('entity/segment/listResidue/residue/crossRefDb[@dbSource="UniProt"]')
     uniprot_acs = list(set([uniprot_crossref.get('dbAccessionId') for uniprot_crossref in uniprot_crossrefs]))
-    return uniprot_acs
\ No newline at end of file
+    return uniprot_acs
+
+
+def gen_pdb_url(pdb_id, compressed=True, base_url=None):
+    if base_url is None:
+        base_url = pdb_download_base_url
+    url = base_url + pdb_id + '.pdb'
+    if compressed:
+        url += '.gz'
+    return url
+
+
+def gen_sifts_url(pdb_id, base_url=None):
+    if base_url is None:
+        base_url = sifts_download_base_url
+    return base_url + pdb_id.lower() + '.xml.gz'
+
+
+class HTTPFetchError(Exception):
+    def __init__(self, url, status):
+        self.url = url
+        self.status = status
+        super(HTTPFetchError, self).__init__('HTTP status %d for %s' % (status, url))
+
+
+class HTTPFetcher(object):
+    """Downloads URLs concurrently, using a bounded pool of threads.
+
+    Each thread keeps a persistent (keep-alive) connection to each host, which is reused across
+    requests. Failed requests (connection errors, and HTTP 429 and 5xx responses) are retried with
+    exponential backoff. Non-HTTP URLs (e.g. ftp://) are fetched with urlopen, with the same retry
+    behavior.
+
+    Parameters
+    ----------
+    nthreads: int
+    max_retries: int
+    backoff: float
+        Delay (s) before the first retry; doubled for each subsequent retry.
+    timeout: float
+        Socket timeout (s).
+    """
+    retryable_statuses = [429, 500, 502, 503, 504]
+    redirect_statuses = [301, 302, 303, 307, 308]
+    max_redirects = 5
+
+    def __init__(self, nthreads=8, max_retries=4, backoff=1.0, timeout=60.0):
+        self.nthreads = nthreads
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _get_connection(self, scheme, netloc):
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        key = (scheme, netloc)
+        if key not in self._local.connections:
+            connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+            self._local.connections[key] = connection_class(netloc, timeout=self.timeout)
+        return self._local.connections[key]
+
+    def _drop_connection(self, scheme, netloc):
+        connection = self._local.connections.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def fetch(self, url, stream_callback=None, _nredirects=0):
+        """Download a single URL, retrying if necessary.
+
+        Parameters
+        ----------
+        url: str
+        stream_callback: function(response)
+            If given, this is called with the (file-like) response as soon as it is received, so
+            that the data can be processed as it is downloaded rather than being held in memory.
+            If the download fails partway, the callback is called again with the retried response,
+            so it should start from scratch each time (e.g. by truncating its output file).
+
+        Returns
+        -------
+        data: bytes (or return value of stream_callback)
+        """
+        parsed_url = urlparse(url)
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2**(attempt - 1))
+            if parsed_url.scheme not in ['http', 'https']:
+                try:
+                    response = urlopen(url, timeout=self.timeout)
+                    if stream_callback is not None:
+                        return stream_callback(response)
+                    return response.read()
+                except (URLError, socket.error, zlib.error, EOFError) as e:
+                    error = e
+                    continue
+
+            path = parsed_url.path or '/'
+            if parsed_url.query:
+                path += '?' + parsed_url.query
+            try:
+                connection = self._get_connection(parsed_url.scheme, parsed_url.netloc)
+                connection.request('GET', path, headers={'Connection': 'keep-alive'})
+                response = connection.getresponse()
+                if response.status == 200 and stream_callback is not None:
+                    data = stream_callback(response)
+                    # drain anything the callback did not consume, so the connection can be reused
+                    response.read()
+                else:
+                    data = response.read()
+            except (httplib.HTTPException, socket.error, zlib.error, EOFError) as e:
+                # The server may have closed a kept-alive connection; reconnect on retry.
+                self._drop_connection(parsed_url.scheme, parsed_url.netloc)
+                error = e
+                continue
+            except Exception:
+                # e.g. an error raised by stream_callback, leaving the response partially read
+                self._drop_connection(parsed_url.scheme, parsed_url.netloc)
+                raise
+
+            if (response.getheader('connection') or '').lower() == 'close':
+                self._drop_connection(parsed_url.scheme, parsed_url.netloc)
+
+            if response.status == 200:
+                return data
+            elif response.status in self.redirect_statuses and _nredirects < self.max_redirects:
+                return self.fetch(urljoin(url, response.getheader('location')), stream_callback=stream_callback, _nredirects=_nredirects+1)
+            elif response.status in self.retryable_statuses:
+                error = HTTPFetchError(url, response.status)
+            else:
+                raise HTTPFetchError(url, response.status)
+
+        raise error
+
+    def fetch_all(self, urls, callback=None, stream_callback=None, progress_interval=None):
+        """Download a list of URLs concurrently.
+
+        Parameters
+        ----------
+        urls: list of str
+        callback: function(url, data)
+            Called (in a worker thread) for each downloaded URL, e.g. to write the data to a file.
+            The return value is stored in place of the data.
+        stream_callback: function(url, response)
+            Alternative to callback, which is passed the file-like response to process as it is
+            downloaded (see fetch). The return value is stored in place of the data.
+        progress_interval: int
+            Log progress every progress_interval downloads (default: ~10% of the total).
+
+        Returns
+        -------
+        results: dict
+            {url: data (or return value of callback)}
+        failures: dict
+            {url: exception}
+        """
+        urls = list(urls)
+        results = {}
+        failures = {}
+        if len(urls) == 0:
+            return results, failures
+        if progress_interval is None:
+            progress_interval = max(1, len(urls) // 10)
+
+        def fetch_url(url):
+            try:
+                if stream_callback is not None:
+                    data = self.fetch(url, stream_callback=lambda response: stream_callback(url, response))
+                else:
+                    data = self.fetch(url)
+                if callback is not None:
+                    data = callback(url, data)
+                return url, data, None
+            except Exception as e:
+                return url, None, e
+
+        pool = ThreadPool(min(self.nthreads, len(urls)))
+        try:
+            for ndone, (url, data, error) in enumerate(pool.imap_unordered(fetch_url, urls), 1):
+                if error is None:
+                    results[url] = data
+                else:
+                    logger.warning('Download failed for %s: %r' % (url, error))
+                    failures[url] = error
+                if ndone % progress_interval == 0 or ndone == len(urls):
+                    logger.info('Downloaded %d/%d files (%d failed)' % (ndone, len(urls), len(failures)))
+        finally:
+            pool.close()
+            pool.join()
+        return results, failures
+
+
+def download_structure_files(downloads, fetcher=None, pdb_base_url=None, sifts_base_url=None):
+    """Download PDB and SIFTS files concurrently.
+
+    Files are written to a temporary path and then renamed, so that interrupted downloads do not
+    leave partial files behind.
+
+    Parameters
+    ----------
+    downloads: list of (pdbid, structure_type, filepath)
+        structure_type is 'pdb' (written as .pdb.gz) or 'sifts' (written as processed .xml.gz)
+    fetcher: HTTPFetcher
+
+    Returns
+    -------
+    failures: dict
+        {(pdbid, structure_type): exception}
+    """
+    if fetcher is None:
+        fetcher = HTTPFetcher()
+
+    downloads_by_url = {}
+    for pdbid, structure_type, filepath in downloads:
+        if structure_type == 'pdb':
+            url = gen_pdb_url(pdbid, compressed=True, base_url=pdb_base_url)
+        elif structure_type == 'sifts':
+            url = gen_sifts_url(pdbid, base_url=sifts_base_url)
+        else:
+            raise Exception('Unknown structure type: %s' % structure_type)
+        downloads_by_url[url] = (pdbid, structure_type, filepath)
+
+    def write_structure_file(url, response):
+        # Data is streamed to disk as it is downloaded; SIFTS files are decompressed, filtered and
+        # recompressed on the fly.
+        pdbid, structure_type, filepath = downloads_by_url[url]
+        temp_filepath = filepath + '.part'
+        try:
+            if structure_type == 'pdb':
+                with open(temp_filepath, 'wb') as structure_file:
+                    shutil.copyfileobj(response, structure_file)
+            else:
+                with gzip.open(temp_filepath, 'wb') as structure_file:
+                    process_sifts_stream(response, structure_file)
+        except:
+            if os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+            raise
+        os.rename(temp_filepath, filepath)
+
+    results, failures = fetcher.fetch_all(list(downloads_by_url.keys()), stream_callback=write_structure_file)
+    return dict([
+        (downloads_by_url[url][0:2], error) for url, error in failures.items()
+    ])
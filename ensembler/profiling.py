@@ -0,0 +1,273 @@
+"""
+Instrumentation for timing the phases within each Ensembler stage.
+
+Phases are wrapped in spans, e.g.
+
+>>> with ensembler.profiling.tracer.span('minimization'):
+...     openmm.LocalEnergyMinimizer.minimize(context)
+
+Spans record nothing unless tracing has been enabled (see enable_tracing). Nested spans inherit
+the target and template IDs of the enclosing span, so that timings can be aggregated per target.
+Timings from all MPI ranks can be written in JSON format, or in Chrome trace format (which can be
+loaded in chrome://tracing or https://ui.perfetto.dev).
+"""
+import os
+import json
+import time
+import cProfile
+import contextlib
+from ensembler.core import mpistate, logger
+
+trace_formats = ['json', 'chrome']
+
+trace_format_version = 1
+
+
+class Tracer(object):
+    def __init__(self, enabled=False, profile=False, rank=None, clock=time.time):
+        """
+        Parameters
+        ----------
+        enabled : bool
+        profile : bool or list of str
+            If True, each outermost span is also profiled with cProfile, and the profiles
+            accumulated by span name. A list of span names restricts profiling to those spans.
+            Spans nested within a profiled span are not profiled separately.
+        rank : int
+            default: the MPI rank
+        clock : callable
+            Returns the current time in seconds.
+        """
+        self.enabled = enabled
+        self.profile = profile
+        if rank is None:
+            rank = mpistate.rank
+        self.rank = rank
+        self.clock = clock
+        self.spans = []
+        self.profiles = {}
+        self._open_spans = []
+        self._profiling = False
+
+    @contextlib.contextmanager
+    def span(self, name, target=None, template=None):
+        """
+        Context manager which records the wall time of the enclosed code.
+
+        Parameters
+        ----------
+        name : str
+            e.g. 'minimization'
+        target : str
+            default: the target ID of the enclosing span, if any
+        template : str
+            default: the template ID of the enclosing span, if any
+        """
+        if not self.enabled:
+            yield
+            return
+
+        if self._open_spans:
+            parent = self._open_spans[-1]
+            if target is None:
+                target = parent['target']
+            if template is None:
+                template = parent['template']
+
+        span = {
+            'name': name,
+            'target': target,
+            'template': template,
+            'rank': self.rank,
+            'depth': len(self._open_spans),
+            'start': None,
+            'duration': None,
+        }
+        profile = self._start_profile(name)
+        self._open_spans.append(span)
+        span['start'] = self.clock()
+        try:
+            yield
+        finally:
+            span['duration'] = self.clock() - span['start']
+            self._open_spans.pop()
+            if profile is not None:
+                profile.disable()
+                self._profiling = False
+            self.spans.append(span)
+
+    def _start_profile(self, name):
+        if not self.profile or self._profiling:
+            return None
+        if self.profile is not True and name not in self.profile:
+            return None
+        if name not in self.profiles:
+            self.profiles[name] = cProfile.Profile()
+        profile = self.profiles[name]
+        self._profiling = True
+        profile.enable()
+        return profile
+
+    def reset(self):
+        self.spans = []
+        self.profiles = {}
+
+    def summarize(self, spans=None):
+        """
+        Aggregates span timings by rank, target and span name.
+
+        Parameters
+        ----------
+        spans : list of dict
+            default: the spans recorded by this Tracer
+
+        Returns
+        -------
+        summary : list of dict
+            Each with keys: rank, target, name, count, total_time, mean_time, min_time, max_time.
+            Sorted by rank, target and name.
+        """
+        if spans is None:
+            spans = self.spans
+        aggregated = {}
+        for span in spans:
+            key = (span['rank'], span['target'], span['name'])
+            if key not in aggregated:
+                aggregated[key] = {
+                    'rank': span['rank'],
+                    'target': span['target'],
+                    'name': span['name'],
+                    'count': 0,
+                    'total_time': 0.,
+                    'min_time': span['duration'],
+                    'max_time': span['duration'],
+                }
+            summary = aggregated[key]
+            summary['count'] += 1
+            summary['total_time'] += span['duration']
+            summary['min_time'] = min(summary['min_time'], span['duration'])
+            summary['max_time'] = max(summary['max_time'], span['duration'])
+
+        summaries = []
+        for key in sorted(aggregated, key=lambda x: tuple('' if element is None else element for element in x)):
+            summary = aggregated[key]
+            summary['mean_time'] = summary['total_time'] / summary['count']
+            summaries.append(summary)
+        return summaries
+
+    def gen_json_trace(self, spans=None):
+        if spans is None:
+            spans = self.spans
+        return {
+            'format_version': trace_format_version,
+            'summary': self.summarize(spans),
+            'spans': spans,
+        }
+
+    def gen_chrome_trace(self, spans=None):
+        """
+        Chrome trace event format, with a process for each MPI rank. Timestamps are in
+        microseconds.
+        """
+        if spans is None:
+            spans = self.spans
+        trace_events = []
+        for span in sorted(spans, key=lambda x: (x['rank'], x['start'])):
+            trace_events.append({
+                'name': span['name'],
+                'cat': span['target'] if span['target'] is not None else 'ensembler',
+                'ph': 'X',
+                'ts': span['start'] * 1e6,
+                'dur': span['duration'] * 1e6,
+                'pid': span['rank'],
+                'tid': 0,
+                'args': {'target': span['target'], 'template': span['template']},
+            })
+        for rank in sorted(set([span['rank'] for span in spans])):
+            trace_events.append({
+                'name': 'process_name',
+                'ph': 'M',
+                'pid': rank,
+                'args': {'name': 'MPI rank %d' % rank},
+            })
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def write_profiles(self, filepath_prefix):
+        """
+        Writes the accumulated cProfile statistics for each profiled span name, to files named
+        [filepath_prefix]-[span name]-rank[rank].prof, which can be read with pstats.
+
+        Returns
+        -------
+        filepaths : list of str
+        """
+        filepaths = []
+        for name, profile in sorted(self.profiles.items()):
+            filepath = '%s-%s-rank%d.prof' % (filepath_prefix, name, self.rank)
+            profile.dump_stats(filepath)
+            filepaths.append(filepath)
+        return filepaths
+
+
+tracer = Tracer()
+
+
+def enable_tracing(profile=False):
+    """
+    Enables the module-level tracer, discarding any previously recorded spans.
+
+    Parameters
+    ----------
+    profile : bool or list of str
+        See Tracer.
+    """
+    tracer.reset()
+    tracer.enabled = True
+    tracer.profile = profile
+
+
+def disable_tracing():
+    tracer.enabled = False
+    tracer.profile = False
+
+
+def gather_spans(tracer=tracer):
+    """
+    Gathers the spans recorded on all MPI ranks. Returns the combined list on rank 0, and None
+    on other ranks.
+    """
+    gathered_spans = mpistate.comm.gather(tracer.spans, root=0)
+    if mpistate.rank != 0:
+        return None
+    return [span for rank_spans in gathered_spans for span in rank_spans]
+
+
+def write_trace(filepath, trace_format='json', tracer=tracer):
+    """
+    Gathers the spans recorded on all MPI ranks, and writes them from rank 0. Any cProfile
+    statistics are written by each rank, alongside the trace file (see Tracer.write_profiles).
+
+    Parameters
+    ----------
+    filepath : str
+    trace_format : str
+        'json' (span summary plus individual spans) or 'chrome' (Chrome trace event format)
+    """
+    if trace_format not in trace_formats:
+        raise Exception('Unrecognized trace format %s. Options: %s' % (trace_format, ', '.join(trace_formats)))
+
+    if tracer.profiles:
+        tracer.write_profiles(os.path.splitext(filepath)[0])
+
+    spans = gather_spans(tracer)
+    if mpistate.rank != 0:
+        return
+
+    if trace_format == 'json':
+        trace = tracer.gen_json_trace(spans)
+    else:
+        trace = tracer.gen_chrome_trace(spans)
+
+    with open(filepath, 'w') as trace_file:
+        json.dump(trace, trace_file, indent=1)
+    logger.info('Trace written to %s' % filepath)
@@ -13,7 +13,11 @@ import numpy as np
 import Bio
 import ensembler
 import ensembler.version
+import ensembler.utils
+import ensembler.runlog
 from ensembler.core import mpistate, logger
+from ensembler.profiling import tracer
+from ensembler.metrics import metrics
 import simtk.unit as unit
 import simtk.openmm as openmm
 import simtk.openmm.app as app
@@ -37,11 +41,27 @@ def refine_implicit_md(
         nsteps_per_iteration=500,
         ph=7.0,
         retry_failed_runs=False,
-        cpu_platform_threads=1):
+        cpu_platform_threads=1,
+        calibrate_openmm_platform=False,
+        partition_cpu_cores=False,
+        pin_cpu_affinity=False,
+        cpu_natoms_per_thread=2000):
     # TODO - refactor
     '''Run MD refinement in implicit solvent.
 
     MPI-enabled.
+
+    If openmm_platform is not specified, the platform (and, for the CPU platform, the number of
+    threads) is taken from the fastest configuration found by a previous platform benchmark run on
+    this host, if available. Set calibrate_openmm_platform=True to (re)run the benchmark, using the
+    reference model of each target.
+
+    When using the CPU platform with several MPI ranks per node, set partition_cpu_cores=True to
+    split the physical cores of each node between the co-located ranks, rather than using
+    cpu_platform_threads for every rank (see assign_worker_cpu_cores). The number of threads used
+    for each target is further capped at one per cpu_natoms_per_thread atoms, and the number of
+    cores left idle as a result is logged, together with the number of ranks per node which would
+    use them. The cores in use can optionally be pinned to each rank (pin_cpu_affinity=True).
     '''
     gpuid = mpistate.rank % gpupn
 
@@ -54,13 +74,30 @@ def refine_implicit_md(
     else:
         selected_template_indices = range(len(templates_resolved_seq))
 
-    if not openmm_platform:
+    autoselect_openmm_platform = not openmm_platform
+    if autoselect_openmm_platform:
         openmm_platform = auto_select_openmm_platform()
 
-    if openmm_platform == 'CPU':
-        platform_properties = {'CpuThreads': str(cpu_platform_threads)}
-    else:
-        platform_properties = {}
+    platform_properties = gen_openmm_platform_properties(openmm_platform, cpu_platform_threads)
+    default_openmm_platform = openmm_platform
+    default_platform_properties = platform_properties
+
+    if calibrate_openmm_platform:
+        # One rank per host runs the benchmark, while the others wait.
+        hostnames = ensembler.core.get_mpi_hostnames()
+        first_rank_on_host = hostnames.index(hostnames[mpistate.rank]) == mpistate.rank
+
+    if partition_cpu_cores:
+        # The partition is computed once, from the CPUs available before any pinning, so that
+        # every target is run on the same share of the node.
+        node_local_rank, node_local_size = ensembler.core.get_node_local_rank_and_size()
+        physical_core_cpus = get_physical_core_cpus()
+        cpu_threads, worker_cpu_cores = assign_worker_cpu_cores(
+            len(physical_core_cpus), node_local_size, node_local_rank
+        )
+        worker_cpus = [physical_core_cpus[core] for core in worker_cpu_cores]
+        if pin_cpu_affinity:
+            set_cpu_affinity(worker_cpus)
 
     ff_files = [ff+'.xml', implicit_water_model+'.xml']
     forcefield = app.ForceField(*ff_files)
@@ -70,11 +107,19 @@ def refine_implicit_md(
 
     niterations = int((sim_length / timestep) / nsteps_per_iteration)
 
+    def create_implicit_system(topology):
+        if cutoff is None:
+            system = forcefield.createSystem(topology, nonbondedMethod=app.NoCutoff, constraints=app.HBonds)
+        else:
+            system = forcefield.createSystem(topology, nonbondedMethod=app.CutoffNonPeriodic, nonbondedCutoff=cutoff, constraints=app.HBonds)
+        return system
+
     def simulate_implicit_md():
 
         if verbose: print("Reading model...")
-        with gzip.open(model_filename) as model_file:
-            pdb = app.PDBFile(model_file)
+        with tracer.span('read_model'):
+            with gzip.open(model_filename) as model_file:
+                pdb = app.PDBFile(model_file)
 
         # Set up Platform
         platform = openmm.Platform.getPlatformByName(openmm_platform)
@@ -90,23 +135,24 @@ def refine_implicit_md(
         modeller = app.Modeller(reference_topology, pdb.positions)
         # set_openmm_topology_bonds_from_atom_indices(modeller.topology, reference_bonds)
         # Add missing protons.
-        modeller.addHydrogens(forcefield, pH=ph, variants=reference_variants)
+        with tracer.span('add_hydrogens'):
+            modeller.addHydrogens(forcefield, pH=ph, variants=reference_variants)
         topology = modeller.getTopology()
         positions = modeller.getPositions()
 
         if verbose: print("Constructing System object...")
-        if cutoff is None:
-            system = forcefield.createSystem(topology, nonbondedMethod=app.NoCutoff, constraints=app.HBonds)
-        else:
-            system = forcefield.createSystem(topology, nonbondedMethod=app.CutoffNonPeriodic, nonbondedCutoff=cutoff, constraints=app.HBonds)
+        with tracer.span('create_system'):
+            system = create_implicit_system(topology)
 
         if verbose: print("Creating Context...")
-        integrator = openmm.LangevinIntegrator(temperature, collision_rate, timestep)
-        context = openmm.Context(system, integrator, platform, platform_properties)
-        context.setPositions(positions)
+        with tracer.span('create_context'):
+            integrator = openmm.LangevinIntegrator(temperature, collision_rate, timestep)
+            context = openmm.Context(system, integrator, platform, platform_properties)
+            context.setPositions(positions)
 
         if verbose: print("Minimizing structure...")
-        openmm.LocalEnergyMinimizer.minimize(context, minimization_tolerance, minimization_steps)
+        with tracer.span('minimization'):
+            openmm.LocalEnergyMinimizer.minimize(context, minimization_tolerance, minimization_steps)
 
         if write_trajectory:
             # Open trajectory for writing.
@@ -125,7 +171,8 @@ def refine_implicit_md(
         initial_time = time.time()
         for iteration in range(niterations):
             # integrate dynamics
-            integrator.step(nsteps_per_iteration)
+            with tracer.span('dynamics'):
+                integrator.step(nsteps_per_iteration)
             # get current state
             state = context.getState(getEnergy=True, getPositions=True)
             simulation_time = state.getTime()
@@ -134,6 +181,8 @@ def refine_implicit_md(
             final_time = time.time()
             elapsed_time = (final_time - initial_time) * unit.seconds
             ns_per_day = (simulation_time / elapsed_time) / (unit.nanoseconds / unit.day)
+            metrics.set('ensembler_ns_per_day', ns_per_day, stage='refine_implicit_md')
+            metrics.maybe_write()
             if verbose: print(
                 "  %8.1f ps : potential %8.3f kT | kinetic %8.3f kT | %.3f ns/day | %.3f s remain"
                 % (
@@ -161,11 +210,12 @@ def refine_implicit_md(
         energy_outfile.close()
 
         # Write final PDB file.
-        pdb_outfile = gzip.open(pdb_filename, 'w')
-        app.PDBFile.writeHeader(topology, file=pdb_outfile)
-        app.PDBFile.writeFile(topology, state.getPositions(), file=pdb_outfile)
-        app.PDBFile.writeFooter(topology, file=pdb_outfile)
-        pdb_outfile.close()
+        with tracer.span('compression'):
+            pdb_outfile = gzip.open(pdb_filename, 'w')
+            app.PDBFile.writeHeader(topology, file=pdb_outfile)
+            app.PDBFile.writeFile(topology, state.getPositions(), file=pdb_outfile)
+            app.PDBFile.writeFooter(topology, file=pdb_outfile)
+            pdb_outfile.close()
 
 
 
@@ -212,6 +262,50 @@ def refine_implicit_md(
                 print("")
             else: print(reference_variants)
 
+        # ========
+        # Select the fastest benchmarked platform configuration for this host
+        # ========
+
+        if autoselect_openmm_platform:
+            benchmark_filepath = gen_platform_benchmark_filepath(models_target_dir, benchmark_name='implicit')
+            if calibrate_openmm_platform:
+                if first_rank_on_host:
+                    logger.info('Benchmarking OpenMM platforms for target %s on host %s' % (target.id, socket.gethostname()))
+                    benchmark_results = benchmark_openmm_platforms(
+                        create_implicit_system(modeller.topology), modeller.positions,
+                        temperature=temperature, collision_rate=collision_rate, timestep=timestep,
+                        gpuid=gpuid, verbose=verbose
+                    )
+                    write_platform_benchmark_file(benchmark_filepath, benchmark_results)
+                mpistate.comm.Barrier()
+
+            benchmark_results = read_platform_benchmark_file(benchmark_filepath)
+            if benchmark_results:
+                openmm_platform, benchmarked_cpu_platform_threads = select_fastest_openmm_platform(benchmark_results)
+                platform_properties = gen_openmm_platform_properties(openmm_platform, benchmarked_cpu_platform_threads)
+                logger.debug('Using benchmarked OpenMM platform %s %s' % (openmm_platform, platform_properties))
+            else:
+                openmm_platform = default_openmm_platform
+                platform_properties = default_platform_properties
+
+        if partition_cpu_cores and openmm_platform == 'CPU':
+            cpu_threads, cpu_cores = assign_worker_cpu_cores(
+                len(physical_core_cpus), node_local_size, node_local_rank,
+                natoms=modeller.topology.getNumAtoms(), natoms_per_thread=cpu_natoms_per_thread
+            )
+            target_cpus = [physical_core_cpus[core] for core in cpu_cores]
+            if pin_cpu_affinity:
+                set_cpu_affinity(target_cpus)
+            platform_properties = gen_openmm_platform_properties(openmm_platform, cpu_threads)
+            logger.debug('MPI rank %d using %d CPU threads on CPUs %s' % (mpistate.rank, cpu_threads, target_cpus))
+            nidle_cores = len(worker_cpus) - cpu_threads
+            if nidle_cores > 0 and mpistate.rank == 0:
+                logger.info(
+                    'Target %s (%d atoms) is too small to use all %d cores of each rank; %d cores per rank will be idle. '
+                    'Running %d ranks per node would use all cores.'
+                    % (target.id, modeller.topology.getNumAtoms(), len(worker_cpus), nidle_cores, len(physical_core_cpus) // cpu_threads)
+                )
+
         if template_seqid_cutoff:
             process_only_these_templates = ensembler.core.select_templates_by_seqid_cutoff(target.id, seqid_cutoff=template_seqid_cutoff)
             selected_template_indices = [i for i, seq in enumerate(templates_resolved_seq) if seq.id in process_only_these_templates]
@@ -220,6 +314,8 @@ def refine_implicit_md(
 
         for template_index in range(mpistate.rank, ntemplates_selected, mpistate.size):
             template = templates_resolved_seq[selected_template_indices[template_index]]
+            metrics.set('ensembler_queue_depth', len(range(template_index, ntemplates_selected, mpistate.size)), stage='refine_implicit_md', target=target.id)
+            metrics.maybe_write()
 
             model_dir = os.path.join(models_target_dir, template.id)
             if not os.path.exists(model_dir): continue
@@ -230,13 +326,12 @@ def refine_implicit_md(
 
             # Pass if this simulation has already been run.
             log_filepath = os.path.join(model_dir, 'implicit-log.yaml')
-            if os.path.exists(log_filepath):
-                with open(log_filepath) as log_file:
-                    log_data = yaml.load(log_file, Loader=ensembler.core.YamlLoader)
-                    if log_data.get('successful') is True:
-                        continue
-                    if log_data.get('finished') is True and (retry_failed_runs is False and log_data.get('successful') is False):
-                        continue
+            log_data = ensembler.runlog.load_model_log(log_filepath)
+            if log_data is not None:
+                if log_data.get('successful') is True:
+                    continue
+                if log_data.get('finished') is True and (retry_failed_runs is False and log_data.get('successful') is False):
+                    continue
 
             # Check to make sure the initial model file is present.
             model_filename = os.path.join(model_dir, 'model.pdb.gz')
@@ -263,7 +358,8 @@ def refine_implicit_md(
 
             try:
                 start = datetime.datetime.utcnow()
-                simulate_implicit_md()
+                with tracer.span('refine_implicit_md', target=target.id, template=template.id):
+                    simulate_implicit_md()
                 timing = ensembler.core.strf_timedelta(datetime.datetime.utcnow() - start)
                 log_data = {
                     'finished': True,
@@ -271,6 +367,7 @@ def refine_implicit_md(
                     'successful': True,
                     }
                 log_file.log(new_log_data=log_data)
+                metrics.inc('ensembler_models_completed_total', stage='refine_implicit_md', target=target.id)
             except Exception as e:
                 trbk = traceback.format_exc()
                 warnings.warn(
@@ -287,6 +384,10 @@ def refine_implicit_md(
                     'successful': False,
                     }
                 log_file.log(new_log_data=log_data)
+                metrics.inc('ensembler_models_failed_total', stage='refine_implicit_md', target=target.id)
+
+        metrics.set('ensembler_queue_depth', 0, stage='refine_implicit_md', target=target.id)
+        metrics.write()
 
         if verbose:
             print('Finished template loop: rank %d' % mpistate.rank)
@@ -341,6 +442,298 @@ def auto_select_openmm_platform():
     raise Exception('No OpenMM platform found')
 
 
+def get_available_openmm_platforms():
+    return [openmm.Platform.getPlatform(i).getName() for i in range(openmm.Platform.getNumPlatforms())]
+
+
+def gen_openmm_platform_properties(openmm_platform, cpu_platform_threads=1):
+    if openmm_platform == 'CPU' and cpu_platform_threads is not None:
+        return {'CpuThreads': str(cpu_platform_threads)}
+    return {}
+
+
+def count_physical_cpu_cores():
+    """
+    Count the physical CPU cores available to this process, excluding hyperthreads where this
+    can be determined (from /proc/cpuinfo on Linux).
+
+    Returns
+    -------
+    ncores: int
+    """
+    return len(get_physical_core_cpus())
+
+
+def get_available_cpus():
+    """
+    Returns a sorted list of the (logical) CPU ids which this process is allowed to run on.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    import multiprocessing
+    return list(range(multiprocessing.cpu_count()))
+
+
+def parse_cpuinfo_core_map(cpuinfo_text):
+    """
+    Parse the contents of /proc/cpuinfo.
+
+    Returns
+    -------
+    core_map: dict of {int: (str, str)}
+        {logical CPU id: (physical id, core id)}
+    """
+    core_map = {}
+    for processor_text in cpuinfo_text.strip().split('\n\n'):
+        fields = {}
+        for line in processor_text.splitlines():
+            if ':' in line:
+                key, value = line.split(':', 1)
+                fields[key.strip()] = value.strip()
+        if 'processor' in fields and 'core id' in fields:
+            core_map[int(fields['processor'])] = (fields.get('physical id'), fields['core id'])
+    return core_map
+
+
+def get_physical_core_cpus(available_cpus=None, core_map=None):
+    """
+    Select one logical CPU per physical core, so that hyperthread siblings are not treated as
+    separate cores.
+
+    Parameters
+    ----------
+    available_cpus: list of int
+        default: the CPUs which this process is allowed to run on
+    core_map: dict of {int: (str, str)}
+        {logical CPU id: (physical id, core id)}
+        default: read from /proc/cpuinfo, if available
+
+    Returns
+    -------
+    cpus: list of int
+        sorted logical CPU ids. If the core layout cannot be determined, all available CPUs.
+    """
+    if available_cpus is None:
+        available_cpus = get_available_cpus()
+    if core_map is None:
+        try:
+            with open('/proc/cpuinfo') as cpuinfo_file:
+                core_map = parse_cpuinfo_core_map(cpuinfo_file.read())
+        except IOError:
+            core_map = {}
+    if not all([cpu in core_map for cpu in available_cpus]):
+        return list(available_cpus)
+    core_cpus = {}
+    for cpu in sorted(available_cpus):
+        core_cpus.setdefault(core_map[cpu], cpu)
+    return sorted(core_cpus.values())
+
+
+def assign_worker_cpu_cores(ncores, nworkers, worker_index, natoms=None, natoms_per_thread=2000):
+    """
+    Split the CPU cores of a node between a number of co-located workers (e.g. MPI ranks), each
+    running its own simulation.
+
+    Each worker gets an equal, non-overlapping share of the cores. Small systems do not scale well
+    across many threads, so if natoms is given, the number of threads is also capped at
+    natoms / natoms_per_thread (the worker's remaining cores are left idle). If there are more
+    workers than cores, each worker is given a single thread and cores are shared.
+
+    Parameters
+    ----------
+    ncores: int
+    nworkers: int
+    worker_index: int
+    natoms: int
+    natoms_per_thread: int
+
+    Returns
+    -------
+    cpu_threads: int
+    cpu_cores: list of int
+        indices (in the range [0, ncores)) of the cores assigned to this worker
+
+    Examples
+    --------
+    >>> assign_worker_cpu_cores(16, 4, 1)
+    (4, [4, 5, 6, 7])
+    """
+    cores_per_worker = max(1, ncores // nworkers)
+    cpu_threads = cores_per_worker
+    if natoms is not None:
+        cpu_threads = min(cpu_threads, max(1, natoms // natoms_per_thread))
+    first_core = (worker_index * cores_per_worker) % ncores
+    cpu_cores = [(first_core + i) % ncores for i in range(cpu_threads)]
+    return cpu_threads, cpu_cores
+
+
+def set_cpu_affinity(cpus):
+    """
+    Pin the current process to the given logical CPU ids. Returns False if this is not supported
+    on the current platform.
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        warnings.warn('Setting CPU affinity is not supported on this platform')
+        return False
+    os.sched_setaffinity(0, cpus)
+    return True
+
+
+def gen_cpu_threads_to_benchmark(ncpus=None):
+    """
+    Powers of two up to the number of available CPUs, plus the number of CPUs itself.
+
+    Examples
+    --------
+    >>> gen_cpu_threads_to_benchmark(ncpus=12)
+    [1, 2, 4, 8, 12]
+    """
+    if ncpus is None:
+        import multiprocessing
+        ncpus = multiprocessing.cpu_count()
+    cpu_threads_to_benchmark = []
+    nthreads = 1
+    while nthreads < ncpus:
+        cpu_threads_to_benchmark.append(nthreads)
+        nthreads *= 2
+    cpu_threads_to_benchmark.append(ncpus)
+    return cpu_threads_to_benchmark
+
+
+def benchmark_openmm_platform(system, positions, openmm_platform, cpu_platform_threads=None,
+                              temperature=300.0 * unit.kelvin, collision_rate=20.0 / unit.picoseconds,
+                              timestep=2.0 * unit.femtoseconds, nsteps=500, gpuid=0):
+    """
+    Time a short Langevin dynamics simulation of the given System.
+
+    Returns
+    -------
+    ns_per_day: float
+    """
+    import time
+    platform = openmm.Platform.getPlatformByName(openmm_platform)
+    platform_properties = gen_openmm_platform_properties(openmm_platform, cpu_platform_threads)
+    if 'CUDA_VISIBLE_DEVICES' not in os.environ:
+        if openmm_platform == 'CUDA':
+            platform_properties['CudaDeviceIndex'] = '%d' % gpuid
+        elif openmm_platform == 'OpenCL':
+            platform_properties['OpenCLDeviceIndex'] = '%d' % gpuid
+
+    integrator = openmm.LangevinIntegrator(temperature, collision_rate, timestep)
+    context = openmm.Context(system, integrator, platform, platform_properties)
+    context.setPositions(positions)
+    openmm.LocalEnergyMinimizer.minimize(context, 10.0 * unit.kilojoules_per_mole / unit.nanometer, 20)
+    context.setVelocitiesToTemperature(temperature)
+
+    # Warm up first, so that e.g. kernel compilation is not included in the timing.
+    integrator.step(10)
+    context.getState(getEnergy=True)
+
+    initial_time = time.time()
+    integrator.step(nsteps)
+    context.getState(getEnergy=True)
+    elapsed_time = (time.time() - initial_time) * unit.seconds
+    ns_per_day = ((nsteps * timestep) / elapsed_time) / (unit.nanoseconds / unit.day)
+
+    del context, integrator
+    return ns_per_day
+
+
+def benchmark_openmm_platforms(system, positions, openmm_platforms=None, cpu_threads_to_benchmark=None,
+                               temperature=300.0 * unit.kelvin, collision_rate=20.0 / unit.picoseconds,
+                               timestep=2.0 * unit.femtoseconds, nsteps=500, gpuid=0, verbose=False):
+    """
+    Benchmark a System on each available OpenMM platform, and with a range of thread counts on
+    the CPU platform. The Reference platform is only benchmarked if no other platform is available.
+
+    Returns
+    -------
+    benchmark_results: list of dict
+        [{'openmm_platform': str, 'cpu_platform_threads': int or None, 'ns_per_day': float}, ...]
+    """
+    if openmm_platforms is None:
+        openmm_platforms = get_available_openmm_platforms()
+        if len(openmm_platforms) > 1 and 'Reference' in openmm_platforms:
+            openmm_platforms.remove('Reference')
+    if cpu_threads_to_benchmark is None:
+        cpu_threads_to_benchmark = gen_cpu_threads_to_benchmark()
+
+    benchmark_results = []
+    for openmm_platform in openmm_platforms:
+        if openmm_platform == 'CPU':
+            cpu_platform_threads_list = cpu_threads_to_benchmark
+        else:
+            cpu_platform_threads_list = [None]
+
+        for cpu_platform_threads in cpu_platform_threads_list:
+            try:
+                ns_per_day = benchmark_openmm_platform(
+                    system, positions, openmm_platform, cpu_platform_threads=cpu_platform_threads,
+                    temperature=temperature, collision_rate=collision_rate, timestep=timestep,
+                    nsteps=nsteps, gpuid=gpuid
+                )
+            except Exception as e:
+                logger.debug('Benchmark failed for OpenMM platform %s: %s' % (openmm_platform, e))
+                continue
+            if verbose: print('  %s (CPU threads: %s): %.3f ns/day' % (openmm_platform, cpu_platform_threads, ns_per_day))
+            benchmark_results.append({
+                'openmm_platform': openmm_platform,
+                'cpu_platform_threads': cpu_platform_threads,
+                'ns_per_day': float(ns_per_day),
+            })
+
+    return benchmark_results
+
+
+def select_fastest_openmm_platform(benchmark_results):
+    """
+    Parameters
+    ----------
+    benchmark_results: list of dict
+        As returned by benchmark_openmm_platforms
+
+    Returns
+    -------
+    openmm_platform: str
+    cpu_platform_threads: int or None
+    """
+    if len(benchmark_results) == 0:
+        raise Exception('No OpenMM platform benchmark results to select from')
+    fastest = max(benchmark_results, key=lambda result: result['ns_per_day'])
+    return fastest['openmm_platform'], fastest['cpu_platform_threads']
+
+
+def gen_platform_benchmark_filepath(models_target_dir, benchmark_name='implicit', hostname=None):
+    if hostname is None:
+        hostname = socket.gethostname()
+    return os.path.join(models_target_dir, 'platform-benchmark-%s-%s.yaml' % (benchmark_name, hostname))
+
+
+def write_platform_benchmark_file(benchmark_filepath, benchmark_results):
+    benchmark_data = {
+        'hostname': socket.gethostname(),
+        'datestamp': ensembler.core.get_utcnow_formatted(),
+        'openmm_version': simtk.openmm.version.short_version,
+        'benchmark_results': benchmark_results,
+    }
+    with open(benchmark_filepath, 'w') as benchmark_file:
+        yaml.dump(benchmark_data, benchmark_file, default_flow_style=False, Dumper=ensembler.core.YamlDumper)
+
+
+def read_platform_benchmark_file(benchmark_filepath):
+    """
+    Returns None if no benchmark file is found, or if it was generated with a different
+    version of OpenMM.
+    """
+    if not os.path.exists(benchmark_filepath):
+        return None
+    with open(benchmark_filepath) as benchmark_file:
+        benchmark_data = yaml.load(benchmark_file, Loader=ensembler.core.YamlLoader)
+    if benchmark_data.get('openmm_version') != simtk.openmm.version.short_version:
+        return None
+    return benchmark_data.get('benchmark_results')
+
+
 def get_highest_seqid_existing_model(targetid=None, models_target_dir=None):
     """
     Parameters
@@ -399,9 +792,23 @@ def solvate_models(process_only_these_targets=None, process_only_these_templates
                    ff='amber99sbildn',
                    water_model='tip3p',
                    verbose=False,
-                   padding=None):
+                   padding=None,
+                   estimate_nwaters=False,
+                   nwaters_calibration_samples=0,
+                   water_exclusion_radius=None,
+                   save_solvated_model=False):
     """Solvate models which have been subjected to MD refinement with implicit solvent.
 
+    By default each model is solvated with Modeller.addSolvent, in order to count the number of
+    waters. If estimate_nwaters is True, the number of waters is instead estimated from the
+    bounding box and excluded volume of each model (see estimate_nwaters_from_positions), which is
+    orders of magnitude faster. The estimates can be calibrated against exact counts for a sample
+    of nwaters_calibration_samples models per target.
+
+    If save_solvated_model is True (and estimate_nwaters is False), each solvated model is saved to
+    solvated-model.npz in the model directory, so that refine_explicit_md can trim it to the
+    required number of waters rather than solvating the model again.
+
     MPI-enabled.
     """
     if padding is None:
@@ -420,6 +827,9 @@ def solvate_models(process_only_these_targets=None, process_only_these_templates
     else:
         selected_template_indices = range(len(templates_resolved_seq))
 
+    if water_exclusion_radius is None:
+        water_exclusion_radius = 0.3 * unit.nanometers
+
     ff_files = [ff+'.xml', water_model+'.xml']
     forcefield = app.ForceField(*ff_files)
 
@@ -439,6 +849,43 @@ def solvate_models(process_only_these_targets=None, process_only_these_templates
 
         ntemplates_selected = len(selected_template_indices)
 
+        # ========
+        # Calibrate nwaters estimates against exact counts for a sample of models
+        # ========
+
+        calibration_templateids = []
+        nwaters_calibration_factor = 1.0
+        if estimate_nwaters and nwaters_calibration_samples > 0:
+            model_templateids = [
+                templates_resolved_seq[i].id for i in selected_template_indices
+                if os.path.exists(os.path.join(models_target_dir, templates_resolved_seq[i].id, 'implicit-refined.pdb.gz'))
+            ]
+            calibration_templateids = select_evenly_spaced_sample(model_templateids, nwaters_calibration_samples)
+
+            nwaters_ratios = []
+            for calibration_index in range(mpistate.rank, len(calibration_templateids), mpistate.size):
+                model_dir = os.path.join(models_target_dir, calibration_templateids[calibration_index])
+                try:
+                    with gzip.open(os.path.join(model_dir, 'implicit-refined.pdb.gz')) as model_file:
+                        pdb = app.PDBFile(model_file)
+                    nwaters = count_nwaters_by_solvation(pdb, forcefield, padding, water_model=water_model)
+                    nwaters_estimated = estimate_nwaters_from_positions(pdb.positions, padding, exclusion_radius=water_exclusion_radius)
+                    nwaters_ratios.append(nwaters / nwaters_estimated)
+                    nwaters_filename = os.path.join(model_dir, 'nwaters.txt')
+                    if not os.path.exists(nwaters_filename):
+                        with open(nwaters_filename, 'w') as nwaters_file:
+                            nwaters_file.write('%d\n' % nwaters)
+                except Exception as e:
+                    warnings.warn('nwaters calibration failed for model %s: %r' % (model_dir, e))
+
+            nwaters_ratios_gathered = mpistate.comm.gather(nwaters_ratios, root=0)
+            if mpistate.rank == 0:
+                nwaters_ratios = [ratio for ratios in nwaters_ratios_gathered for ratio in ratios]
+                if len(nwaters_ratios) > 0:
+                    nwaters_calibration_factor = float(np.mean(nwaters_ratios))
+                logger.info('nwaters estimate calibration factor (target: %s, %d samples): %.4f' % (target.id, len(nwaters_ratios), nwaters_calibration_factor))
+            nwaters_calibration_factor = mpistate.comm.bcast(nwaters_calibration_factor, root=0)
+
         for template_index in range(mpistate.rank, ntemplates_selected, mpistate.size):
             template = templates_resolved_seq[selected_template_indices[template_index]]
 
@@ -452,35 +899,33 @@ def solvate_models(process_only_these_targets=None, process_only_these_templates
             print("Solvating %s => %s in explicit solvent" % (target.id, template.id))
             print("-------------------------------------------------------------------------")
             
-            # Pass if solvation has already been run for this model.
+            # Pass if solvation has already been run for this model, unless the saved solvated model
+            # is missing or was generated from a previous version of the refined model.
             nwaters_filename = os.path.join(model_dir, 'nwaters.txt')
+            solvated_model_filename = os.path.join(model_dir, 'solvated-model.npz')
+            model_sha1 = None
+            if save_solvated_model and not estimate_nwaters:
+                model_sha1 = ensembler.utils.sha1_of_file(model_filename)
             if os.path.exists(nwaters_filename):
-                continue
+                if model_sha1 is None or read_solvated_model_source_sha1(solvated_model_filename) == model_sha1:
+                    continue
 
             try:
                 if verbose: print("Reading model...")
                 with gzip.open(model_filename) as model_file:
                     pdb = app.PDBFile(model_file)
 
-                # Count initial atoms.
-                natoms_initial = len(pdb.positions)
-
-                # Add solvent
-                if verbose: print("Solvating model...")
-                modeller = app.Modeller(pdb.topology, pdb.positions)
-                modeller.addSolvent(forcefield, model='tip3p', padding=padding)
-                positions = modeller.getPositions()
-
-                # Get number of particles per water molecule by inspecting the last residue in the topology
-                resi_generator = modeller.topology.residues()
-                resi_deque = deque(resi_generator, maxlen=1)
-                last_resi = resi_deque.pop()
-                nparticles_per_water = len([atom for atom in last_resi.atoms()])
-
-                # Count final atoms.
-                natoms_final = len(positions)
-                nwaters = (natoms_final - natoms_initial) / nparticles_per_water
-                if verbose: print("Solvated model contains %d waters" % nwaters)
+                if estimate_nwaters:
+                    if verbose: print("Estimating number of waters...")
+                    nwaters_estimated = estimate_nwaters_from_positions(pdb.positions, padding, exclusion_radius=water_exclusion_radius)
+                    nwaters = int(round(nwaters_calibration_factor * nwaters_estimated))
+                    if verbose: print("Solvated model estimated to contain %d waters" % nwaters)
+                else:
+                    if verbose: print("Solvating model...")
+                    nwaters, modeller = count_nwaters_by_solvation(pdb, forcefield, padding, water_model=water_model, return_modeller=True)
+                    if verbose: print("Solvated model contains %d waters" % nwaters)
+                    if save_solvated_model:
+                        write_solvated_model(solvated_model_filename, modeller, pdb.topology.getNumResidues(), source_sha1=model_sha1)
 
                 # Record waters.
                 with open(nwaters_filename, 'w') as nwaters_file:
@@ -513,7 +958,11 @@ def solvate_models(process_only_these_targets=None, process_only_these_templates
                 'openmm_version': simtk.openmm.version.short_version,
                 'openmm_commit': simtk.openmm.version.git_revision,
                 'timing': ensembler.core.strf_timedelta(target_timedelta),
+                'nwaters_method': 'estimate' if estimate_nwaters else 'addSolvent',
             }
+            if estimate_nwaters:
+                metadata['nwaters_calibration_samples'] = len(calibration_templateids)
+                metadata['nwaters_calibration_factor'] = nwaters_calibration_factor
 
             project_metadata.add_data(metadata)
             project_metadata.write()
@@ -525,6 +974,393 @@ def solvate_models(process_only_these_targets=None, process_only_these_templates
         print('Done.')
 
 
+def count_nwaters_by_solvation(pdb, forcefield, padding, water_model='tip3p', return_modeller=False):
+    """
+    Count the number of waters added when solvating a model with Modeller.addSolvent.
+
+    Parameters
+    ----------
+    pdb: simtk.openmm.app.PDBFile
+    forcefield: simtk.openmm.app.ForceField
+    padding: simtk.unit.Quantity
+    return_modeller: bool
+        also return the solvated Modeller object
+
+    Returns
+    -------
+    nwaters: int
+    modeller: simtk.openmm.app.Modeller (only if return_modeller is True)
+    """
+    # Count initial atoms.
+    natoms_initial = len(pdb.positions)
+
+    # Add solvent
+    modeller = app.Modeller(pdb.topology, pdb.positions)
+    modeller.addSolvent(forcefield, model=water_model, padding=padding)
+    positions = modeller.getPositions()
+
+    # Get number of particles per water molecule by inspecting the last residue in the topology
+    resi_generator = modeller.topology.residues()
+    resi_deque = deque(resi_generator, maxlen=1)
+    last_resi = resi_deque.pop()
+    nparticles_per_water = len([atom for atom in last_resi.atoms()])
+
+    # Count final atoms.
+    natoms_final = len(positions)
+    nwaters = (natoms_final - natoms_initial) // nparticles_per_water
+    if return_modeller:
+        return nwaters, modeller
+    return nwaters
+
+
+def write_solvated_model(filepath, modeller, nresidues_initial, source_sha1=''):
+    """
+    Write the positions and box of a solvated model, together with the topology of the solvent
+    (everything after the first nresidues_initial residues), to a compressed numpy .npz file.
+
+    Positions are stored in nm, as float32. The solute topology is not stored, and should be
+    taken from the unsolvated model when reading the file (see read_solvated_model).
+    source_sha1 (the sha1 of the unsolvated model file) is stored alongside, so that a solvated
+    model which is out of date with respect to its source can be detected.
+    """
+    residues = list(modeller.topology.residues())
+    solvent_residues = residues[nresidues_initial:]
+    first_solvent_atom_index = next(residues[nresidues_initial].atoms()).index if solvent_residues else modeller.topology.getNumAtoms()
+    solvent_atoms = [atom for residue in solvent_residues for atom in residue.atoms()]
+    solvent_bonds = [
+        (atom1.index - first_solvent_atom_index, atom2.index - first_solvent_atom_index)
+        for atom1, atom2 in modeller.topology.bonds()
+        if atom1.index >= first_solvent_atom_index and atom2.index >= first_solvent_atom_index
+    ]
+    box = modeller.topology.getUnitCellDimensions().value_in_unit(unit.nanometers)
+    with open(filepath, 'wb') as solvated_model_file:
+        np.savez_compressed(
+            solvated_model_file,
+            positions=np.array(modeller.positions.value_in_unit(unit.nanometers), dtype=np.float32),
+            box=np.array([box[0], box[1], box[2]], dtype=np.float32),
+            residue_names=np.array([residue.name for residue in solvent_residues], dtype=str),
+            residue_natoms=np.array([len(list(residue.atoms())) for residue in solvent_residues], dtype=np.int32),
+            atom_names=np.array([atom.name for atom in solvent_atoms], dtype=str),
+            atom_elements=np.array([atom.element.symbol if atom.element is not None else '' for atom in solvent_atoms], dtype=str),
+            bonds=np.array(solvent_bonds, dtype=np.int32).reshape(-1, 2),
+            source_sha1=np.array(source_sha1, dtype=str),
+        )
+
+
+def read_solvated_model_source_sha1(filepath):
+    """
+    Returns the source_sha1 stored by write_solvated_model, or None if the file does not exist or
+    has no source_sha1.
+    """
+    if not os.path.exists(filepath):
+        return None
+    solvated_model = np.load(filepath)
+    try:
+        if 'source_sha1' not in solvated_model.files:
+            return None
+        return str(solvated_model['source_sha1'][()]) or None
+    finally:
+        solvated_model.close()
+
+
+def read_solvated_model(filepath, topology):
+    """
+    Read a solvated model written by write_solvated_model.
+
+    Parameters
+    ----------
+    filepath: str
+    topology: simtk.openmm.app.Topology
+        topology of the unsolvated model
+
+    Returns
+    -------
+    modeller: simtk.openmm.app.Modeller
+    """
+    solvated_model = np.load(filepath)
+    positions = solvated_model['positions'].astype(float)
+    natoms_initial = topology.getNumAtoms()
+
+    solvent_topology = app.Topology()
+    chain = solvent_topology.addChain()
+    atoms = []
+    atom_names = iter(solvated_model['atom_names'])
+    atom_elements = iter(solvated_model['atom_elements'])
+    for residue_name, residue_natoms in zip(solvated_model['residue_names'], solvated_model['residue_natoms']):
+        residue = solvent_topology.addResidue(str(residue_name), chain)
+        for _ in range(residue_natoms):
+            atom_name = str(next(atom_names))
+            element_symbol = str(next(atom_elements))
+            element = app.element.get_by_symbol(element_symbol) if element_symbol else None
+            atoms.append(solvent_topology.addAtom(atom_name, element, residue))
+    for atom_index1, atom_index2 in solvated_model['bonds']:
+        solvent_topology.addBond(atoms[atom_index1], atoms[atom_index2])
+
+    if natoms_initial + len(atoms) != len(positions):
+        raise Exception('Solvated model file %s does not match the given topology' % filepath)
+
+    modeller = app.Modeller(topology, [openmm.Vec3(*xyz) for xyz in positions[:natoms_initial]] * unit.nanometers)
+    modeller.add(solvent_topology, [openmm.Vec3(*xyz) for xyz in positions[natoms_initial:]] * unit.nanometers)
+    modeller.topology.setUnitCellDimensions(openmm.Vec3(*solvated_model['box'].astype(float)) * unit.nanometers)
+    return modeller
+
+
+def estimate_nwaters_from_positions(positions, padding,
+                                    exclusion_radius=0.3 * unit.nanometers,
+                                    water_density=32.3 / unit.nanometers**3,
+                                    grid_spacing=0.1 * unit.nanometers):
+    """
+    Estimate the number of waters which Modeller.addSolvent would add to a model, without actually
+    solvating it.
+
+    As with addSolvent, the box is taken to be a cube with edge length equal to the largest
+    dimension of the solute bounding box plus twice the padding distance. The volume excluded by
+    the solute is calculated as the union of spheres (of radius exclusion_radius) around each atom,
+    on a grid. The default water density is an effective density for TIP3P, which has been
+    calibrated against addSolvent (and which is accordingly somewhat lower than the bulk density).
+
+    Parameters
+    ----------
+    positions: simtk.unit.Quantity wrapping a list of Vec3 or an (natoms, 3) array
+    padding: simtk.unit.Quantity
+    exclusion_radius: simtk.unit.Quantity
+    water_density: simtk.unit.Quantity
+        number of waters per unit volume
+    grid_spacing: simtk.unit.Quantity
+
+    Returns
+    -------
+    nwaters: float
+    """
+    positions = np.array(positions.value_in_unit(unit.nanometers), dtype=float)
+    padding = padding.value_in_unit(unit.nanometers)
+    exclusion_radius = exclusion_radius.value_in_unit(unit.nanometers)
+    grid_spacing = grid_spacing.value_in_unit(unit.nanometers)
+    water_density = water_density.value_in_unit(unit.nanometers**-3)
+
+    box_edge = (positions.max(axis=0) - positions.min(axis=0)).max() + 2 * padding
+
+    # Grid offsets of all points within exclusion_radius of an atom.
+    radius_in_grid_points = int(np.ceil(exclusion_radius / grid_spacing))
+    offsets = np.mgrid[
+        -radius_in_grid_points:radius_in_grid_points+1,
+        -radius_in_grid_points:radius_in_grid_points+1,
+        -radius_in_grid_points:radius_in_grid_points+1,
+    ].reshape(3, -1).T
+    offsets = offsets[np.sum((offsets * grid_spacing)**2, axis=1) <= exclusion_radius**2]
+
+    origin = positions.min(axis=0) - (radius_in_grid_points + 1) * grid_spacing
+    atom_grid_points = np.floor((positions - origin) / grid_spacing).astype(int)
+    grid_shape = atom_grid_points.max(axis=0) + radius_in_grid_points + 2
+    excluded_grid_points = (atom_grid_points[:, np.newaxis, :] + offsets[np.newaxis, :, :]).reshape(-1, 3)
+    nexcluded_grid_points = np.unique(np.ravel_multi_index(excluded_grid_points.T, grid_shape)).size
+    excluded_volume = nexcluded_grid_points * grid_spacing**3
+
+    return water_density * (box_edge**3 - excluded_volume)
+
+
+def select_evenly_spaced_sample(items, nsamples):
+    """
+    Examples
+    --------
+    >>> select_evenly_spaced_sample(['a', 'b', 'c', 'd', 'e', 'f'], 3)
+    ['a', 'c', 'e']
+    """
+    if nsamples >= len(items):
+        return list(items)
+    return [items[(i * len(items)) // nsamples] for i in range(nsamples)]
+
+
+def solvate_to_nwaters(topology, positions, target_nwaters, forcefield, water_model='tip3p',
+                       water_density=32.3 / unit.nanometers**3,
+                       box_oversize_factor=1.1,
+                       boundary_gap=0.3 * unit.nanometers,
+                       nonbonded_cutoff=1.0 * unit.nanometers,
+                       verbose=False):
+    """
+    Solvate a model with exactly target_nwaters waters, in a cubic box.
+
+    Unlike the iterative approach used previously, addSolvent is called only once, on a box which
+    is somewhat larger than required. Water molecules are then ranked by the distance of their
+    oxygen atoms from the box boundary, and the target_nwaters waters furthest from the boundary
+    are retained, together with any counterions added by addSolvent (which are relocated onto the
+    sites of randomly selected retained waters). The box is then shrunk to fit the retained waters.
+
+    Parameters
+    ----------
+    topology: simtk.openmm.app.Topology
+    positions: simtk.unit.Quantity
+    target_nwaters: int
+    forcefield: simtk.openmm.app.ForceField
+    water_model: str
+    water_density: simtk.unit.Quantity
+        effective water density, used to size the initial box
+    box_oversize_factor: float
+        initial box edge length as a multiple of the edge length estimated to be required
+    boundary_gap: simtk.unit.Quantity
+        added to the edge length of the final box. This is the separation between the outermost
+        retained water oxygens and their periodic images across each box face, so should be at
+        least the water-water contact distance.
+    nonbonded_cutoff: simtk.unit.Quantity
+        an exception is raised if the final box edge length does not exceed the solute extent
+        plus twice this cutoff (default: the OpenMM default cutoff, as used by
+        refine_explicit_md)
+
+    Returns
+    -------
+    positions: simtk.unit.Quantity
+    topology: simtk.openmm.app.Topology
+    """
+    nresidues_initial = topology.getNumResidues()
+    solute_positions = np.array(positions.value_in_unit(unit.nanometers), dtype=float)
+    solute_extent = (solute_positions.max(axis=0) - solute_positions.min(axis=0)).max()
+    density = water_density.value_in_unit(unit.nanometers**-3)
+
+    # Volume excluded by the solute, in a box with zero padding.
+    nwaters_unpadded = estimate_nwaters_from_positions(positions, 0.0 * unit.nanometers, water_density=water_density)
+    excluded_volume = solute_extent**3 - nwaters_unpadded / density
+
+    box_edge = (target_nwaters / density + excluded_volume)**(1.0/3.0)
+    box_edge = max(box_edge, solute_extent) * box_oversize_factor
+
+    while True:
+        if verbose: print("Solvating with box edge length %.3f nm..." % box_edge)
+        modeller = app.Modeller(topology, positions)
+        modeller.addSolvent(forcefield, model=water_model, boxSize=openmm.Vec3(box_edge, box_edge, box_edge) * unit.nanometers)
+
+        solvent_residues = list(modeller.topology.residues())[nresidues_initial:]
+        water_residues = [residue for residue in solvent_residues if residue.name == 'HOH']
+        ion_residues = [residue for residue in solvent_residues if residue.name != 'HOH']
+        if len(water_residues) >= target_nwaters + len(ion_residues):
+            break
+        box_edge *= box_oversize_factor
+
+    # The solute is centered in the box by addSolvent.
+    box_center = np.array([box_edge / 2.0] * 3)
+    return trim_solvent_to_nwaters(
+        modeller, nresidues_initial, box_center, target_nwaters,
+        boundary_gap=boundary_gap, nonbonded_cutoff=nonbonded_cutoff, verbose=verbose
+    )
+
+
+def trim_solvent_to_nwaters(modeller, nresidues_initial, box_center, target_nwaters,
+                            boundary_gap=0.3 * unit.nanometers,
+                            nonbonded_cutoff=1.0 * unit.nanometers,
+                            verbose=False):
+    """
+    Trim the solvent of a solvated model to exactly target_nwaters waters, retaining those furthest
+    from the boundary of the cubic box centered on box_center, and shrink the box accordingly.
+
+    Any counterions are relocated onto the sites of randomly selected retained waters.
+
+    Parameters
+    ----------
+    modeller: simtk.openmm.app.Modeller
+        solvated model; modified in place
+    nresidues_initial: int
+        number of (solute) residues preceding the solvent
+    box_center: np.array (3,)
+        in nm
+    target_nwaters: int
+    boundary_gap: simtk.unit.Quantity
+        see solvate_to_nwaters
+    nonbonded_cutoff: simtk.unit.Quantity
+        see solvate_to_nwaters
+
+    Returns
+    -------
+    positions: simtk.unit.Quantity
+    topology: simtk.openmm.app.Topology
+    """
+    solvent_residues = list(modeller.topology.residues())[nresidues_initial:]
+    water_residues = [residue for residue in solvent_residues if residue.name == 'HOH']
+    ion_residues = [residue for residue in solvent_residues if residue.name != 'HOH']
+    if len(water_residues) < target_nwaters + len(ion_residues):
+        raise Exception('Too few waters to trim: %d waters and %d ions present, target_nwaters = %d' % (len(water_residues), len(ion_residues), target_nwaters))
+
+    solvated_positions = np.array(modeller.positions.value_in_unit(unit.nanometers), dtype=float)
+    oxygen_indices = np.array([
+        [atom.index for atom in residue.atoms() if atom.element.symbol == 'O'][0] for residue in water_residues
+    ])
+
+    nions = len(ion_residues)
+    kept_water_indices, half_edge = select_waters_furthest_from_box_boundary(
+        solvated_positions[oxygen_indices], box_center, target_nwaters + nions
+    )
+    if verbose: print("Retaining %d of %d waters..." % (target_nwaters, len(water_residues)))
+
+    # Relocate ions onto randomly selected retained waters, which are then deleted.
+    replaced_water_indices = np.random.permutation(kept_water_indices)[:nions]
+    for ion_residue, water_index in zip(ion_residues, replaced_water_indices):
+        for atom in ion_residue.atoms():
+            solvated_positions[atom.index] = solvated_positions[oxygen_indices[water_index]]
+
+    retained_water_mask = np.zeros(len(water_residues), dtype=bool)
+    retained_water_mask[kept_water_indices] = True
+    retained_water_mask[replaced_water_indices] = False
+    residues_to_delete = [residue for residue, retained in zip(water_residues, retained_water_mask) if not retained]
+    deleted_atom_mask = np.zeros(len(solvated_positions), dtype=bool)
+    for residue in residues_to_delete:
+        for atom in residue.atoms():
+            deleted_atom_mask[atom.index] = True
+
+    # Delete all surplus waters in a single call.
+    modeller.delete(residues_to_delete)
+
+    final_box_edge = 2.0 * half_edge + boundary_gap.value_in_unit(unit.nanometers)
+
+    # The solute must not interact with its own periodic images.
+    nsolute_atoms = sum([len(list(residue.atoms())) for residue in list(modeller.topology.residues())[:nresidues_initial]])
+    solute_positions = solvated_positions[:nsolute_atoms]
+    solute_extent = (solute_positions.max(axis=0) - solute_positions.min(axis=0)).max()
+    min_box_edge = solute_extent + 2.0 * nonbonded_cutoff.value_in_unit(unit.nanometers)
+    if final_box_edge <= min_box_edge:
+        raise Exception(
+            'Box edge length %.3f nm with %d waters does not exceed solute extent plus twice the nonbonded cutoff (%.3f nm)'
+            % (final_box_edge, target_nwaters, min_box_edge)
+        )
+    final_positions = solvated_positions[~deleted_atom_mask] - (box_center - final_box_edge / 2.0)
+    final_topology = modeller.getTopology()
+    final_topology.setUnitCellDimensions(openmm.Vec3(final_box_edge, final_box_edge, final_box_edge) * unit.nanometers)
+
+    nwaters = len([residue for residue in final_topology.residues() if residue.name == 'HOH'])
+    if nwaters != target_nwaters:
+        raise Exception("Malfunction in trim_solvent_to_nwaters: nwaters = %d, target_nwaters = %d" % (nwaters, target_nwaters))
+
+    final_positions = [openmm.Vec3(*xyz) for xyz in final_positions] * unit.nanometers
+    return final_positions, final_topology
+
+
+def select_waters_furthest_from_box_boundary(oxygen_positions, box_center, nwaters):
+    """
+    Select the nwaters waters furthest from the boundary of a cubic box, i.e. those with the
+    smallest Chebyshev distance from the box center.
+
+    Parameters
+    ----------
+    oxygen_positions: np.array (nwaters_total, 3)
+    box_center: np.array (3,)
+    nwaters: int
+
+    Returns
+    -------
+    water_indices: np.array
+        indices of selected waters, in ascending order
+    half_edge: float
+        half the edge length of the smallest cube (centered on box_center) containing all selected
+        water oxygens
+    """
+    distances = np.abs(np.asarray(oxygen_positions) - box_center).max(axis=1)
+    if nwaters == 0:
+        return np.array([], dtype=int), 0.0
+    if nwaters < len(distances):
+        water_indices = np.argpartition(distances, nwaters - 1)[:nwaters]
+    else:
+        water_indices = np.arange(len(distances))
+    return np.sort(water_indices), distances[water_indices].max()
+
+
+@ensembler.core.batch_metadata_writes
 def determine_nwaters(process_only_these_targets=None,
                       process_only_these_templates=None, template_seqid_cutoff=None,
                       verbose=False,
@@ -668,14 +1504,38 @@ def refine_explicit_md(
         write_solvated_model=False,
         cpu_platform_threads=1,
         retry_failed_runs=False,
-        serialize_at_start_of_each_sim=False):
+        serialize_at_start_of_each_sim=False,
+        solvation_method='oneshot',
+        reuse_solvated_models=True,
+        deduplicate_serialized_xml=True):
     '''Run MD refinement in explicit solvent.
 
+    Each model is solvated with the number of waters given in models/[target_id]/nwaters-use.txt.
+    solvation_method selects between a single oversized solvation followed by trimming
+    ('oneshot'; see solvate_to_nwaters) and the original iterative box-resizing procedure
+    ('iterative'). With the 'oneshot' method, if reuse_solvated_models is True and solvate_models
+    has saved a solvated model with sufficient waters (solvated-model.npz), that model is trimmed
+    instead.
+
+    If deduplicate_serialized_xml is True, the serialized System and Integrator files in each model
+    directory are hardlinks into a content-addressed store (models/.xml-store), so that identical
+    files are stored only once. Since each model is solvated in a box of a different size, the
+    default periodic box vectors of the serialized System are then replaced by placeholder values
+    (see serialize_system_without_box); the box vectors of each model are those held in
+    explicit-state.xml.
+
     MPI-enabled.
     '''
+    if solvation_method not in ['oneshot', 'iterative']:
+        raise Exception("solvation_method must be 'oneshot' or 'iterative'")
+
     gpuid = mpistate.rank % gpupn
 
     models_dir = os.path.abspath(ensembler.core.default_project_dirnames.models)
+    if deduplicate_serialized_xml:
+        xml_store_dir = os.path.join(models_dir, ensembler.core.xml_store_dirname)
+    else:
+        xml_store_dir = None
 
     targets, templates_resolved_seq = ensembler.core.get_targets_and_templates()
 
@@ -812,13 +1672,6 @@ def refine_explicit_md(
 
         if (nwaters != target_nwaters):
             raise Exception("Malfunction in solvate_pdb: nwaters = %d, target_nwaters = %d" % (nwaters, target_nwaters))
-        else:
-            if write_solvated_model:
-                # write solvated pdb file
-                with open(os.path.join(model_dir, 'model-solvated.pdb'), 'w') as pdb_outfile:
-                    app.PDBFile.writeHeader(topology, file=pdb_outfile)
-                    app.PDBFile.writeFile(topology, positions, file=pdb_outfile)
-                    app.PDBFile.writeFooter(topology, file=pdb_outfile)
 
         return [positions, topology]
 
@@ -833,7 +1686,8 @@ def refine_explicit_md(
                 platform.setPropertyDefaultValue('OpenCLDeviceIndex', '%d' % gpuid)
 
         if verbose: print("Constructing System object...")
-        system = forcefield.createSystem(topology, nonbondedMethod=nonbondedMethod, constraints=app.HBonds)
+        with tracer.span('create_system'):
+            system = forcefield.createSystem(topology, nonbondedMethod=nonbondedMethod, constraints=app.HBonds)
         if verbose: print("  system has %d atoms" % (system.getNumParticles()))
 
         # Add barostat.
@@ -842,12 +1696,14 @@ def refine_explicit_md(
         system.addForce(barostat)
 
         if verbose: print("Creating Context...")
-        integrator = openmm.LangevinIntegrator(temperature, collision_rate, timestep)
-        context = openmm.Context(system, integrator, platform, platform_properties)
-        context.setPositions(positions)
+        with tracer.span('create_context'):
+            integrator = openmm.LangevinIntegrator(temperature, collision_rate, timestep)
+            context = openmm.Context(system, integrator, platform, platform_properties)
+            context.setPositions(positions)
 
         if verbose: print("Minimizing structure...")
-        openmm.LocalEnergyMinimizer.minimize(context, minimization_tolerance, minimization_steps)
+        with tracer.span('minimization'):
+            openmm.LocalEnergyMinimizer.minimize(context, minimization_tolerance, minimization_steps)
 
         if write_trajectory:
             # Open trajectory for writing.
@@ -878,7 +1734,8 @@ def refine_explicit_md(
 
         for iteration in range(niterations):
             # integrate dynamics
-            integrator.step(nsteps_per_iteration)
+            with tracer.span('dynamics'):
+                integrator.step(nsteps_per_iteration)
             # get current state
             state = context.getState(getEnergy=True)
             simulation_time = state.getTime()
@@ -890,6 +1747,8 @@ def refine_explicit_md(
             box_vectors = state.getPeriodicBoxVectors()
             volume_in_nm3 = (box_vectors[0][0] * box_vectors[1][1] * box_vectors[2][2]) / (unit.nanometers**3) # TODO: Use full determinant
             remaining_time = elapsed_time * (niterations-iteration-1) / (iteration+1)
+            metrics.set('ensembler_ns_per_day', ns_per_day, stage='refine_explicit_md')
+            metrics.maybe_write()
             if verbose: print("  %8.1f ps : potential %8.3f kT | kinetic %8.3f kT | volume %.3f nm^3 | %.3f ns/day | %.3f s remain" % (simulation_time / unit.picoseconds, potential_energy / kT, kinetic_energy / kT, volume_in_nm3, ns_per_day, remaining_time / unit.seconds))
 
             if write_trajectory:
@@ -907,26 +1766,37 @@ def refine_explicit_md(
         energy_outfile.close()
 
         state = context.getState(getPositions=True, enforcePeriodicBox=True)
-        with gzip.open(pdb_filename, 'w') as pdb_outfile:
-            app.PDBFile.writeHeader(topology, file=pdb_outfile)
-            app.PDBFile.writeFile(topology, state.getPositions(), file=pdb_outfile)
-            app.PDBFile.writeFooter(topology, file=pdb_outfile)
-
-        # Serialize system
+        with tracer.span('compression'):
+            with gzip.open(pdb_filename, 'w') as pdb_outfile:
+                app.PDBFile.writeHeader(topology, file=pdb_outfile)
+                app.PDBFile.writeFile(topology, state.getPositions(), file=pdb_outfile)
+                app.PDBFile.writeFooter(topology, file=pdb_outfile)
+
+        # Serialize system and integrator. These are often identical between models, so they are
+        # written to a content-addressed store and hardlinked into the model directory.
         if verbose: print("Serializing system...")
-        with gzip.open(system_filename+'.gz', 'w') as system_file:
-            system_file.write(openmm.XmlSerializer.serialize(system))
+        with tracer.span('serialization'):
+            if xml_store_dir is not None:
+                serialized_system = serialize_system_without_box(system)
+            else:
+                serialized_system = openmm.XmlSerializer.serialize(system)
+        with tracer.span('compression'):
+            write_serialized_xml(serialized_system, system_filename+'.gz', xml_store_dir)
 
-        # Serialize integrator.
         if verbose: print("Serializing integrator...")
-        with gzip.open(integrator_filename+'.gz', 'w') as integrator_file:
-            integrator_file.write(openmm.XmlSerializer.serialize(integrator))
+        with tracer.span('serialization'):
+            serialized_integrator = openmm.XmlSerializer.serialize(integrator)
+        with tracer.span('compression'):
+            write_serialized_xml(serialized_integrator, integrator_filename+'.gz', xml_store_dir)
 
         # Serialize state.
         if verbose: print("Serializing state...")
-        state = context.getState(getPositions=True, getVelocities=True, getForces=True, getEnergy=True, getParameters=True, enforcePeriodicBox=True)
-        with gzip.open(state_filename+'.gz', 'w') as state_file:
-            state_file.write(openmm.XmlSerializer.serialize(state))
+        with tracer.span('serialization'):
+            state = context.getState(getPositions=True, getVelocities=True, getForces=True, getEnergy=True, getParameters=True, enforcePeriodicBox=True)
+            serialized_state = openmm.XmlSerializer.serialize(state)
+        with tracer.span('compression'):
+            with gzip.open(state_filename+'.gz', 'w') as state_file:
+                state_file.write(serialized_state)
 
 
     for target in targets:
@@ -954,27 +1824,28 @@ def refine_explicit_md(
 
         for template_index in range(mpistate.rank, ntemplates_selected, mpistate.size):
             template = templates_resolved_seq[selected_template_indices[template_index]]
+            metrics.set('ensembler_queue_depth', len(range(template_index, ntemplates_selected, mpistate.size)), stage='refine_explicit_md', target=target.id)
+            metrics.maybe_write()
 
             model_dir = os.path.join(models_target_dir, template.id)
             if not os.path.exists(model_dir): continue
 
             # Pass if this simulation has already been run.
             log_filepath = os.path.join(model_dir, 'explicit-log.yaml')
-            if os.path.exists(log_filepath):
-                with open(log_filepath) as log_file:
-                    try:
-                        log_data = yaml.load(log_file, Loader=ensembler.core.YamlLoader)
-                        if log_data.get('successful') is True:
-                            continue
-                        if log_data.get('finished') is True and (retry_failed_runs is False and log_data.get('successful') is False):
-                            continue
-                    except ScannerError as e:
-                        trbk = traceback.format_exc()
-                        warnings.warn(
-                            '= WARNING start: template {0} MPI rank {1} hostname {2} gpuid {3} =\n{4}\n{5}\n= WARNING end: template {0} MPI rank {1} hostname {2} gpuid {3}'.format(
-                                template.id, mpistate.rank, socket.gethostname(), gpuid, e, trbk
-                            )
-                        )
+            try:
+                log_data = ensembler.runlog.load_model_log(log_filepath)
+                if log_data is not None:
+                    if log_data.get('successful') is True:
+                        continue
+                    if log_data.get('finished') is True and (retry_failed_runs is False and log_data.get('successful') is False):
+                        continue
+            except ScannerError as e:
+                trbk = traceback.format_exc()
+                warnings.warn(
+                    '= WARNING start: template {0} MPI rank {1} hostname {2} gpuid {3} =\n{4}\n{5}\n= WARNING end: template {0} MPI rank {1} hostname {2} gpuid {3}'.format(
+                        template.id, mpistate.rank, socket.gethostname(), gpuid, e, trbk
+                    )
+                )
 
             # Check to make sure the initial model file is present.
             model_filename = os.path.join(model_dir, 'implicit-refined.pdb.gz')
@@ -997,6 +1868,7 @@ def refine_explicit_md(
                 'gpuid': gpuid if 'CUDA_VISIBLE_DEVICES' not in os.environ else os.environ['CUDA_VISIBLE_DEVICES'],
                 'openmm_platform': openmm_platform,
                 'sim_length': '%s' % sim_length,
+                'solvation_method': solvation_method,
                 'finished': False,
                 }
             log_file = ensembler.core.LogFile(log_filepath)
@@ -1005,15 +1877,43 @@ def refine_explicit_md(
             try:
                 start = datetime.datetime.utcnow()
 
-                with gzip.open(model_filename) as model_file:
-                    pdb = app.PDBFile(model_file)
-
-                if not include_disulfide_bonds:
-                    remove_disulfide_bonds_from_topology(pdb.topology)
-
-                [positions, topology] = solvate_pdb(pdb, nwaters)
-
-                simulate_explicit_md()
+                with tracer.span('refine_explicit_md', target=target.id, template=template.id):
+                    with tracer.span('read_model'):
+                        with gzip.open(model_filename) as model_file:
+                            pdb = app.PDBFile(model_file)
+
+                    if not include_disulfide_bonds:
+                        remove_disulfide_bonds_from_topology(pdb.topology)
+
+                    with tracer.span('solvation'):
+                        solvated_model_filename = os.path.join(model_dir, 'solvated-model.npz')
+                        reuse_solvated_model = solvation_method == 'oneshot' and reuse_solvated_models and os.path.exists(solvated_model_filename)
+                        if reuse_solvated_model and read_solvated_model_source_sha1(solvated_model_filename) != ensembler.utils.sha1_of_file(model_filename):
+                            # e.g. the implicit refinement has been rerun since the model was solvated
+                            if verbose: print('Saved solvated model is out of date; solvating model...')
+                            os.remove(solvated_model_filename)
+                            reuse_solvated_model = False
+                        if reuse_solvated_model:
+                            modeller = read_solvated_model(solvated_model_filename, pdb.topology)
+                            box_center = np.array(modeller.topology.getUnitCellDimensions().value_in_unit(unit.nanometers)) / 2.0
+                            try:
+                                positions, topology = trim_solvent_to_nwaters(modeller, pdb.topology.getNumResidues(), box_center, nwaters, verbose=verbose)
+                            except Exception as e:
+                                if verbose: print('Could not reuse saved solvated model (%s); solvating model...' % e)
+                                positions, topology = solvate_to_nwaters(pdb.topology, pdb.positions, nwaters, forcefield, water_model=water_model, verbose=verbose)
+                        elif solvation_method == 'oneshot':
+                            positions, topology = solvate_to_nwaters(pdb.topology, pdb.positions, nwaters, forcefield, water_model=water_model, verbose=verbose)
+                        else:
+                            [positions, topology] = solvate_pdb(pdb, nwaters)
+
+                    if write_solvated_model:
+                        # write solvated pdb file
+                        with open(os.path.join(model_dir, 'model-solvated.pdb'), 'w') as pdb_outfile:
+                            app.PDBFile.writeHeader(topology, file=pdb_outfile)
+                            app.PDBFile.writeFile(topology, positions, file=pdb_outfile)
+                            app.PDBFile.writeFooter(topology, file=pdb_outfile)
+
+                    simulate_explicit_md()
 
                 timing = ensembler.core.strf_timedelta(datetime.datetime.utcnow() - start)
                 log_data = {
@@ -1022,6 +1922,7 @@ def refine_explicit_md(
                     'successful': True,
                     }
                 log_file.log(new_log_data=log_data)
+                metrics.inc('ensembler_models_completed_total', stage='refine_explicit_md', target=target.id)
 
             except Exception as e:
                 trbk = traceback.format_exc()
@@ -1039,6 +1940,10 @@ def refine_explicit_md(
                     'successful': False,
                     }
                 log_file.log(new_log_data=log_data)
+                metrics.inc('ensembler_models_failed_total', stage='refine_explicit_md', target=target.id)
+
+        metrics.set('ensembler_queue_depth', 0, stage='refine_explicit_md', target=target.id)
+        metrics.write()
 
         if verbose:
             print('Finished template loop: rank %d' % mpistate.rank)
@@ -1080,6 +1985,37 @@ def refine_explicit_md(
         print('Done.')
 
 
+def serialize_system_without_box(system):
+    """
+    Serialize an OpenMM System with its default periodic box vectors replaced by those of a newly
+    constructed System, so that Systems which differ only in their box size (e.g. models of the
+    same target solvated with the same number of waters) serialize identically. The System itself
+    is left unchanged.
+    """
+    box_vectors = system.getDefaultPeriodicBoxVectors()
+    system.setDefaultPeriodicBoxVectors(*openmm.System().getDefaultPeriodicBoxVectors())
+    try:
+        return openmm.XmlSerializer.serialize(system)
+    finally:
+        system.setDefaultPeriodicBoxVectors(*box_vectors)
+
+
+def write_serialized_xml(contents, filepath, xml_store_dir=None):
+    """
+    Write serialized OpenMM XML to a gzipped file. If xml_store_dir is given, the contents are
+    written to the content-addressed store (see ensembler.utils.write_content_addressed_file), and
+    filepath is hardlinked to the stored file.
+    """
+    if xml_store_dir is None:
+        if os.path.lexists(filepath):
+            os.remove(filepath)
+        with gzip.open(filepath, 'w') as xml_file:
+            xml_file.write(contents)
+    else:
+        stored_filepath = ensembler.utils.write_content_addressed_file(xml_store_dir, contents)
+        ensembler.utils.link_file(stored_filepath, filepath)
+
+
 def readFileContents(filename):
     import os.path
 
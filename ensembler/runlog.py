@@ -0,0 +1,286 @@
+"""
+Append-only run log for per-model log files (e.g. models/[targetid]/[templateid]/implicit-log.yaml).
+
+By default, each ensembler.core.LogFile update rewrites the whole YAML log file. When the run log
+is enabled (see enable_run_log), updates are instead appended as JSON-lines events to a single file
+per MPI rank, in the .run-logs directory at the top level of the project. Each event is written
+with a single append, so concurrent writers never interleave partial lines.
+
+The events can be read directly (see load_model_log and RunLogReader), or compacted into the
+per-model YAML log files (see compact_run_logs), which should be done while no stage is running.
+Events recorded before a YAML log file was last written (e.g. by a later run without the run log)
+are superseded by its contents.
+"""
+import os
+import json
+import time
+import socket
+import yaml
+import ensembler.utils
+from ensembler.core import mpistate, YamlLoader, YamlDumper, literal_str
+
+run_log_dirname = '.run-logs'
+
+run_log_filename_suffix = '.jsonl'
+
+
+def gen_run_log_dir(project_dir='.'):
+    return os.path.join(project_dir, run_log_dirname)
+
+
+def gen_run_log_key(log_filepath, project_dir='.'):
+    """
+    Run log events identify log files by their path relative to the project top-level directory.
+    """
+    return os.path.relpath(os.path.abspath(log_filepath), os.path.abspath(project_dir))
+
+
+def serialize_log_value(value):
+    """
+    Log data may contain objects which cannot be represented in JSON, e.g. exceptions.
+    """
+    if isinstance(value, Exception):
+        return '%s: %s' % (type(value).__name__, value)
+    return str(value)
+
+
+class RunLog(object):
+    def __init__(self, project_dir='.', rank=None, hostname=None):
+        """
+        Append-only writer for the run log of this MPI rank.
+
+        Parameters
+        ----------
+        project_dir : str
+        rank : int
+            default: the MPI rank
+        hostname : str
+            default: socket.gethostname()
+        """
+        if rank is None:
+            rank = mpistate.rank
+        if hostname is None:
+            hostname = socket.gethostname()
+        self.project_dir = project_dir
+        self.rank = rank
+        self.hostname = hostname
+        run_log_dir = gen_run_log_dir(project_dir)
+        ensembler.utils.create_dir(run_log_dir)
+        self.filepath = os.path.join(run_log_dir, 'run-%s-rank%d%s' % (hostname, rank, run_log_filename_suffix))
+        self.nevents = 0
+
+    def append(self, log_filepath, log_data, event='update'):
+        """
+        Parameters
+        ----------
+        log_filepath : str
+            Per-model YAML log file to which the event applies.
+        log_data : dict
+        event : str
+            'start' (log_data replaces any previous contents of the log file) or 'update' (the
+            log file contents are updated with log_data)
+        """
+        record = {
+            'log': gen_run_log_key(log_filepath, self.project_dir),
+            'event': event,
+            'time': time.time(),
+            'rank': self.rank,
+            'seq': self.nevents,
+            'data': log_data,
+        }
+        line = json.dumps(record, default=serialize_log_value) + '\n'
+        # O_APPEND positions each write at the end of the file, and the event is written with a
+        # single call, so events from other writers are never interleaved within a line.
+        fd = os.open(self.filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+        self.nevents += 1
+
+
+class RunLogReader(object):
+    def __init__(self, project_dir='.'):
+        """
+        Reads the run log events for a project. Each call to update() reads only the events
+        appended since the previous call.
+        """
+        self.project_dir = project_dir
+        self.run_log_dir = gen_run_log_dir(project_dir)
+        self.file_offsets = {}
+        self.file_events = {}
+        self.events_by_log = {}
+
+    def update(self):
+        """
+        Returns
+        -------
+        events_by_log : dict of {str: list of dict}
+            Events for each log file (see gen_run_log_key), sorted by time.
+        """
+        if not os.path.exists(self.run_log_dir):
+            if self.file_offsets:
+                self.__init__(self.project_dir)
+            return self.events_by_log
+
+        filenames = [filename for filename in os.listdir(self.run_log_dir) if filename.endswith(run_log_filename_suffix)]
+        # run log files are only removed or truncated by compaction, after which all events are
+        # regrouped; otherwise only the logs touched by newly read events are updated
+        rebuild = len(set(self.file_offsets) - set(filenames)) > 0
+        new_events = []
+        for filename in filenames:
+            filepath = os.path.join(self.run_log_dir, filename)
+            size = os.path.getsize(filepath)
+            offset = self.file_offsets.get(filename, 0)
+            if size < offset:
+                # file has been compacted and recreated since it was last read
+                offset = 0
+                self.file_events[filename] = []
+                rebuild = True
+            if size == offset:
+                continue
+            with open(filepath, 'rb') as run_log_file:
+                run_log_file.seek(offset)
+                contents = run_log_file.read()
+            # ignore any partially written final line, which will be read next time
+            complete_length = contents.rfind(b'\n') + 1
+            events = self.file_events.setdefault(filename, [])
+            for line in contents[:complete_length].decode('utf-8').splitlines():
+                if line.strip():
+                    event = json.loads(line)
+                    events.append(event)
+                    new_events.append(event)
+            self.file_offsets[filename] = offset + complete_length
+
+        for filename in set(self.file_offsets) - set(filenames):
+            del self.file_offsets[filename]
+            del self.file_events[filename]
+
+        if rebuild:
+            self.events_by_log = {}
+            new_events = [event for filename in sorted(self.file_events) for event in self.file_events[filename]]
+        touched_logs = set()
+        for event in new_events:
+            self.events_by_log.setdefault(event['log'], []).append(event)
+            touched_logs.add(event['log'])
+        for log in touched_logs:
+            self.events_by_log[log].sort(key=lambda x: (x['time'], x['rank'], x['seq']))
+        return self.events_by_log
+
+    def get_events(self, log_filepath):
+        return self.update().get(gen_run_log_key(log_filepath, self.project_dir), [])
+
+
+def merge_log_events(events, log_data=None):
+    """
+    Applies a sequence of run log events to the contents of a log file.
+
+    Parameters
+    ----------
+    events : list of dict
+    log_data : dict or None
+        Contents of the existing YAML log file, if any.
+
+    Returns
+    -------
+    log_data : dict or None
+    """
+    for event in events:
+        if event['event'] == 'start' or log_data is None:
+            log_data = {}
+        log_data.update(event['data'])
+    if log_data is not None and 'traceback' in log_data and log_data['traceback'] is not None:
+        log_data['traceback'] = literal_str(log_data['traceback'])
+    return log_data
+
+
+def discard_superseded_events(events, log_filepath):
+    """
+    Discards events recorded before the YAML log file was last written, e.g. by a later run
+    without the run log (or by compaction), whose contents supersede them.
+    """
+    try:
+        log_mtime = os.path.getmtime(log_filepath)
+    except OSError:
+        return events
+    return [event for event in events if event['time'] > log_mtime]
+
+
+def read_yaml_log_file(log_filepath):
+    if not os.path.exists(log_filepath):
+        return None
+    with open(log_filepath) as log_file:
+        return yaml.load(log_file, Loader=YamlLoader)
+
+
+_readers = {}
+
+
+def get_run_log_reader(project_dir='.'):
+    project_dir = os.path.abspath(project_dir)
+    if project_dir not in _readers:
+        _readers[project_dir] = RunLogReader(project_dir)
+    return _readers[project_dir]
+
+
+def load_model_log(log_filepath, project_dir='.'):
+    """
+    Returns the contents of a per-model log file, including any updates recorded in the run log,
+    or None if neither exists.
+    """
+    events = discard_superseded_events(get_run_log_reader(project_dir).get_events(log_filepath), log_filepath)
+    if events and events[0]['event'] == 'start':
+        return merge_log_events(events)
+    return merge_log_events(events, log_data=read_yaml_log_file(log_filepath))
+
+
+def compact_run_logs(project_dir='.'):
+    """
+    Writes the run log events to the per-model YAML log files, then removes the run log files.
+    Should not be run while any stage is writing to the run log.
+
+    Returns
+    -------
+    nlogs : int
+        Number of YAML log files written
+    """
+    reader = RunLogReader(project_dir)
+    events_by_log = reader.update()
+    nlogs = 0
+    for key, events in events_by_log.items():
+        log_filepath = os.path.join(project_dir, key)
+        events = discard_superseded_events(events, log_filepath)
+        if not events:
+            continue
+        if events[0]['event'] == 'start':
+            log_data = merge_log_events(events)
+        else:
+            log_data = merge_log_events(events, log_data=read_yaml_log_file(log_filepath))
+        temp_filepath = '%s.%d.tmp' % (log_filepath, os.getpid())
+        with open(temp_filepath, 'w') as log_file:
+            yaml.dump(log_data, log_file, default_flow_style=False, Dumper=YamlDumper)
+        os.rename(temp_filepath, log_filepath)
+        nlogs += 1
+
+    for filename in reader.file_offsets:
+        os.remove(os.path.join(reader.run_log_dir, filename))
+    _readers.pop(os.path.abspath(project_dir), None)
+    return nlogs
+
+
+run_log = None
+
+
+def enable_run_log(project_dir='.'):
+    """
+    Directs subsequent ensembler.core.LogFile updates to the run log for this MPI rank.
+    """
+    global run_log
+    run_log = RunLog(project_dir)
+    return run_log
+
+
+def disable_run_log():
+    global run_log
+    run_log = None
+
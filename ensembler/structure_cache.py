@@ -0,0 +1,244 @@
+import os
+import time
+import shutil
+import tempfile
+import contextlib
+import ensembler
+import ensembler.utils
+from ensembler.core import logger
+
+
+structure_cache_env_var = 'ENSEMBLER_STRUCTURE_CACHE'
+
+structure_type_file_extensions = {
+    'pdb': '.pdb.gz',
+    'sifts': '.xml.gz',
+}
+
+
+def get_default_structure_cache_dir():
+    """
+    The structure cache directory can be set with the ENSEMBLER_STRUCTURE_CACHE environment
+    variable, so that it is shared across projects by default.
+    """
+    return os.environ.get(structure_cache_env_var)
+
+
+class StructureCache(object):
+    """
+    On-disk cache of PDB and SIFTS files, shared across projects.
+
+    Files are stored as [cache_dir]/[structure_type]/[pdbid][extension]. An index file
+    ([cache_dir]/index.json) maps each structure type and PDB ID to the cached file, its size, sha1
+    checksum and last access time, so that lookups do not require scanning the cache directory.
+    Updates to the index are serialized with a lock file and written atomically, so the cache can be
+    used by several projects concurrently.
+
+    If max_size (bytes) is set, least recently used files are evicted when the cache grows beyond
+    that size.
+
+    Parameters
+    ----------
+    cache_dir: str
+    max_size: int or None
+    """
+    index_filename = 'index.json'
+    lock_filename = 'index.lock'
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        for structure_type in structure_type_file_extensions:
+            ensembler.utils.create_dir(os.path.join(self.cache_dir, structure_type))
+        self.index_filepath = os.path.join(self.cache_dir, self.index_filename)
+        self.lock_filepath = os.path.join(self.cache_dir, self.lock_filename)
+
+    @contextlib.contextmanager
+    def _locked_index(self, write=True):
+        with ensembler.utils.locked_json_file(self.index_filepath, self.lock_filepath, write=write) as index:
+            for structure_type in structure_type_file_extensions:
+                index.setdefault(structure_type, {})
+            yield index
+
+    def gen_cache_filepath(self, pdbid, structure_type):
+        return os.path.join(self.cache_dir, structure_type, pdbid + structure_type_file_extensions[structure_type])
+
+    def lookup(self, pdbid, structure_type, verify_checksum=False):
+        """
+        Returns
+        -------
+        filepath: str or None
+            Path of the cached file, or None if the file is not cached (or if the cached file does
+            not match the size - or optionally the checksum - recorded in the index, in which case
+            it is removed from the cache).
+        """
+        with self._locked_index() as index:
+            return self._lookup(index, pdbid, structure_type, verify_checksum=verify_checksum)
+
+    def _lookup(self, index, pdbid, structure_type, verify_checksum=False):
+        entry = index[structure_type].get(pdbid)
+        if entry is None:
+            return None
+        filepath = os.path.join(self.cache_dir, entry['filename'])
+        if not self._entry_is_valid(entry, filepath, verify_checksum=verify_checksum):
+            logger.warning('Removing invalid structure cache entry: %s' % filepath)
+            del index[structure_type][pdbid]
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            return None
+        entry['last_access'] = time.time()
+        return filepath
+
+    def _entry_is_valid(self, entry, filepath, verify_checksum=False):
+        if not os.path.exists(filepath) or os.path.getsize(filepath) != entry['size']:
+            return False
+        if verify_checksum and ensembler.utils.sha1_of_file(filepath) != entry['sha1']:
+            return False
+        return True
+
+    def add(self, pdbid, structure_type, source_filepath, move=False):
+        """
+        Add a file to the cache.
+
+        Parameters
+        ----------
+        pdbid: str
+        structure_type: str
+            'pdb' or 'sifts'
+        source_filepath: str
+        move: bool
+            Move rather than copy the file into the cache.
+
+        Returns
+        -------
+        filepath: str
+            Path of the cached file.
+        """
+        return self.add_all([(pdbid, structure_type, source_filepath)], move=move)[0]
+
+    def add_all(self, items, move=False):
+        """
+        Add files to the cache, reading and writing the index only once.
+
+        Parameters
+        ----------
+        items: list of (pdbid, structure_type, source_filepath)
+        move: bool
+
+        Returns
+        -------
+        filepaths: list of str
+            Paths of the cached files.
+        """
+        staged = []
+        for pdbid, structure_type, source_filepath in items:
+            filepath = self.gen_cache_filepath(pdbid, structure_type)
+            temp_fd, temp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix='.tmp')
+            os.close(temp_fd)
+            if move:
+                shutil.move(source_filepath, temp_filepath)
+            else:
+                shutil.copyfile(source_filepath, temp_filepath)
+            os.chmod(temp_filepath, 0o644)
+            entry = {
+                'filename': os.path.relpath(filepath, self.cache_dir),
+                'size': os.path.getsize(temp_filepath),
+                'sha1': ensembler.utils.sha1_of_file(temp_filepath),
+                'last_access': time.time(),
+            }
+            staged.append((pdbid, structure_type, temp_filepath, filepath, entry))
+
+        with self._locked_index() as index:
+            for pdbid, structure_type, temp_filepath, filepath, entry in staged:
+                os.rename(temp_filepath, filepath)
+                index[structure_type][pdbid] = entry
+            if self.max_size is not None:
+                self._evict(index, self.max_size, keep=[(structure_type, pdbid) for pdbid, structure_type, _, _, _ in staged])
+        return [filepath for _, _, _, filepath, _ in staged]
+
+    def link(self, pdbid, structure_type, project_filepath):
+        """
+        Link a cached file into a project, if present in the cache (see link_all).
+
+        Returns
+        -------
+        linked: bool
+        """
+        return len(self.link_all([(pdbid, structure_type, project_filepath)])) == 0
+
+    def link_all(self, requests):
+        """
+        Link cached files into a project, reading and writing the index only once.
+
+        Files are hardlinked (or copied, if the project is on a different filesystem), rather than
+        symlinked, so that evicting a file from the cache does not affect projects which use it.
+
+        Parameters
+        ----------
+        requests: list of (pdbid, structure_type, project_filepath)
+
+        Returns
+        -------
+        not_linked: list of (pdbid, structure_type, project_filepath)
+            requests for files which are not in the cache
+        """
+        not_linked = []
+        with self._locked_index() as index:
+            for pdbid, structure_type, project_filepath in requests:
+                filepath = self._lookup(index, pdbid, structure_type)
+                if filepath is None:
+                    not_linked.append((pdbid, structure_type, project_filepath))
+                    continue
+                ensembler.utils.link_file(filepath, project_filepath)
+        return not_linked
+
+    def evict(self, max_size):
+        """
+        Remove least recently used files until the total size of the cache is at most max_size
+        (bytes).
+        """
+        with self._locked_index() as index:
+            self._evict(index, max_size)
+
+    def _evict(self, index, max_size, keep=()):
+        entries = [
+            (entry['last_access'], structure_type, pdbid, entry['size'])
+            for structure_type in index
+            for pdbid, entry in index[structure_type].items()
+        ]
+        total_size = sum([entry[3] for entry in entries])
+        for last_access, structure_type, pdbid, size in sorted(entries):
+            if total_size <= max_size:
+                break
+            if (structure_type, pdbid) in keep:
+                continue
+            filepath = os.path.join(self.cache_dir, index[structure_type][pdbid]['filename'])
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            del index[structure_type][pdbid]
+            total_size -= size
+            logger.debug('Evicted %s from structure cache' % filepath)
+
+    def verify(self):
+        """
+        Check the checksums of all cached files, removing any which do not match the index.
+
+        Returns
+        -------
+        invalid: list of (structure_type, pdbid)
+        """
+        invalid = []
+        with self._locked_index() as index:
+            for structure_type in index:
+                for pdbid, entry in list(index[structure_type].items()):
+                    filepath = os.path.join(self.cache_dir, entry['filename'])
+                    if not self._entry_is_valid(entry, filepath, verify_checksum=True):
+                        invalid.append((structure_type, pdbid))
+                        del index[structure_type][pdbid]
+                        if os.path.exists(filepath):
+                            os.remove(filepath)
+        return invalid
+
+    def size(self):
+        with self._locked_index(write=False) as index:
+            return sum([entry['size'] for structure_type in index for entry in index[structure_type].values()])
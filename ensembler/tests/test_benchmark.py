@@ -0,0 +1,43 @@
+import os
+import json
+import ensembler
+import ensembler.tools.benchmark
+from ensembler.core import default_project_dirnames
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+
+@attr('unit')
+def test_synthetic_project():
+    with enter_temp_dir():
+        project = ensembler.tools.benchmark.SyntheticProject('project', ntargets=3, ntemplates=3)
+        assert project.targetids == ['SYN0_HUMAN_D0', 'SYN1_HUMAN_D0', 'SYN2_HUMAN_D0']
+        assert project.templateids == ['SYN0_HUMAN_D0_4HNF_A', 'SYN1_HUMAN_D0_4KB8_D', 'SYN2_HUMAN_D0_4HNF_A']
+
+        os.chdir('project')
+        targets, templates_resolved_seq = ensembler.core.get_targets_and_templates()
+        assert [target.id for target in targets] == project.targetids
+        assert [template.id for template in templates_resolved_seq] == project.templateids
+        for templateid in project.templateids:
+            assert os.path.exists(os.path.join(default_project_dirnames.templates_structures_modeled_loops, templateid + '-pdbfixed.fasta'))
+        for targetid in project.targetids:
+            for templateid in project.templateids:
+                assert os.path.exists(os.path.join(default_project_dirnames.models, targetid, templateid, 'model.pdb.gz'))
+            with open(os.path.join(default_project_dirnames.models, targetid, 'unique-models.txt')) as unique_models_file:
+                assert unique_models_file.read().split() == project.templateids
+
+
+@attr('unit')
+def test_run_benchmarks():
+    with enter_temp_dir():
+        results = ensembler.tools.benchmark.run_benchmarks(
+            ntargets=2, ntemplates=2, stages=['metadata'], results_filepath='benchmark.json'
+        )
+        with open('benchmark.json') as results_file:
+            assert json.load(results_file) == results
+        assert results['openmm_platform'] == 'CPU'
+        assert len(results['stages']) == 1
+        stage_result = results['stages'][0]
+        assert stage_result['stage'] == 'metadata'
+        assert stage_result['status'] == 'succeeded'
+        assert stage_result['nitems'] == 2
@@ -0,0 +1,24 @@
+import sys
+import json
+import subprocess
+from nose.plugins.attrib import attr
+
+
+heavy_modules = ['simtk.openmm', 'mdtraj', 'msmbuilder', 'modeller', 'pandas', 'numpy', 'Bio', 'lxml']
+
+# Imports the CLI in a fresh interpreter, and reports any heavy dependencies which were loaded.
+import_cli_script = """\
+import sys
+import json
+import ensembler.cli
+print(json.dumps({
+    'heavy_modules_loaded': [module for module in %r if module in sys.modules],
+}))
+""" % heavy_modules
+
+
+@attr('unit')
+def test_cli_import_defers_heavy_dependencies():
+    output = subprocess.check_output([sys.executable, '-c', import_cli_script])
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    assert result['heavy_modules_loaded'] == []
@@ -0,0 +1,52 @@
+import numpy as np
+import ensembler.tools.energies
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+energies_header = '# iteration | simulation time (ps) | potential_energy (kT) | kinetic_energy (kT) | ns per day\n'
+
+
+def write_example_energies(filepath, niterations, partial_line=''):
+    with open(filepath, 'w') as energies_file:
+        energies_file.write(energies_header)
+        for iteration in range(niterations):
+            energies_file.write("  %8d %8.1f %8.3f %8.3f %.3f\n" % (iteration, iteration * 0.5, -1000. - iteration, 100. + iteration, 50.))
+        energies_file.write(partial_line)
+
+
+@attr('unit')
+def test_read_final_energy():
+    with enter_temp_dir():
+        write_example_energies('long.txt', 2000)
+        write_example_energies('header_only.txt', 0)
+        assert ensembler.tools.energies.read_final_energy('long.txt') == -2999.
+        assert ensembler.tools.energies.read_final_energy('long.txt', column='simulation_time') == 999.5
+        assert ensembler.tools.energies.read_final_energy('header_only.txt') is None
+        assert ensembler.tools.energies.read_final_energy('missing.txt') is None
+        assert ensembler.tools.energies.read_last_line('long.txt', blocksize=8).split()[0] == '1999'
+
+
+@attr('unit')
+def test_read_final_energy_ignores_incomplete_final_line():
+    with enter_temp_dir():
+        write_example_energies('running.txt', 3, partial_line='         3      1.5 -100')
+        write_example_energies('started.txt', 0, partial_line='         0      0.0 -100')
+        assert ensembler.tools.energies.read_final_energy('running.txt') == -1002.
+        assert ensembler.tools.energies.read_final_energy('started.txt') is None
+        last_line = ensembler.tools.energies.read_last_line('running.txt', blocksize=8, complete_only=True)
+        assert last_line.split()[0] == '2'
+        assert ensembler.tools.energies.read_last_line('running.txt').split()[0] == '3'
+
+
+@attr('unit')
+def test_load_energies():
+    with enter_temp_dir():
+        write_example_energies('a.txt', 3)
+        write_example_energies('b.txt', 5, partial_line='         5      2.5 -100')
+        write_example_energies('c.txt', 0)
+        energies = ensembler.tools.energies.load_energies(['a.txt', 'b.txt', 'c.txt', 'missing.txt'])
+        assert energies.shape == (4, 5)
+        assert np.all(energies[0, :3] == [-1000., -1001., -1002.])
+        assert np.all(np.isnan(energies[0, 3:]))
+        assert energies[1, 4] == -1004.
+        assert np.all(np.isnan(energies[2:]))
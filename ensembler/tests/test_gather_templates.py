@@ -50,3 +50,23 @@ def test_extract_residues_by_resnum_output():
     first_line = ofile_text[0: ofile_text.index('\n')]
     assert first_line == 'ATOM    175  N   TYR A  24      50.812  43.410  19.390  1.00 38.55           N  '
     ofile.close()
+
+
+@attr('unit')
+def test_extract_templates_from_pdb():
+    pdb_input_filepath = get_installed_resource_filename(os.path.join('resources', '3HLL.pdb.gz'))
+    templates = [Mock(), Mock()]
+    templates[0].chainid = 'A'
+    templates[0].resolved_pdbresnums = [str(x) for x in range(24, 50)]
+    templates[1].chainid = 'A'
+    templates[1].resolved_pdbresnums = [str(x) for x in range(40, 60)]
+    templates[1].resolved_pdbresnums[templates[1].resolved_pdbresnums.index('56')] = '56A'
+    ofiles = [StringIO(), StringIO()]
+    ensembler.pdb.extract_templates_from_pdb(ofiles, pdb_input_filepath, templates)
+
+    for template, ofile in zip(templates, ofiles):
+        single_template_ofile = StringIO()
+        ensembler.pdb.extract_residues_by_resnum(single_template_ofile, pdb_input_filepath, template)
+        assert ofile.getvalue() == single_template_ofile.getvalue()
+    # residues 40-49 are written to both templates
+    assert ' A  40 ' in ofiles[0].getvalue() and ' A  40 ' in ofiles[1].getvalue()
@@ -112,6 +112,85 @@ def test_attempt_symlink_structure_files():
         assert os.path.exists(project_pdb_filepath)
 
 
+@attr('unit')
+def test_parse_sifts_residue_table():
+    sifts_filepath = get_installed_resource_filename(
+        os.path.join('example_project', 'structures', 'sifts', '4AF3.xml.gz')
+    )
+    residue_table = ensembler.initproject.parse_sifts_residue_table(sifts_filepath)
+    assert sorted(residue_table.keys()) == ['A', 'D']
+
+    # compare against a full-tree XPath selection
+    siftsxml = ensembler.initproject.parse_sifts_xml(sifts_filepath)
+    ensembler.initproject.add_pdb_modified_xml_tags_to_residues(siftsxml)
+    residue_span = [50, 300]
+    selected_residues = siftsxml.xpath(
+        'entity/segment/listResidue/residue/crossRefDb[@dbSource="PDB"][@dbChainId="A"]'
+        '[../crossRefDb[@dbSource="UniProt"][@dbResNum >= "%d"][@dbResNum <= "%d"]]' % tuple(residue_span)
+    )
+    selected_mask, selected_resolved_mask = ensembler.initproject.select_sifts_domain_residues(
+        residue_table['A'], residue_span
+    )
+    assert list(residue_table['A']['pdb_resnums'][selected_mask]) == [r.get('dbResNum') for r in selected_residues]
+    assert 0 < selected_resolved_mask.sum() < selected_mask.sum()
+    assert not (selected_resolved_mask & ~residue_table['A']['observed']).any()
+
+
+@attr('unit')
+def test_parse_sifts_residue_table_multiple_uniprot_crossrefs():
+    import gzip
+    residue_xml = (
+        '<residue dbSource="PDBe" dbResNum="%d" dbResName="ALA">'
+        '<crossRefDb dbSource="PDB" dbResNum="%d" dbResName="ALA" dbChainId="A"/>'
+        '<crossRefDb dbSource="UniProt" dbAccessionId="P00001" dbResNum="%d" dbResName="A"/>'
+        '<crossRefDb dbSource="UniProt" dbAccessionId="P00002" dbResNum="%d" dbResName="A"/>'
+        '</residue>'
+    )
+    sifts_xml = '<entry><entity><segment><listResidue>%s%s</listResidue></segment></entity></entry>' % (
+        residue_xml % (1, 1, 1, 101), residue_xml % (2, 2, 2, 500)
+    )
+    with enter_temp_dir():
+        with gzip.open('1ABC.xml.gz', 'wb') as sifts_file:
+            sifts_file.write(sifts_xml.encode('utf-8'))
+        residue_table = ensembler.initproject.parse_sifts_residue_table('1ABC.xml.gz')
+    assert list(residue_table['A']['uniprot_resnums']) == [1., 2.]
+    # residues are selected if any of their UniProt crossrefs is within the span
+    selected_mask, selected_resolved_mask = ensembler.initproject.select_sifts_domain_residues(
+        residue_table['A'], [100, 200]
+    )
+    assert list(selected_mask) == [True, False]
+
+
+@attr('unit')
+def test_load_sifts_residue_table():
+    import shutil
+    import numpy as np
+    sifts_filepath = get_installed_resource_filename(
+        os.path.join('example_project', 'structures', 'sifts', '4AF3.xml.gz')
+    )
+    with enter_temp_dir():
+        shutil.copy(sifts_filepath, '4AF3.xml.gz')
+        residue_table = ensembler.initproject.load_sifts_residue_table('4AF3.xml.gz')
+        assert os.path.exists('4AF3.residues.npz')
+        cached_residue_table = ensembler.initproject.load_sifts_residue_table('4AF3.xml.gz')
+        assert sorted(cached_residue_table.keys()) == ['A', 'D']
+        for column_name, column in residue_table['A'].items():
+            np.testing.assert_array_equal(cached_residue_table['A'][column_name], column)
+
+        # a stale cache is regenerated once the SIFTS file changes
+        ensembler.initproject.write_sifts_residue_table_cache('4AF3.residues.npz', {}, np.array([0, 0, 0]))
+        os.utime('4AF3.xml.gz', (0, 0))
+        assert sorted(ensembler.initproject.load_sifts_residue_table('4AF3.xml.gz').keys()) == ['A', 'D']
+
+
+@attr('unit')
+def test_group_indices_by_pdbid():
+    assert ensembler.initproject.group_indices_by_pdbid(['4AF3', '1OPL', '4AF3', '2H8H']) == [
+        ('4AF3', [0, 2]), ('1OPL', [1]), ('2H8H', [3])
+    ]
+    assert ensembler.initproject.group_indices_by_pdbid([]) == []
+
+
 @attr('unit')
 def test_log_unique_domain_names():
     with open(
@@ -176,4 +255,23 @@ DKPDYSYLRQLFRNLF
         chainids = {'4KB8': ['A', 'D']}
         uniprot_domain_regex = '^Protein kinase'
         ensembler.initproject.gather_templates_from_pdb(pdbids, uniprot_domain_regex, chainids=chainids)
-        assert open(os.path.join(ensembler.core.default_project_dirnames.templates, 'templates-resolved-seq.fa')).read() == ref_templates_resolved_seq
\ No newline at end of file
+        assert open(os.path.join(ensembler.core.default_project_dirnames.templates, 'templates-resolved-seq.fa')).read() == ref_templates_resolved_seq
+
+@attr('unit')
+def test_extract_template_pdbchains_from_streamed_uniprot_entries():
+    uniprotxml_filepath = get_installed_resource_filename(os.path.join('resources', 'uniprot-CK1-kinases.xml'))
+    with open(uniprotxml_filepath) as uniprotxml_file:
+        uniprotxml = etree.fromstring(ensembler.uniprot.remove_uniprot_xmlns(uniprotxml_file.read()))
+    expected_pdbchains = ensembler.initproject.extract_template_pdbchains_from_uniprot_xml(
+        uniprotxml, uniprot_domain_regex='^Protein kinase'
+    )
+    assert len(expected_pdbchains) > 0
+
+    with enter_temp_dir():
+        uniprot_entries = ensembler.uniprot.iter_uniprot_entries(uniprotxml_filepath, write_to_filepath='copy.xml')
+        pdbchains = ensembler.initproject.extract_template_pdbchains_from_uniprot_xml(
+            uniprot_entries, uniprot_domain_regex='^Protein kinase'
+        )
+        with open(uniprotxml_filepath, 'rb') as uniprotxml_file, open('copy.xml', 'rb') as copy_file:
+            assert copy_file.read() == uniprotxml_file.read()
+    assert pdbchains == expected_pdbchains
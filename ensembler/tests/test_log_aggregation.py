@@ -0,0 +1,71 @@
+import os
+import time
+import yaml
+import ensembler.core
+import ensembler.runlog
+import ensembler.tools.log_aggregation
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+
+def write_example_log(log_filepath, log_data):
+    ensembler.utils.create_dir(os.path.dirname(log_filepath))
+    with open(log_filepath, 'w') as log_file:
+        yaml.dump(log_data, log_file, default_flow_style=False, Dumper=ensembler.core.YamlDumper)
+
+
+def gen_example_log_filepaths():
+    return [
+        os.path.join('models', 'EGFR_HUMAN_D0', templateid, 'implicit-log.yaml')
+        for templateid in ['TMPL_A', 'TMPL_B', 'TMPL_C']
+    ]
+
+
+@attr('unit')
+def test_aggregate_logs_reparses_only_changed_logs():
+    with enter_temp_dir():
+        log_filepaths = gen_example_log_filepaths()
+        write_example_log(log_filepaths[0], {'successful': True, 'timing': '0:01:00'})
+        write_example_log(log_filepaths[1], {'successful': False, 'exception': 'NaN'})
+
+        aggregator = ensembler.tools.log_aggregation.LogAggregator(cache_name='test', nprocesses=1)
+        df = aggregator.aggregate(log_filepaths)
+        assert aggregator.nparsed == 2
+        assert list(df.log_filepath) == log_filepaths[:2]
+        assert list(df.successful) == [True, False]
+        assert os.path.exists(os.path.join(ensembler.tools.log_aggregation.log_cache_dirname, 'test.pkl'))
+
+        aggregator = ensembler.tools.log_aggregation.LogAggregator(cache_name='test', nprocesses=1)
+        cached_df = aggregator.aggregate(log_filepaths)
+        assert aggregator.nparsed == 0
+        assert list(cached_df.successful) == [True, False]
+
+        # ensure the modified log file has a different mtime
+        time.sleep(0.01)
+        write_example_log(log_filepaths[1], {'successful': True, 'timing': '0:02:00'})
+        os.utime(log_filepaths[1], (time.time() + 10, time.time() + 10))
+        write_example_log(log_filepaths[2], {'successful': True})
+        aggregator = ensembler.tools.log_aggregation.LogAggregator(cache_name='test', nprocesses=1)
+        df = aggregator.aggregate(log_filepaths)
+        assert aggregator.nparsed == 2
+        assert list(df.log_filepath) == log_filepaths
+        assert list(df.successful) == [True, True, True]
+        assert list(df.timing[:2]) == ['0:01:00', '0:02:00']
+
+
+@attr('unit')
+def test_aggregate_logs_applies_run_log():
+    with enter_temp_dir():
+        log_filepaths = gen_example_log_filepaths()
+        write_example_log(log_filepaths[0], {'successful': False, 'finished': False})
+        run_log = ensembler.runlog.RunLog(rank=0)
+        run_log.append(log_filepaths[0], {'successful': True, 'finished': True})
+        run_log.append(log_filepaths[1], {'successful': True, 'finished': True}, event='start')
+
+        df = ensembler.tools.log_aggregation.aggregate_logs(log_filepaths, cache_name='test', nprocesses=1)
+        assert list(df.log_filepath) == log_filepaths[:2]
+        assert list(df.successful) == [True, True]
+
+        # the cache holds the contents of the YAML log files only
+        df = ensembler.tools.log_aggregation.LogAggregator(cache_name='test', apply_run_log=False).aggregate(log_filepaths)
+        assert list(df.successful) == [False]
@@ -0,0 +1,57 @@
+import os
+import json
+import ensembler.metrics
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+
+class ManualClock(object):
+    def __init__(self):
+        self.time = 1000.
+
+    def __call__(self):
+        return self.time
+
+
+def gen_example_metrics(filepath, metrics_format, clock):
+    metrics = ensembler.metrics.MetricsRecorder(
+        filepath=filepath, metrics_format=metrics_format, write_interval=60., rank=0, clock=clock
+    )
+    metrics.inc('ensembler_models_completed_total', stage='refine_implicit_md', target='EGFR_HUMAN_D0')
+    metrics.inc('ensembler_models_completed_total', stage='refine_implicit_md', target='EGFR_HUMAN_D0')
+    metrics.inc('ensembler_models_failed_total', stage='refine_implicit_md', target='EGFR_HUMAN_D0')
+    metrics.set('ensembler_ns_per_day', 52.5, stage='refine_implicit_md')
+    return metrics
+
+
+@attr('unit')
+def test_prometheus_metrics():
+    with enter_temp_dir():
+        clock = ManualClock()
+        metrics = gen_example_metrics('metrics.prom', 'prometheus', clock)
+        metrics.maybe_write()
+        with open('metrics.prom') as metrics_file:
+            metrics_text = metrics_file.read()
+        assert '# TYPE ensembler_models_completed_total counter' in metrics_text
+        assert 'ensembler_models_completed_total{rank="0",stage="refine_implicit_md",target="EGFR_HUMAN_D0"} 2.0' in metrics_text
+        assert 'ensembler_ns_per_day{rank="0",stage="refine_implicit_md"} 52.5' in metrics_text
+        assert 'ensembler_last_update_timestamp_seconds{rank="0"} 1000.0' in metrics_text
+        assert os.listdir('.') == ['metrics.prom']
+
+
+@attr('unit')
+def test_jsonl_metrics_writes_are_throttled():
+    with enter_temp_dir():
+        clock = ManualClock()
+        metrics = gen_example_metrics('metrics.jsonl', 'jsonl', clock)
+        metrics.maybe_write()
+        clock.time += 30.
+        metrics.set('ensembler_ns_per_day', 60., stage='refine_implicit_md')
+        metrics.maybe_write()
+        clock.time += 30.
+        metrics.maybe_write()
+        with open('metrics.jsonl') as metrics_file:
+            snapshots = [json.loads(line) for line in metrics_file]
+        assert [snapshot['timestamp'] for snapshot in snapshots] == [1000., 1060.]
+        ns_per_day = [metric['value'] for metric in snapshots[-1]['metrics'] if metric['name'] == 'ensembler_ns_per_day']
+        assert ns_per_day == [60.]
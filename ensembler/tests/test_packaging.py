@@ -0,0 +1,102 @@
+import os
+import gzip
+import tarfile
+import ensembler.packaging
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+
+@attr('unit')
+def test_copy_gzipped_file():
+    with enter_temp_dir():
+        with gzip.open('model.pdb.gz', 'wb') as model_file:
+            model_file.write(b'ATOM      1  N   ALA A   1\n')
+        ensembler.packaging.copy_gzipped_file('model.pdb.gz', 'model.pdb')
+        with open('model.pdb', 'rb') as model_file:
+            assert model_file.read() == b'ATOM      1  N   ALA A   1\n'
+
+
+@attr('unit')
+def test_archive_fah_run():
+    with enter_temp_dir():
+        os.makedirs(os.path.join('project', 'RUN0'))
+        with open(os.path.join('project', 'RUN0', 'system.xml'), 'w') as system_file:
+            system_file.write('<System/>\n')
+        ensembler.packaging.archive_fah_run('project', 0)
+        with tarfile.open(os.path.join('project', 'RUN0.tgz')) as archive_file:
+            assert 'project/RUN0/system.xml' in archive_file.getnames()
+
+
+@attr('unit')
+def test_extract_periodic_box_vectors_xml():
+    state_contents = '<State time="0"><PeriodicBoxVectors><A x="3" y="0" z="0"/></PeriodicBoxVectors><Positions/></State>'
+    assert ensembler.packaging.extract_periodic_box_vectors_xml(state_contents) == '<PeriodicBoxVectors><A x="3" y="0" z="0"/></PeriodicBoxVectors>'
+
+
+@attr('unit')
+def test_assign_fah_runs():
+    manifest = {'runs': [
+        {'run': 0, 'template_id': 'T_A', 'sequence_identity': 90.0, 'source_sha1s': {'f': 'a'}, 'nclones': 2},
+        {'run': 1, 'template_id': 'T_B', 'sequence_identity': 80.0, 'source_sha1s': {'f': 'b'}, 'nclones': 2},
+        {'run': 2, 'template_id': 'T_C', 'sequence_identity': 70.0, 'source_sha1s': {'f': 'c'}, 'nclones': 2},
+    ]}
+    source_sha1s_by_templateid = {'T_A': {'f': 'a'}, 'T_B': {'f': 'b2'}, 'T_D': {'f': 'd'}, 'T_E': {'f': 'e'}}
+    with enter_temp_dir():
+        for templateid, seqid in [('T_D', 50.0), ('T_E', 60.0)]:
+            os.mkdir(templateid)
+            with open(os.path.join(templateid, 'sequence-identity.txt'), 'w') as seqid_file:
+                seqid_file.write('%f\n' % seqid)
+
+        runs_to_build = ensembler.packaging.assign_fah_runs(manifest, source_sha1s_by_templateid, 2, '.')
+        assert [(run['run'], run['template_id'], run['changed']) for run in runs_to_build] == [
+            (1, 'T_B', True), (3, 'T_E', False), (4, 'T_D', False)
+        ]
+
+        runs_to_build = ensembler.packaging.assign_fah_runs(manifest, {'T_A': {'f': 'a'}}, 3, '.')
+        assert [(run['run'], run['changed'], run['nclones']) for run in runs_to_build] == [(0, False, 2)]
+
+
+@attr('unit')
+def test_write_and_read_fah_manifest():
+    manifest = {'runs': [{'run': 0, 'template_id': 'T_A', 'sequence_identity': 90.0, 'source_sha1s': {'f': 'a'}, 'nclones': 1}]}
+    with enter_temp_dir():
+        assert ensembler.packaging.read_fah_manifest('manifest.yaml') == {'runs': []}
+        ensembler.packaging.write_fah_manifest('manifest.yaml', manifest)
+        assert ensembler.packaging.read_fah_manifest('manifest.yaml') == manifest
+
+
+@attr('unit')
+def test_gen_fah_run_source_sha1s_uses_cache():
+    with enter_temp_dir():
+        for filename in ensembler.packaging.fah_run_source_filenames:
+            with open(filename, 'w') as source_file:
+                source_file.write(filename)
+        source_sha1s = ensembler.packaging.gen_fah_run_source_sha1s('.')
+        assert os.path.exists(ensembler.packaging.fah_run_source_sha1s_cache_filename)
+
+        # a cached hash is reused while the file size and mtime are unchanged
+        stat = os.stat('sequence-identity.txt')
+        with open('sequence-identity.txt', 'w') as source_file:
+            source_file.write('SEQUENCE-IDENTITY.TXT')
+        os.utime('sequence-identity.txt', (stat.st_atime, stat.st_mtime))
+        assert ensembler.packaging.gen_fah_run_source_sha1s('.') == source_sha1s
+
+        os.utime('sequence-identity.txt', (stat.st_atime, stat.st_mtime + 10))
+        assert ensembler.packaging.gen_fah_run_source_sha1s('.')['sequence-identity.txt'] != source_sha1s['sequence-identity.txt']
+
+
+@attr('unit')
+def test_check_fah_run_source():
+    with enter_temp_dir():
+        os.mkdir('RUN0')
+        assert not ensembler.packaging.check_fah_run_source('RUN0', 'T_A')
+        with open(os.path.join('RUN0', 'template.txt'), 'w') as template_file:
+            template_file.write('T_A\n')
+        assert ensembler.packaging.check_fah_run_source('RUN0', 'T_A')
+        assert not ensembler.packaging.check_fah_run_source('RUN0', 'T_B')
+        # no record of the source hashes
+        assert not ensembler.packaging.check_fah_run_source('RUN0', 'T_A', source_sha1s={'f': 'a'})
+        with open(os.path.join('RUN0', ensembler.packaging.fah_run_source_sha1s_filename), 'w') as source_sha1s_file:
+            source_sha1s_file.write('f: a\n')
+        assert ensembler.packaging.check_fah_run_source('RUN0', 'T_A', source_sha1s={'f': 'a'})
+        assert not ensembler.packaging.check_fah_run_source('RUN0', 'T_A', source_sha1s={'f': 'b'})
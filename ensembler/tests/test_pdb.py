@@ -0,0 +1,152 @@
+import os
+import sys
+import gzip
+import threading
+if sys.version_info > (3, 0):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+import ensembler.pdb
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    """Stand-in for the PDB/SIFTS download servers."""
+    protocol_version = 'HTTP/1.1'
+    pages = {}
+    nfailures = {}
+    client_ports = set()
+
+    def do_GET(self):
+        self.client_ports.add(self.client_address[1])
+        if self.nfailures.get(self.path, 0) > 0:
+            self.nfailures[self.path] -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path not in self.pages:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        page = self.pages[self.path]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stand_in_server(pages, nfailures=None):
+    StandInRequestHandler.pages = pages
+    StandInRequestHandler.nfailures = nfailures if nfailures is not None else {}
+    StandInRequestHandler.client_ports = set()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+@attr('unit')
+def test_http_fetcher():
+    pages = dict([('/file%d' % i, ('contents %d' % i).encode('utf-8')) for i in range(20)])
+    server, base_url = start_stand_in_server(pages, nfailures={'/file3': 2})
+    try:
+        fetcher = ensembler.pdb.HTTPFetcher(nthreads=2, max_retries=3, backoff=0.01)
+        urls = [base_url + path for path in pages] + [base_url + '/missing']
+        results, failures = fetcher.fetch_all(urls)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert len(results) == 20
+    assert results[base_url + '/file3'] == b'contents 3'
+    assert list(failures.keys()) == [base_url + '/missing']
+    assert failures[base_url + '/missing'].status == 404
+    # connections are kept alive and reused (one per thread)
+    assert len(StandInRequestHandler.client_ports) <= 2
+
+
+@attr('unit')
+def test_download_structure_files():
+    pdb_page = b'ATOM      1  N   ALA A   1\n'
+    sifts_page = b'<?xml version="1.0"?>\n<entry dbSource="PDBe">\n  <rdf:RDF>\n  </rdf:RDF>\n  <entity/>\n</entry>\n'
+    server, base_url = start_stand_in_server({
+        '/pdb/1ABC.pdb.gz': gzip_bytes(pdb_page),
+        '/sifts/1abc.xml.gz': gzip_bytes(sifts_page),
+    })
+    try:
+        with enter_temp_dir():
+            failures = ensembler.pdb.download_structure_files(
+                [('1ABC', 'pdb', '1ABC.pdb.gz'), ('1ABC', 'sifts', '1ABC.xml.gz')],
+                fetcher=ensembler.pdb.HTTPFetcher(nthreads=2, backoff=0.01),
+                pdb_base_url=base_url + '/pdb/', sifts_base_url=base_url + '/sifts/',
+            )
+            assert failures == {}
+            with gzip.open('1ABC.pdb.gz') as pdb_file:
+                assert pdb_file.read() == pdb_page
+            with gzip.open('1ABC.xml.gz') as sifts_file:
+                assert sifts_file.read() == b'<?xml version="1.0"?>\n<entry>\n  <entity/>\n</entry>\n'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@attr('unit')
+def test_download_structure_files_removes_partial_files():
+    server, base_url = start_stand_in_server({
+        '/sifts/1abc.xml.gz': b'not gzipped',
+        '/sifts/2abc.xml.gz': gzip_bytes(b'<entry>\n  <entity/>\n</entry>\n' * 100)[:-20],
+    })
+    try:
+        with enter_temp_dir():
+            failures = ensembler.pdb.download_structure_files(
+                [('1ABC', 'sifts', '1ABC.xml.gz'), ('2ABC', 'sifts', '2ABC.xml.gz')],
+                fetcher=ensembler.pdb.HTTPFetcher(nthreads=1, max_retries=1, backoff=0.01),
+                sifts_base_url=base_url + '/sifts/',
+            )
+            assert sorted(failures.keys()) == [('1ABC', 'sifts'), ('2ABC', 'sifts')]
+            assert os.listdir('.') == []
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@attr('unit')
+def test_process_sifts_stream():
+    import io
+    sifts_page = b'<?xml version="1.0"?>\n<entry dbSource="PDBe">\n  <rdf:RDF>\n    <rdf:Description/>\n  </rdf:RDF>\n'
+    sifts_page += b''.join([b'  <residue dbResNum="%d"/>\n' % i for i in range(50000)]) + b'</entry>\n'
+    expected_page = b'<?xml version="1.0"?>\n<entry>\n' + sifts_page[sifts_page.index(b'  <residue'):]
+    processed_file = io.BytesIO()
+    ensembler.pdb.process_sifts_stream(io.BytesIO(gzip_bytes(sifts_page)), processed_file)
+    assert processed_file.getvalue() == expected_page
+    assert ensembler.pdb.process_sifts_page(gzip_bytes(sifts_page)) == expected_page.decode('utf-8')
+    lines = list(ensembler.pdb.iter_gunzipped_lines(io.BytesIO(gzip_bytes(b'ab\ncd\r\nef') + gzip_bytes(b'gh\n')), chunk_size=3))
+    assert lines == [b'ab', b'cd', b'efgh']
+    truncated_page = gzip_bytes(sifts_page)[:-100]
+    try:
+        list(ensembler.pdb.iter_gunzipped_lines(io.BytesIO(truncated_page)))
+    except EOFError:
+        pass
+    else:
+        raise AssertionError('Truncated gzip data was not detected')
+
+
+def gzip_bytes(data):
+    import io
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as gz_file:
+        gz_file.write(data)
+    return buf.getvalue()
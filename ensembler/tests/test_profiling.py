@@ -0,0 +1,70 @@
+import os
+import json
+import ensembler.profiling
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+
+class StepClock(object):
+    """Clock which advances by one second each time it is read."""
+    def __init__(self):
+        self.time = 0.
+
+    def __call__(self):
+        self.time += 1.
+        return self.time
+
+
+def gen_example_tracer(**kwargs):
+    tracer = ensembler.profiling.Tracer(enabled=True, rank=0, clock=StepClock(), **kwargs)
+    for templateid in ['TMPL_A', 'TMPL_B']:
+        with tracer.span('refine_implicit_md', target='EGFR_HUMAN_D0', template=templateid):
+            with tracer.span('minimization'):
+                pass
+            for iteration in range(2):
+                with tracer.span('dynamics'):
+                    pass
+    return tracer
+
+
+@attr('unit')
+def test_tracer_spans():
+    tracer = gen_example_tracer()
+    assert len(tracer.spans) == 8
+    dynamics_spans = [span for span in tracer.spans if span['name'] == 'dynamics']
+    assert [span['template'] for span in dynamics_spans] == ['TMPL_A', 'TMPL_A', 'TMPL_B', 'TMPL_B']
+    assert all([span['target'] == 'EGFR_HUMAN_D0' and span['depth'] == 1 for span in dynamics_spans])
+
+    summary = dict([(span_summary['name'], span_summary) for span_summary in tracer.summarize()])
+    assert summary['dynamics']['count'] == 4
+    assert summary['dynamics']['total_time'] == 4.
+    # each refine_implicit_md span encloses three child spans, each of which reads the clock twice
+    assert summary['refine_implicit_md']['mean_time'] == 7.
+
+
+@attr('unit')
+def test_disabled_tracer_records_nothing():
+    tracer = ensembler.profiling.Tracer(enabled=False)
+    with tracer.span('minimization'):
+        pass
+    assert tracer.spans == []
+
+
+@attr('unit')
+def test_write_trace():
+    tracer = gen_example_tracer(profile=['minimization'])
+    with enter_temp_dir():
+        ensembler.profiling.write_trace('trace.json', tracer=tracer)
+        with open('trace.json') as trace_file:
+            trace = json.load(trace_file)
+        assert len(trace['spans']) == 8
+        assert len(trace['summary']) == 3
+        assert os.path.exists('trace-minimization-rank0.prof')
+
+        ensembler.profiling.write_trace('trace-chrome.json', trace_format='chrome', tracer=tracer)
+        with open('trace-chrome.json') as trace_file:
+            trace = json.load(trace_file)
+        complete_events = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+        assert len(complete_events) == 8
+        assert complete_events[0]['name'] == 'refine_implicit_md'
+        assert complete_events[0]['dur'] == 7e6
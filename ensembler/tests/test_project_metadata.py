@@ -125,4 +125,35 @@ def test_project_metadata_gather_templates_write():
                 'test_field': 'test_value',
                 'iteration': 0
             }
-        }
\ No newline at end of file
+        }
+
+@attr('unit')
+def test_project_metadata_batch_writes():
+    with ensembler.utils.enter_temp_dir():
+        os.mkdir('targets')
+        test_data = {'test_field': 'test_value'}
+        with ensembler.core.metadata_cache.batch_writes():
+            init_project_metadata = ensembler.core.ProjectMetadata(project_stage='init')
+            init_project_metadata.add_data(test_data)
+            init_project_metadata.write()
+            init_project_metadata.write()
+            assert not os.path.exists('meta0.yaml')
+            # pending writes are visible to subsequent metadata objects
+            gather_targets_project_metadata = ensembler.core.ProjectMetadata(project_stage='gather_targets')
+            assert gather_targets_project_metadata.data['init']['iteration'] == 1
+        assert yaml.load(open('meta0.yaml'))['init']['iteration'] == 0
+        assert yaml.load(open('meta1.yaml'))['init']['iteration'] == 1
+
+        # files written by other processes are picked up
+        with open('meta2.yaml', 'w') as metadata_file:
+            yaml.dump({'init': {'iteration': 2}}, metadata_file)
+        gather_targets_project_metadata = ensembler.core.ProjectMetadata(project_stage='gather_targets')
+        assert gather_targets_project_metadata.data['init']['iteration'] == 2
+
+        # ... even if the directory mtime does not change (e.g. on a filesystem with coarse mtimes)
+        dir_mtime = os.stat('.').st_mtime
+        with open('meta3.yaml', 'w') as metadata_file:
+            yaml.dump({'init': {'iteration': 3}}, metadata_file)
+        os.utime('.', (dir_mtime, dir_mtime))
+        gather_targets_project_metadata = ensembler.core.ProjectMetadata(project_stage='gather_targets')
+        assert gather_targets_project_metadata.data['init']['iteration'] == 3
@@ -0,0 +1,143 @@
+import os
+import ensembler
+import ensembler.refinement
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+
+@attr('unit')
+def test_gen_cpu_threads_to_benchmark():
+    assert ensembler.refinement.gen_cpu_threads_to_benchmark(ncpus=1) == [1]
+    assert ensembler.refinement.gen_cpu_threads_to_benchmark(ncpus=8) == [1, 2, 4, 8]
+    assert ensembler.refinement.gen_cpu_threads_to_benchmark(ncpus=12) == [1, 2, 4, 8, 12]
+
+
+@attr('unit')
+def test_select_fastest_openmm_platform():
+    benchmark_results = [
+        {'openmm_platform': 'CPU', 'cpu_platform_threads': 1, 'ns_per_day': 2.1},
+        {'openmm_platform': 'CPU', 'cpu_platform_threads': 8, 'ns_per_day': 11.5},
+        {'openmm_platform': 'OpenCL', 'cpu_platform_threads': None, 'ns_per_day': 9.8},
+    ]
+    assert ensembler.refinement.select_fastest_openmm_platform(benchmark_results) == ('CPU', 8)
+
+
+@attr('unit')
+def test_write_and_read_platform_benchmark_file():
+    benchmark_results = [{'openmm_platform': 'CPU', 'cpu_platform_threads': 4, 'ns_per_day': 5.0}]
+    with enter_temp_dir():
+        benchmark_filepath = ensembler.refinement.gen_platform_benchmark_filepath('.', hostname='testhost')
+        assert ensembler.refinement.read_platform_benchmark_file(benchmark_filepath) is None
+        ensembler.refinement.write_platform_benchmark_file(benchmark_filepath, benchmark_results)
+        assert os.path.exists('platform-benchmark-implicit-testhost.yaml')
+        assert ensembler.refinement.read_platform_benchmark_file(benchmark_filepath) == benchmark_results
+
+
+@attr('unit')
+def test_assign_worker_cpu_cores():
+    assert ensembler.refinement.assign_worker_cpu_cores(16, 4, 0) == (4, [0, 1, 2, 3])
+    assert ensembler.refinement.assign_worker_cpu_cores(16, 4, 3) == (4, [12, 13, 14, 15])
+    # small systems are given fewer threads
+    assert ensembler.refinement.assign_worker_cpu_cores(16, 2, 1, natoms=4500, natoms_per_thread=2000) == (2, [8, 9])
+    # more workers than cores
+    assert ensembler.refinement.assign_worker_cpu_cores(4, 8, 5) == (1, [1])
+
+
+@attr('unit')
+def test_get_physical_core_cpus():
+    cpuinfo_text = '\n\n'.join([
+        'processor\t: %d\nphysical id\t: 0\ncore id\t\t: %d\n' % (cpu, cpu % 4) for cpu in range(8)
+    ])
+    core_map = ensembler.refinement.parse_cpuinfo_core_map(cpuinfo_text)
+    assert core_map[5] == ('0', '1')
+    # CPUs 4-7 are hyperthread siblings of CPUs 0-3
+    assert ensembler.refinement.get_physical_core_cpus(list(range(8)), core_map=core_map) == [0, 1, 2, 3]
+    assert ensembler.refinement.get_physical_core_cpus([2, 3, 4, 6], core_map=core_map) == [2, 3, 4]
+    # unknown layout
+    assert ensembler.refinement.get_physical_core_cpus([0, 1, 9], core_map=core_map) == [0, 1, 9]
+
+
+@attr('unit')
+def test_estimate_nwaters_from_positions():
+    import simtk.unit as unit
+    # a single atom in a 2 nm cube: volume 8 nm^3, minus a sphere of radius 0.3 nm (~0.11 nm^3)
+    positions = unit.Quantity([[0.0, 0.0, 0.0]], unit.nanometers)
+    nwaters = ensembler.refinement.estimate_nwaters_from_positions(
+        positions, 1.0 * unit.nanometers, water_density=10.0 / unit.nanometers**3
+    )
+    assert 78.0 < nwaters < 79.5
+
+
+@attr('unit')
+def test_select_evenly_spaced_sample():
+    assert ensembler.refinement.select_evenly_spaced_sample(['a', 'b', 'c', 'd', 'e', 'f'], 3) == ['a', 'c', 'e']
+    assert ensembler.refinement.select_evenly_spaced_sample(['a', 'b'], 3) == ['a', 'b']
+    assert ensembler.refinement.select_evenly_spaced_sample(['a', 'b'], 0) == []
+
+
+@attr('unit')
+def test_select_waters_furthest_from_box_boundary():
+    import numpy as np
+    oxygen_positions = np.array([
+        [0.1, 1.0, 1.0],
+        [1.0, 1.0, 1.2],
+        [1.0, 1.9, 1.0],
+        [0.7, 1.3, 0.8],
+    ])
+    water_indices, half_edge = ensembler.refinement.select_waters_furthest_from_box_boundary(
+        oxygen_positions, np.array([1.0, 1.0, 1.0]), 2
+    )
+    assert list(water_indices) == [1, 3]
+    assert abs(half_edge - 0.3) < 1e-9
+
+
+@attr('unit')
+def test_serialize_system_without_box():
+    import simtk.unit as unit
+    import simtk.openmm as openmm
+    serialized_systems = []
+    for box_edge in [3.0, 4.0]:
+        system = openmm.System()
+        system.addParticle(1.0)
+        system.setDefaultPeriodicBoxVectors(openmm.Vec3(box_edge, 0, 0), openmm.Vec3(0, box_edge, 0), openmm.Vec3(0, 0, box_edge))
+        serialized_systems.append(ensembler.refinement.serialize_system_without_box(system))
+        assert system.getDefaultPeriodicBoxVectors()[0][0] == box_edge * unit.nanometers
+    assert serialized_systems[0] == serialized_systems[1]
+
+
+@attr('unit')
+def test_write_and_read_solvated_model():
+    import simtk.unit as unit
+    import simtk.openmm as openmm
+    import simtk.openmm.app as app
+    solute_topology = app.Topology()
+    chain = solute_topology.addChain()
+    residue = solute_topology.addResidue('ALA', chain)
+    solute_topology.addAtom('CA', app.element.carbon, residue)
+    modeller = app.Modeller(solute_topology, [openmm.Vec3(1.0, 1.0, 1.0)] * unit.nanometers)
+
+    water_topology = app.Topology()
+    chain = water_topology.addChain()
+    residue = water_topology.addResidue('HOH', chain)
+    oxygen = water_topology.addAtom('O', app.element.oxygen, residue)
+    for hydrogen_name in ['H1', 'H2']:
+        hydrogen = water_topology.addAtom(hydrogen_name, app.element.hydrogen, residue)
+        water_topology.addBond(oxygen, hydrogen)
+    residue = water_topology.addResidue('NA', chain)
+    water_topology.addAtom('NA', app.element.sodium, residue)
+    modeller.add(water_topology, [openmm.Vec3(0.5, 0.5, 0.5), openmm.Vec3(0.6, 0.5, 0.5), openmm.Vec3(0.5, 0.6, 0.5), openmm.Vec3(1.5, 1.5, 1.5)] * unit.nanometers)
+    modeller.topology.setUnitCellDimensions(openmm.Vec3(2.0, 2.0, 2.0) * unit.nanometers)
+
+    with enter_temp_dir():
+        ensembler.refinement.write_solvated_model('solvated-model.npz', modeller, 1, source_sha1='abc123')
+        read_modeller = ensembler.refinement.read_solvated_model('solvated-model.npz', solute_topology)
+        assert ensembler.refinement.read_solvated_model_source_sha1('solvated-model.npz') == 'abc123'
+        assert ensembler.refinement.read_solvated_model_source_sha1('missing.npz') is None
+        ensembler.refinement.write_solvated_model('unversioned.npz', modeller, 1)
+        assert ensembler.refinement.read_solvated_model_source_sha1('unversioned.npz') is None
+
+    assert [r.name for r in read_modeller.topology.residues()] == ['ALA', 'HOH', 'NA']
+    assert [a.name for a in read_modeller.topology.atoms()] == ['CA', 'O', 'H1', 'H2', 'NA']
+    assert len(list(read_modeller.topology.bonds())) == 2
+    assert read_modeller.topology.getUnitCellDimensions()[0] == 2.0 * unit.nanometers
+    assert abs(read_modeller.positions[2][0].value_in_unit(unit.nanometers) - 0.6) < 1e-6
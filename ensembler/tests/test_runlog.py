@@ -0,0 +1,92 @@
+import os
+import time
+import yaml
+import ensembler.core
+import ensembler.runlog
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+
+def write_example_logs():
+    model_dir = os.path.join('models', 'EGFR_HUMAN_D0', 'EGFR_HUMAN_D0_TMPL_A')
+    ensembler.utils.create_dir(model_dir)
+    log_filepath = os.path.join(model_dir, 'implicit-log.yaml')
+    log_file = ensembler.core.LogFile(log_filepath)
+    log_file.log(new_log_data={'mpi_rank': 0, 'finished': False})
+    log_file.log(new_log_data={'finished': True, 'successful': True})
+    return log_filepath
+
+
+@attr('unit')
+def test_run_log():
+    with enter_temp_dir():
+        ensembler.runlog.enable_run_log()
+        try:
+            log_filepath = write_example_logs()
+        finally:
+            ensembler.runlog.disable_run_log()
+
+        # updates are appended to the run log, rather than written to the model log file
+        assert not os.path.exists(log_filepath)
+        run_log_filenames = os.listdir(ensembler.runlog.run_log_dirname)
+        assert len(run_log_filenames) == 1
+        with open(os.path.join(ensembler.runlog.run_log_dirname, run_log_filenames[0])) as run_log_file:
+            assert len(run_log_file.readlines()) == 2
+
+        log_data = ensembler.runlog.load_model_log(log_filepath)
+        assert log_data['mpi_rank'] == 0
+        assert log_data['finished'] is True
+        assert log_data['successful'] is True
+        assert 'hostname' in log_data
+
+        assert ensembler.runlog.compact_run_logs() == 1
+        assert os.listdir(ensembler.runlog.run_log_dirname) == []
+        with open(log_filepath) as log_file:
+            compacted_log_data = yaml.load(log_file, Loader=ensembler.core.YamlLoader)
+        assert compacted_log_data == log_data
+        assert ensembler.runlog.load_model_log(log_filepath) == log_data
+
+
+@attr('unit')
+def test_log_file_without_run_log():
+    with enter_temp_dir():
+        log_filepath = write_example_logs()
+        assert not os.path.exists(ensembler.runlog.run_log_dirname)
+        log_data = ensembler.runlog.load_model_log(log_filepath)
+        assert log_data['successful'] is True
+
+
+@attr('unit')
+def test_yaml_log_file_supersedes_earlier_run_log_events():
+    with enter_temp_dir():
+        ensembler.runlog.enable_run_log()
+        try:
+            log_filepath = write_example_logs()
+        finally:
+            ensembler.runlog.disable_run_log()
+        reader = ensembler.runlog.get_run_log_reader()
+        assert len(reader.get_events(log_filepath)) == 2
+
+        # e.g. a later run with --retry_failed_runs, without the run log
+        log_file = ensembler.core.LogFile(log_filepath)
+        log_file.log(new_log_data={'finished': True, 'successful': False})
+        os.utime(log_filepath, (time.time() + 10, time.time() + 10))
+        assert ensembler.runlog.load_model_log(log_filepath)['successful'] is False
+        assert ensembler.runlog.compact_run_logs() == 0
+        assert ensembler.runlog.load_model_log(log_filepath)['successful'] is False
+
+
+@attr('unit')
+def test_run_log_reader_reads_new_events_incrementally():
+    with enter_temp_dir():
+        run_log = ensembler.runlog.RunLog(rank=0)
+        reader = ensembler.runlog.RunLogReader()
+        run_log.append('a.yaml', {'finished': False}, event='start')
+        run_log.append('b.yaml', {'finished': False}, event='start')
+        events_by_log = reader.update()
+        b_events = events_by_log['b.yaml']
+        run_log.append('a.yaml', {'finished': True})
+        events_by_log = reader.update()
+        assert [event['data'] for event in events_by_log['a.yaml']] == [{'finished': False}, {'finished': True}]
+        # logs without new events are left untouched
+        assert events_by_log['b.yaml'] is b_events
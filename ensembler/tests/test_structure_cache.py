@@ -0,0 +1,79 @@
+import os
+import time
+import ensembler.structure_cache
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+
+def write_file(filepath, contents):
+    with open(filepath, 'w') as outfile:
+        outfile.write(contents)
+
+
+@attr('unit')
+def test_structure_cache_add_and_link():
+    with enter_temp_dir():
+        cache = ensembler.structure_cache.StructureCache('cache')
+        write_file('1ABC.pdb.gz', 'pdb contents')
+        cached_filepath = cache.add('1ABC', 'pdb', '1ABC.pdb.gz', move=True)
+        assert not os.path.exists('1ABC.pdb.gz')
+        assert cached_filepath == os.path.abspath(os.path.join('cache', 'pdb', '1ABC.pdb.gz'))
+
+        # A new instance reads the index
+        cache = ensembler.structure_cache.StructureCache('cache')
+        assert cache.lookup('1ABC', 'pdb') == cached_filepath
+        assert cache.lookup('1ABC', 'sifts') is None
+
+        not_linked = cache.link_all([('1ABC', 'pdb', 'project-1ABC.pdb.gz'), ('2XYZ', 'pdb', 'project-2XYZ.pdb.gz')])
+        assert not_linked == [('2XYZ', 'pdb', 'project-2XYZ.pdb.gz')]
+        assert not os.path.islink('project-1ABC.pdb.gz')
+        with open('project-1ABC.pdb.gz') as project_file:
+            assert project_file.read() == 'pdb contents'
+
+
+@attr('unit')
+def test_structure_cache_verify():
+    with enter_temp_dir():
+        cache = ensembler.structure_cache.StructureCache('cache')
+        write_file('1ABC.xml.gz', 'sifts contents')
+        cached_filepath = cache.add('1ABC', 'sifts', '1ABC.xml.gz')
+        write_file(cached_filepath, 'sifts CONTENTS')
+        assert cache.verify() == [('sifts', '1ABC')]
+        assert cache.lookup('1ABC', 'sifts') is None
+        assert not os.path.exists(cached_filepath)
+
+
+@attr('unit')
+def test_structure_cache_lru_eviction():
+    with enter_temp_dir():
+        cache = ensembler.structure_cache.StructureCache('cache', max_size=25)
+        for pdbid in ['1AAA', '2BBB']:
+            write_file(pdbid, '0123456789')
+            cache.add(pdbid, 'pdb', pdbid)
+            time.sleep(0.01)
+        # access 1AAA, so that 2BBB is the least recently used
+        cache.lookup('1AAA', 'pdb')
+        time.sleep(0.01)
+        write_file('3CCC', '0123456789')
+        cache.add('3CCC', 'pdb', '3CCC')
+        assert cache.lookup('2BBB', 'pdb') is None
+        assert cache.lookup('1AAA', 'pdb') is not None
+        assert cache.lookup('3CCC', 'pdb') is not None
+        assert cache.size() == 20
+
+
+@attr('unit')
+def test_structure_cache_eviction_keeps_linked_project_files():
+    with enter_temp_dir():
+        cache = ensembler.structure_cache.StructureCache('cache', max_size=15)
+        write_file('1AAA', '0123456789')
+        cache.add('1AAA', 'pdb', '1AAA')
+        cache.link('1AAA', 'pdb', 'project-1AAA.pdb.gz')
+        time.sleep(0.01)
+        write_file('2BBB', '0123456789')
+        cache.add('2BBB', 'pdb', '2BBB')
+        assert cache.lookup('1AAA', 'pdb') is None
+        with open('project-1AAA.pdb.gz') as project_file:
+            assert project_file.read() == '0123456789'
+        # the index is readable by other users of a shared cache
+        assert os.stat(cache.index_filepath).st_mode & 0o044 == 0o044 & ~ensembler.utils.get_umask()
@@ -0,0 +1,75 @@
+import os
+from lxml import etree
+import ensembler.uniprot
+from ensembler.utils import enter_temp_dir
+from ensembler.tests.utils import get_installed_resource_filename
+from nose.plugins.attrib import attr
+
+
+def read_ck1_entries_xml():
+    with open(get_installed_resource_filename(os.path.join('resources', 'uniprot-CK1-kinases.xml')), 'rb') as uniprotxml_file:
+        return uniprotxml_file.read()
+
+
+class StandInFetcher(object):
+    """Stand-in for ensembler.pdb.HTTPFetcher, which returns the CK1 kinase UniProt XML for every
+    URL and records the URLs requested."""
+    def __init__(self):
+        self.urls = []
+
+    def fetch_all(self, urls):
+        urls = list(urls)
+        self.urls += urls
+        return {url: read_ck1_entries_xml() for url in urls}, {}
+
+
+@attr('unit')
+def test_split_acs_into_batches():
+    acs = ['P%05d' % i for i in range(10)]
+    assert ensembler.uniprot.split_acs_into_batches(acs, max_batch_size=4) == [acs[0:4], acs[4:8], acs[8:10]]
+    # each encoded 'acc:P00000' is 12 characters, and each '+OR+' separator 4 characters
+    assert ensembler.uniprot.split_acs_into_batches(acs, max_query_length=30) == [acs[i:i+2] for i in range(0, 10, 2)]
+    assert ensembler.uniprot.split_acs_into_batches([]) == []
+
+
+@attr('unit')
+def test_uniprot_entry_cache():
+    # streamed entries are cleared after use, so keep copies
+    entries = [
+        ensembler.uniprot.strip_xml_namespaces(etree.fromstring(etree.tostring(entry)))
+        for entry in ensembler.uniprot.iter_uniprot_entries(
+            get_installed_resource_filename(os.path.join('resources', 'uniprot-CK1-kinases.xml'))
+        )
+    ][0:2]
+    with enter_temp_dir():
+        cache = ensembler.uniprot.UniProtEntryCache('uniprot-cache')
+        cache.add_entries(entries)
+        primary_ac = entries[0].find('accession').text
+        secondary_ac = entries[0].findall('accession')[1].text
+        name = entries[0].find('name').text
+        cached_entries = cache.get_entries(acs=[primary_ac, secondary_ac, 'XXXXXX'], names=[name])
+        assert sorted(cached_entries.keys()) == sorted([primary_ac, secondary_ac, name])
+        assert cached_entries[name].find('sequence').text == entries[0].find('sequence').text
+
+        # a new entry version replaces the previous one
+        entries[0].set('version', '999')
+        cache.add_entries([entries[0]])
+        assert os.listdir(os.path.join('uniprot-cache', 'entries')).count('%s_v999.xml' % primary_ac) == 1
+        assert len(os.listdir(os.path.join('uniprot-cache', 'entries'))) == 2
+
+
+@attr('unit')
+def test_uniprot_client_uses_cache():
+    with enter_temp_dir():
+        fetcher = StandInFetcher()
+        client = ensembler.uniprot.UniProtClient(cache_dir='uniprot-cache', fetcher=fetcher, max_batch_size=1)
+        entries = client.get_entries(['P48730', 'P48729'])
+        assert [entry.find('accession').text for entry in entries] == ['P48730', 'P48729']
+        assert len(fetcher.urls) == 2
+
+        fetcher = StandInFetcher()
+        client = ensembler.uniprot.UniProtClient(cache_dir='uniprot-cache', fetcher=fetcher)
+        uniprotxml = client.get_uniprot_xml(['P48729', 'P48730'])
+        assert [entry.find('accession').text for entry in uniprotxml.findall('entry')] == ['P48729', 'P48730']
+        assert client.get_entry_by_name('KC1D_HUMAN').find('accession').text == 'P48730'
+        assert len(fetcher.urls) == 0
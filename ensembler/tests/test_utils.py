@@ -0,0 +1,35 @@
+import os
+import gzip
+import ensembler.utils
+from ensembler.utils import enter_temp_dir
+from nose.plugins.attrib import attr
+
+
+@attr('unit')
+def test_write_content_addressed_file():
+    contents = '<System></System>\n'
+    with enter_temp_dir():
+        filepath = ensembler.utils.write_content_addressed_file('store', contents)
+        assert os.path.basename(filepath) == ensembler.utils.sha1_hexdigest(contents) + '.xml.gz'
+        with gzip.open(filepath) as stored_file:
+            assert stored_file.read().decode('utf-8') == contents
+        # identical contents are stored only once
+        assert ensembler.utils.write_content_addressed_file('store', contents) == filepath
+        assert len(os.listdir('store')) == 1
+
+        uncompressed_filepath = ensembler.utils.write_content_addressed_file('store', contents, compress=False)
+        assert uncompressed_filepath.endswith('.xml')
+        assert len(os.listdir('store')) == 2
+
+
+@attr('unit')
+def test_link_file():
+    with enter_temp_dir():
+        with open('source.txt', 'w') as source_file:
+            source_file.write('a')
+        with open('dest.txt', 'w') as dest_file:
+            dest_file.write('b')
+        ensembler.utils.link_file('source.txt', 'dest.txt')
+        with open('dest.txt') as dest_file:
+            assert dest_file.read() == 'a'
+        assert os.stat('source.txt').st_ino == os.stat('dest.txt').st_ino
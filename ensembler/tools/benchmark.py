@@ -0,0 +1,388 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import traceback
+import ensembler
+import ensembler.version
+import ensembler.initproject
+from ensembler.core import logger, default_project_dirnames, mpistate, get_utcnow_formatted
+
+# Targets and templates in the bundled example project from which synthetic projects are built.
+# Each of these templates has a loop-modeled structure, and a model directory for each target.
+example_project_targetids = ['EGFR_HUMAN_D0', 'KC1D_HUMAN_D0']
+example_project_templateids = ['KC1D_HUMAN_D0_4HNF_A', 'KC1D_HUMAN_D0_4KB8_D']
+
+# Model files copied into each synthetic model directory. Simulation state files (e.g.
+# explicit-state.xml.gz) are not read by any of the benchmarked stages, so are not copied.
+synthetic_model_filenames = [
+    'model.pdb.gz',
+    'modeling-log.yaml',
+    'sequence-identity.txt',
+    'unique_by_clustering',
+    'implicit-refined.pdb.gz',
+    'implicit-energies.txt',
+    'implicit-log.yaml',
+    'nwaters.txt',
+    'explicit-refined.pdb.gz',
+    'explicit-energies.txt',
+    'explicit-log.yaml',
+]
+
+benchmark_stages = ['align', 'cluster', 'solvate', 'metadata', 'inspect', 'mktraj']
+
+benchmark_results_format_version = 1
+
+benchmark_openmm_platform = 'CPU'
+
+
+def gen_synthetic_targetid(target_index):
+    return 'SYN%d_HUMAN_D0' % target_index
+
+
+def gen_synthetic_templateid(template_index):
+    """
+    Synthetic template IDs retain the PDB ID and chain ID of the example project template from
+    which they are derived, e.g. 'SYN3_HUMAN_D0_4KB8_D'.
+    """
+    source_templateid = example_project_templateids[template_index % len(example_project_templateids)]
+    pdbid_chainid = '_'.join(source_templateid.split('_')[-2:])
+    return 'SYN%d_HUMAN_D0_%s' % (template_index, pdbid_chainid)
+
+
+def get_example_project_filepath(*path_elements):
+    return os.path.join(ensembler.core.installation_toplevel_dir, 'tests', 'example_project', *path_elements)
+
+
+class SyntheticProjectIds(object):
+    """
+    The target and template IDs of a SyntheticProject, without creating the project (e.g. on
+    MPI ranks other than 0).
+    """
+    def __init__(self, ntargets, ntemplates):
+        self.ntargets = ntargets
+        self.ntemplates = ntemplates
+        self.targetids = [gen_synthetic_targetid(i) for i in range(ntargets)]
+        self.templateids = [gen_synthetic_templateid(i) for i in range(ntemplates)]
+
+
+class SyntheticProject(SyntheticProjectIds):
+    def __init__(self, project_dir, ntargets=2, ntemplates=2, source_project_dir=None):
+        """
+        Creates a synthetic Ensembler project, with ntargets targets and ntemplates templates, from
+        the example project bundled with the Ensembler tests. The project contains the files
+        output by all stages up to and including refine_explicit_md, so that any of those stages
+        can be benchmarked.
+
+        Each synthetic target takes its sequence and models from one of the example project
+        targets, and each synthetic template takes its sequence and structures from one of the
+        example project templates, cycling through each in turn. Files are copied rather than
+        linked, so that benchmarked stages cannot modify the example project.
+
+        Parameters
+        ----------
+        project_dir : str
+        ntargets : int
+        ntemplates : int
+        source_project_dir : str
+            default: the example project bundled with the Ensembler tests
+        """
+        super(SyntheticProject, self).__init__(ntargets, ntemplates)
+        self.project_dir = project_dir
+        if source_project_dir is None:
+            source_project_dir = get_example_project_filepath()
+        self.source_project_dir = source_project_dir
+
+        self.source_targetids = [
+            example_project_targetids[i % len(example_project_targetids)] for i in range(ntargets)
+        ]
+        self.source_templateids = [
+            example_project_templateids[i % len(example_project_templateids)] for i in range(ntemplates)
+        ]
+
+        ensembler.initproject.InitProject(project_dir)
+        self._copy_project_metadata()
+        self._write_targets()
+        self._write_templates()
+        self._write_models()
+
+    def _source_path(self, *path_elements):
+        return os.path.join(self.source_project_dir, *path_elements)
+
+    def _project_path(self, *path_elements):
+        return os.path.join(self.project_dir, *path_elements)
+
+    def _copy_project_metadata(self):
+        for dirname in ['.', default_project_dirnames.targets, default_project_dirnames.templates]:
+            shutil.copy(self._source_path(dirname, 'meta0.yaml'), self._project_path(dirname, 'meta0.yaml'))
+
+    def _write_targets(self):
+        source_seqs = read_fasta_seqs(self._source_path(default_project_dirnames.targets, 'targets.fa'))
+        with open(self._project_path(default_project_dirnames.targets, 'targets.fa'), 'w') as targets_file:
+            for targetid, source_targetid in zip(self.targetids, self.source_targetids):
+                write_fasta_seq(targets_file, targetid, source_seqs[source_targetid])
+
+    def _write_templates(self):
+        for fasta_filename in ['templates-resolved-seq.fa', 'templates-full-seq.fa']:
+            source_seqs = read_fasta_seqs(self._source_path(default_project_dirnames.templates, fasta_filename))
+            with open(self._project_path(default_project_dirnames.templates, fasta_filename), 'w') as templates_file:
+                for templateid, source_templateid in zip(self.templateids, self.source_templateids):
+                    write_fasta_seq(templates_file, templateid, source_seqs[source_templateid])
+
+        for templateid, source_templateid in zip(self.templateids, self.source_templateids):
+            shutil.copy(
+                self._source_path(default_project_dirnames.templates_structures_resolved, source_templateid + '.pdb'),
+                self._project_path(default_project_dirnames.templates_structures_resolved, templateid + '.pdb'),
+            )
+            shutil.copy(
+                self._source_path(default_project_dirnames.templates_structures_modeled_loops, source_templateid + '.pdb'),
+                self._project_path(default_project_dirnames.templates_structures_modeled_loops, templateid + '.pdb'),
+            )
+            pdbfixed_seq = read_fasta_seqs(
+                self._source_path(default_project_dirnames.templates_structures_modeled_loops, source_templateid + '-pdbfixed.fasta')
+            )[source_templateid]
+            pdbfixed_seq_filepath = self._project_path(
+                default_project_dirnames.templates_structures_modeled_loops, templateid + '-pdbfixed.fasta'
+            )
+            with open(pdbfixed_seq_filepath, 'w') as pdbfixed_seq_file:
+                write_fasta_seq(pdbfixed_seq_file, templateid, pdbfixed_seq)
+
+    def _write_models(self):
+        for targetid, source_targetid in zip(self.targetids, self.source_targetids):
+            source_models_target_dir = self._source_path(default_project_dirnames.models, source_targetid)
+            models_target_dir = self._project_path(default_project_dirnames.models, targetid)
+            ensembler.utils.create_dir(models_target_dir)
+
+            for filename in os.listdir(source_models_target_dir):
+                if filename.endswith('.yaml') or filename.startswith('nwaters-'):
+                    shutil.copy(os.path.join(source_models_target_dir, filename), models_target_dir)
+
+            for templateid, source_templateid in zip(self.templateids, self.source_templateids):
+                source_model_dir = os.path.join(source_models_target_dir, source_templateid)
+                model_dir = os.path.join(models_target_dir, templateid)
+                ensembler.utils.create_dir(model_dir)
+                for filename in synthetic_model_filenames:
+                    source_filepath = os.path.join(source_model_dir, filename)
+                    if os.path.exists(source_filepath):
+                        shutil.copy(source_filepath, os.path.join(model_dir, filename))
+
+            with open(os.path.join(models_target_dir, 'unique-models.txt'), 'w') as unique_models_file:
+                for templateid in self.templateids:
+                    unique_models_file.write(templateid + '\n')
+
+            seqids = []
+            for templateid in self.templateids:
+                with open(os.path.join(models_target_dir, templateid, 'sequence-identity.txt')) as seqid_file:
+                    seqids.append((templateid, float(seqid_file.read().strip())))
+            with open(os.path.join(models_target_dir, 'sequence-identities.txt'), 'w') as seqids_file:
+                for templateid, seqid in sorted(seqids, key=lambda x: x[1], reverse=True):
+                    seqids_file.write('%-30s %.1f\n' % (templateid, seqid))
+
+
+def read_fasta_seqs(fasta_filepath):
+    """
+    Returns
+    -------
+    seqs : dict
+        {seqid: seq}
+    """
+    seqs = {}
+    seqid = None
+    with open(fasta_filepath) as fasta_file:
+        for line in fasta_file:
+            line = line.strip()
+            if line.startswith('>'):
+                seqid = line[1:].split()[0]
+                seqs[seqid] = ''
+            elif seqid is not None:
+                seqs[seqid] += line
+    return seqs
+
+
+def write_fasta_seq(ofile, seqid, seq, line_length=60):
+    ofile.write('>%s\n' % seqid)
+    for i in range(0, len(seq), line_length):
+        ofile.write(seq[i:i+line_length] + '\n')
+
+
+def benchmark_align(project, loglevel=None):
+    import ensembler.modeling
+    ensembler.modeling.align_targets_and_templates(loglevel=loglevel)
+    return project.ntargets * project.ntemplates
+
+
+def benchmark_cluster(project, loglevel=None):
+    import ensembler.modeling
+    ensembler.modeling.cluster_models(loglevel=loglevel)
+    return project.ntargets
+
+
+def benchmark_solvate(project, loglevel=None):
+    import ensembler.refinement
+    ensembler.refinement.solvate_models()
+    return project.ntargets * project.ntemplates
+
+
+def benchmark_metadata(project, loglevel=None):
+    # Project metadata is written by a single rank, as in the pipeline stages
+    if mpistate.rank != 0:
+        return 0
+    for targetid in project.targetids:
+        project_metadata = ensembler.core.ProjectMetadata(
+            project_stage='refine_explicit_md', target_id=targetid
+        )
+        project_metadata.add_data({
+            'benchmark': True,
+            'datestamp': get_utcnow_formatted(),
+        })
+        project_metadata.write()
+    return project.ntargets
+
+
+def benchmark_inspect(project, loglevel=None):
+    import ensembler.tools.inspect
+    for targetid in project.targetids:
+        ensembler.tools.inspect.ProjectCounts(targetid, log_level=loglevel)
+        ensembler.tools.inspect.BuildModelsLogs(targetid)
+        ensembler.tools.inspect.RefineImplicitLogs(targetid)
+        ensembler.tools.inspect.RefineExplicitLogs(targetid)
+    return project.ntargets
+
+
+def benchmark_mktraj(project, loglevel=None):
+    import ensembler.tools.mktraj
+    for targetid in project.targetids:
+        ensembler.tools.mktraj.MkTraj(targetid, ensembler_stage='refine_implicit_md', loglevel=loglevel)
+    return project.ntargets
+
+
+benchmark_functions = {
+    'align': benchmark_align,
+    'cluster': benchmark_cluster,
+    'solvate': benchmark_solvate,
+    'metadata': benchmark_metadata,
+    'inspect': benchmark_inspect,
+    'mktraj': benchmark_mktraj,
+}
+
+
+def run_benchmark_stage(stage, project, loglevel=None):
+    """
+    Times a single benchmark stage. Exceptions are recorded in the results rather than raised, so
+    that the remaining stages can still be benchmarked (e.g. if an optional dependency is missing).
+
+    Returns
+    -------
+    result : dict
+    """
+    result = {
+        'stage': stage,
+        'wall_time': None,
+        'nitems': None,
+        'items_per_second': None,
+        'status': 'failed',
+        'error': None,
+    }
+    start = time.time()
+    try:
+        nitems = benchmark_functions[stage](project, loglevel=loglevel)
+    except Exception as e:
+        result['wall_time'] = time.time() - start
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+        logger.debug(traceback.format_exc())
+        logger.info('Benchmark stage %s failed: %s' % (stage, result['error']))
+        return result
+    wall_time = time.time() - start
+    result.update({
+        'wall_time': wall_time,
+        'nitems': nitems,
+        'items_per_second': nitems / wall_time if wall_time > 0 else None,
+        'status': 'succeeded',
+    })
+    logger.info('Benchmark stage %s: %.3f s (%d items)' % (stage, wall_time, nitems))
+    return result
+
+
+def run_benchmarks(ntargets=2, ntemplates=2, stages=None, project_dir=None, results_filepath=None,
+                   keep_project=False, loglevel=None):
+    """
+    Creates a synthetic project with ntargets targets and ntemplates templates, and times each
+    of the given Ensembler stages on it. OpenMM is restricted to the CPU platform, so that
+    results are comparable between machines.
+
+    Parameters
+    ----------
+    ntargets : int
+    ntemplates : int
+    stages : list of str
+        default: all stages in ensembler.tools.benchmark.benchmark_stages
+    project_dir : str
+        Directory in which to create the synthetic project (which must not already contain an
+        Ensembler project). default: a temporary directory, which is deleted afterwards unless
+        keep_project is True
+    results_filepath : str
+        Results are also written to this file in JSON format, if given.
+    keep_project : bool
+    loglevel : str
+
+    Returns
+    -------
+    results : dict
+    """
+    ensembler.utils.set_loglevel(loglevel)
+    if stages is None:
+        stages = benchmark_stages
+    for stage in stages:
+        if stage not in benchmark_functions:
+            raise Exception('Unrecognized benchmark stage %s. Options: %s' % (stage, ', '.join(benchmark_stages)))
+
+    os.environ['OPENMM_DEFAULT_PLATFORM'] = benchmark_openmm_platform
+
+    created_project_dir = project_dir is None
+    if created_project_dir:
+        # All ranks must use the same directory
+        if mpistate.rank == 0:
+            project_dir = tempfile.mkdtemp(prefix='ensembler-benchmark-')
+        project_dir = mpistate.comm.bcast(project_dir, root=0)
+    project_dir = os.path.abspath(project_dir)
+
+    results = {
+        'format_version': benchmark_results_format_version,
+        'ensembler_version': ensembler.version.short_version,
+        'ensembler_commit': ensembler.version.git_revision,
+        'python_version': sys.version.split()[0],
+        'hostname': socket.gethostname(),
+        'datestamp': get_utcnow_formatted(),
+        'mpi_size': mpistate.size,
+        'openmm_platform': benchmark_openmm_platform,
+        'ntargets': ntargets,
+        'ntemplates': ntemplates,
+        'stages': [],
+    }
+
+    cwd = os.getcwd()
+    try:
+        if mpistate.rank == 0:
+            logger.info('Creating synthetic project with %d targets and %d templates in %s' % (ntargets, ntemplates, project_dir))
+            start = time.time()
+            SyntheticProject(project_dir, ntargets=ntargets, ntemplates=ntemplates)
+            results['setup_wall_time'] = time.time() - start
+        mpistate.comm.Barrier()
+        project = SyntheticProjectIds(ntargets, ntemplates)
+        os.chdir(project_dir)
+        for stage in stages:
+            results['stages'].append(run_benchmark_stage(stage, project, loglevel=loglevel))
+            mpistate.comm.Barrier()
+    finally:
+        os.chdir(cwd)
+        if created_project_dir and not keep_project and mpistate.rank == 0:
+            shutil.rmtree(project_dir)
+
+    if results_filepath is not None and mpistate.rank == 0:
+        with open(results_filepath, 'w') as results_file:
+            json.dump(results, results_file, indent=4, sort_keys=True)
+
+    return results
@@ -0,0 +1,131 @@
+"""
+Readers for the energy trajectory files written during refinement (implicit-energies.txt and
+explicit-energies.txt), e.g.
+
+# iteration | simulation time (ps) | potential_energy (kT) | kinetic_energy (kT) | ns per day
+         0      0.5 -12345.678  1234.567 52.500
+
+explicit-energies.txt has an additional volume (nm^3) column before ns per day.
+"""
+import os
+import warnings
+import numpy as np
+
+energy_columns = {
+    'iteration': 0,
+    'simulation_time': 1,
+    'potential_energy': 2,
+    'kinetic_energy': 3,
+    'volume': 4,
+    'ns_per_day': -1,
+}
+
+
+def read_last_line(filepath, blocksize=4096, complete_only=False):
+    """
+    Returns the last non-empty line of a file, reading backwards from the end of the file in
+    blocks, so that the cost does not depend on the length of the file.
+
+    Parameters
+    ----------
+    filepath : str
+    blocksize : int
+    complete_only : bool
+        Ignore any final line which is not terminated by a newline (e.g. if it is still being
+        written), and return the previous line instead.
+
+    Returns
+    -------
+    line : str or None
+        None if the file is empty.
+    """
+    with open(filepath, 'rb') as file_obj:
+        file_obj.seek(0, os.SEEK_END)
+        position = file_obj.tell()
+        tail = b''
+        while position > 0:
+            read_size = min(blocksize, position)
+            position -= read_size
+            file_obj.seek(position)
+            tail = file_obj.read(read_size) + tail
+            if complete_only:
+                tail = tail[:tail.rfind(b'\n') + 1]
+            stripped_tail = tail.rstrip()
+            # stop once the tail contains the whole of the last non-empty line
+            if stripped_tail and b'\n' in stripped_tail:
+                break
+    lines = tail.decode('utf-8').strip().splitlines()
+    if len(lines) == 0:
+        return None
+    return lines[-1]
+
+
+def read_final_energy(energies_filepath, column='potential_energy'):
+    """
+    Returns the given value from the final iteration in an energies file, or None if the file
+    does not exist or contains no iterations. Any incomplete final line is ignored.
+    """
+    if not os.path.exists(energies_filepath):
+        return None
+    last_line = read_last_line(energies_filepath, complete_only=True)
+    if last_line is None or last_line.startswith('#'):
+        return None
+    try:
+        return float(last_line.split()[energy_columns[column]])
+    except (ValueError, IndexError):
+        warnings.warn(last_line)
+        return None
+
+
+def read_energies_data(energies_filepath):
+    """
+    Returns the contents of an energies file as an array of shape (niterations, ncolumns).
+    Any incomplete final line (e.g. if the simulation is still running) is ignored.
+    """
+    with open(energies_filepath, 'rb') as energies_file:
+        text = energies_file.read().decode('utf-8')
+    # drop the header and any incomplete final line
+    text = text[:text.rfind('\n') + 1]
+    data_lines = [line for line in text.splitlines() if line.strip() and not line.startswith('#')]
+    if len(data_lines) == 0:
+        return np.zeros((0, 0))
+    ncolumns = len(data_lines[0].split())
+    values = np.array(' '.join(data_lines).split(), dtype=float)
+    if len(values) != len(data_lines) * ncolumns:
+        # inconsistent line lengths - fall back to parsing line by line
+        data_lines = [line for line in data_lines if len(line.split()) == ncolumns]
+        values = np.array(' '.join(data_lines).split(), dtype=float)
+    return values.reshape(-1, ncolumns)
+
+
+def load_energies(energies_filepaths, column='potential_energy'):
+    """
+    Loads the given value from each iteration in each of a set of energies files.
+
+    Parameters
+    ----------
+    energies_filepaths : list of str
+    column : str
+        See energy_columns.
+
+    Returns
+    -------
+    energies : np.ndarray
+        Of shape (len(energies_filepaths), maximum number of iterations). Rows for shorter or
+        missing files are padded with NaN.
+    """
+    traces = []
+    for energies_filepath in energies_filepaths:
+        if os.path.exists(energies_filepath):
+            data = read_energies_data(energies_filepath)
+            if data.shape[0] > 0:
+                traces.append(data[:, energy_columns[column]])
+                continue
+        traces.append(np.zeros(0))
+
+    max_niterations = max([len(trace) for trace in traces]) if traces else 0
+    energies = np.empty((len(traces), max_niterations))
+    energies.fill(np.nan)
+    for index, trace in enumerate(traces):
+        energies[index, :len(trace)] = trace
+    return energies
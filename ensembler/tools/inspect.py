@@ -4,10 +4,11 @@ import os
 import re
 import numpy as np
 import pandas as pd
-import yaml
 import mdtraj
 import gzip
 from ensembler.core import logger, check_ensembler_modeling_stage_complete
+from ensembler.tools.log_aggregation import aggregate_logs, list_model_dirs
+from ensembler.tools.energies import read_final_energy, load_energies
 import warnings
 
 
@@ -35,45 +36,30 @@ class ProjectCounts(object):
         ]
 
     def _count_templates(self):
-        root, dirnames, filenames = next(os.walk(self.models_target_dir))
-        templateid = dirnames
-        self.df['templateid'] = templateid
+        # each model directory is listed once, rather than testing for each file separately
+        self.model_dir_contents = list_model_dirs(self.models_target_dir)
+        self.df['templateid'] = [templateid for templateid, filenames in self.model_dir_contents]
 
     def _count_models(self):
-        has_model = []
-        for templateid in self.df.templateid:
-            model_path = os.path.join(self.models_target_dir, templateid, 'model.pdb.gz')
-            if os.path.exists(model_path):
-                has_model.append(True)
-            else:
-                has_model.append(False)
-        self.df['has_model'] = has_model
+        self.df['has_model'] = [
+            'model.pdb.gz' in filenames for templateid, filenames in self.model_dir_contents
+        ]
 
     def _count_uniques(self):
-        unique = []
-        for templateid in self.df.templateid:
-            model_path = os.path.join(self.models_target_dir, templateid, 'unique_by_clustering')
-            if os.path.exists(model_path):
-                unique.append(True)
-            else:
-                unique.append(False)
-        self.df['unique'] = unique
+        self.df['unique'] = [
+            'unique_by_clustering' in filenames for templateid, filenames in self.model_dir_contents
+        ]
 
     def _count_implicit_refined(self):
-        has_implicit_refined = []
-        for templateid in self.df.templateid:
-            model_path = os.path.join(self.models_target_dir, templateid, 'implicit-refined.pdb.gz')
-            if os.path.exists(model_path):
-                has_implicit_refined.append(True)
-            else:
-                has_implicit_refined.append(False)
-        self.df['has_implicit_refined'] = has_implicit_refined
+        self.df['has_implicit_refined'] = [
+            'implicit-refined.pdb.gz' in filenames for templateid, filenames in self.model_dir_contents
+        ]
 
     def _get_sequence_identities(self):
         sequence_identity = []
-        for templateid in self.df.templateid:
+        for templateid, filenames in self.model_dir_contents:
             aln_path = os.path.join(self.models_target_dir, templateid, 'alignment.pir')
-            if os.path.exists(aln_path):
+            if 'alignment.pir' in filenames:
                 with open(aln_path) as aln_file:
                     aln_text = aln_file.read().splitlines()
                 aln = [aln_text[3], aln_text[6]]
@@ -309,48 +295,41 @@ class AnalyzeEnergies(object):
         self.df['unique_by_clustering'] = unique_models
 
     def _get_successful(self):
-        successful = []
-        for template_dirpath in self.template_dirpaths:
-            log_filepath = os.path.join(template_dirpath, 'implicit-log.yaml')
-            if os.path.exists(log_filepath):
-                with open(log_filepath) as log_file:
-                    log_data = yaml.load(log_file)
-                if log_data.get('successful') == True:
-                    successful.append(True)
-                else:
-                    successful.append(False)
-            else:
-                successful.append(False)
-        self.df['successful'] = successful
+        log_filepaths = [os.path.join(template_dirpath, 'implicit-log.yaml') for template_dirpath in self.template_dirpaths]
+        logs_df = aggregate_logs(
+            log_filepaths, cache_name='models-{0}-implicit-log'.format(self.targetid), project_dir=self.project_dir
+        )
+        if 'successful' in logs_df:
+            successful_filepaths = set(logs_df.log_filepath[logs_df.successful == True])
+        else:
+            successful_filepaths = set()
+        self.df['successful'] = [log_filepath in successful_filepaths for log_filepath in log_filepaths]
 
     def _get_final_energies(self):
-        has_energies = []
-        final_energies = []
-        for template_dirpath in self.template_dirpaths:
-            energies_filepath = os.path.join(template_dirpath, self.energies_filename)
-            if os.path.exists(energies_filepath):
-                with open(energies_filepath) as energies_file:
-                    lines = energies_file.read().splitlines()
-                if len(lines) > 1:
-
-                    try:
-                        final_energies.append(float(lines[-1].split()[2]))
-                        has_energies.append(True)
-                    except ValueError:
-                        warnings.warn(lines[-1])
-                        has_energies.append(False)
-                        final_energies.append(None)
-
-                else:
-                    has_energies.append(False)
-                    final_energies.append(None)
-            else:
-                has_energies.append(False)
-                final_energies.append(None)
-
-        self.df['has_energies'] = has_energies
+        # only the end of each energies file is read
+        final_energies = [
+            read_final_energy(os.path.join(template_dirpath, self.energies_filename))
+            for template_dirpath in self.template_dirpaths
+        ]
+        self.df['has_energies'] = [final_energy is not None for final_energy in final_energies]
         self.df['final_energy'] = final_energies
 
+    def load_energy_traces(self, column='potential_energy'):
+        """
+        Parameters
+        ----------
+        column : str
+            See ensembler.tools.energies.energy_columns.
+
+        Returns
+        -------
+        energies : np.ndarray
+            Of shape (number of templates, maximum number of iterations), with rows in the order
+            of self.templateids, padded with NaN.
+        """
+        energies_filepaths = [os.path.join(template_dirpath, self.energies_filename) for template_dirpath in self.template_dirpaths]
+        return load_energies(energies_filepaths, column=column)
+
     def _get_seqids(self):
         seqid_filepath = os.path.join(self.models_target_dir, 'sequence-identities.txt')
         with open(seqid_filepath) as seqid_file:
@@ -368,62 +347,50 @@ class AnalyzeEnergies(object):
 
 
 class LoopmodelLogs(object):
-    def __init__(self, project_dir='.'):
+    def __init__(self, project_dir='.', nprocesses=None):
+        """
+        Parameters
+        ----------
+        project_dir : str
+        nprocesses : int
+            Number of processes used to parse the log files (default: the number of CPUs).
+            Parsed logs are cached, and only changed log files are reparsed.
+        """
         self.project_dir = project_dir
+        self.nprocesses = nprocesses
         self.df = self.parse_loopmodel_logs()
 
     def parse_loopmodel_logs(self):
-        templateid = []
-        mpi_rank = []
-        hostname = []
-        successful = []
-        no_missing_residues = []
-        exception = []
-        loopmodel_exception = []
-        loopmodel_output = []
-        traceback = []
-        datestamp = []
-        timing_str = []
-        timing_total_seconds = []
-
         structures_modeled_loops_dir = os.path.join(self.project_dir, os.path.join(ensembler.core.default_project_dirnames.templates_structures_modeled_loops))
-        for filename in os.listdir(structures_modeled_loops_dir):
-            if len(filename) >= 5:
-                if filename[-5:] == '.yaml':
-                    filepath = os.path.join(structures_modeled_loops_dir, filename)
-                    with open(filepath) as logfile:
-                        pass
-                        log = yaml.load(logfile, Loader=ensembler.core.YamlLoader)
-
-                        templateid.append(log.get('templateid'))
-                        mpi_rank.append(int(log.get('mpi_rank')))
-                        hostname.append(log.get('hostname'))
-                        successful.append(log.get('successful'))
-                        no_missing_residues.append(log.get('no_missing_residues'))
-                        exception.append(log.get('exception'))
-                        loopmodel_exception.append(log.get('loopmodel_exception'))
-                        loopmodel_output.append(log.get('loopmodel_output'))
-                        traceback.append(log.get('traceback'))
-                        ds = datetime.datetime.strptime(log.get('datestamp'), ensembler.core.datestamp_format_string)
-                        datestamp.append(ds)
-                        timing_str.append(log.get('timing'))
-                        timing_hours, timing_minutes, timing_seconds = map(int, timing_str[-1].split(':'))
-                        timing_total_seconds.append(timing_hours*3600 + timing_minutes*60 + timing_seconds)
+        log_filepaths = [
+            os.path.join(structures_modeled_loops_dir, filename)
+            for filename in os.listdir(structures_modeled_loops_dir)
+            if len(filename) >= 5 and filename[-5:] == '.yaml'
+        ]
+        logs_df = aggregate_logs(
+            log_filepaths, cache_name='templates-structures-modeled-loops', project_dir=self.project_dir, nprocesses=self.nprocesses
+        )
+
+        def get_column(key):
+            if key in logs_df:
+                return logs_df[key].where(pd.notnull(logs_df[key]), None).values
+            return [None] * len(logs_df)
 
+        timing_str = get_column('timing')
         df = pd.DataFrame(
             {
-                'templateid': templateid,
-                'mpi_rank': mpi_rank,
-                'hostname': hostname,
-                'successful': successful,
-                'no_missing_residues': no_missing_residues,
-                'exception': exception,
-                'loopmodel_exception': loopmodel_exception,
-                'loopmodel_output': loopmodel_output,
-                'traceback': traceback,
-                'datestamp': datestamp,
+                'templateid': get_column('templateid'),
+                'mpi_rank': [int(mpi_rank) for mpi_rank in get_column('mpi_rank')],
+                'hostname': get_column('hostname'),
+                'successful': get_column('successful'),
+                'no_missing_residues': get_column('no_missing_residues'),
+                'exception': get_column('exception'),
+                'loopmodel_exception': get_column('loopmodel_exception'),
+                'loopmodel_output': get_column('loopmodel_output'),
+                'traceback': get_column('traceback'),
+                'datestamp': pd.to_datetime(get_column('datestamp'), format=ensembler.core.datestamp_format_string),
                 'timing_str': timing_str,
-                'timing_total_seconds': timing_total_seconds,
+                'timing_total_seconds': [parse_timing_seconds(timing) for timing in timing_str],
             }
         )
         return df
@@ -467,58 +434,81 @@ class LoopmodelLogs(object):
 
 
 class ModelingLogs(object):
-    def __init__(self, targetid, project_dir='.'):
+    def __init__(self, targetid, project_dir='.', nprocesses=None, use_cache=True):
+        """
+        Parameters
+        ----------
+        targetid : str
+        project_dir : str
+        nprocesses : int
+            Number of processes used to parse the log files (default: the number of CPUs).
+        use_cache : bool
+            Cache the parsed logs (in the .inspect-cache directory), so that only changed log
+            files are reparsed.
+        """
         self.project_dir = project_dir
         self.targetid = targetid
+        self.nprocesses = nprocesses
+        self.use_cache = use_cache
         self._parse_logs()
 
     def _parse_logs(self):
         self.target_models_dir = os.path.join(self.project_dir, ensembler.core.default_project_dirnames.models, self.targetid)
-        log_data = {}
         root, dirs, files = next(os.walk(self.target_models_dir))
         templateids = [dirname for dirname in dirs]
         logfilepaths = [os.path.join(self.target_models_dir, templateid, self.logfilename) for templateid in templateids]
-        valid_logfilepaths = [logfilepath for logfilepath in logfilepaths if os.path.exists(logfilepath)]
-
-        for t, logfilepath in enumerate(valid_logfilepaths):
-            with open(logfilepath) as logfile:
-                log = yaml.load(logfile)
 
-            for key in log:
-                if key not in log_data:
-                    log_data[key] = [None] * len(valid_logfilepaths)
-                log_data[key][t] = log[key]
-
-                if key == 'timing':
-                    if re.match('[0-9]+:[0-9]+:[0-9]+', log[key]):
-                        hours, mins, seconds = [int(x) for x in log[key].split(':')]
-                        timing_timedelta = datetime.timedelta(seconds=(seconds + mins*60 + hours*3600))
-                    else:
-                        timing_timedelta = None
+        if self.use_cache:
+            cache_name = 'models-{0}-{1}'.format(self.targetid, os.path.splitext(self.logfilename)[0])
+        else:
+            cache_name = None
+        # logs are read from the YAML log files, plus any updates held in the run log
+        df = aggregate_logs(logfilepaths, cache_name=cache_name, project_dir=self.project_dir, nprocesses=self.nprocesses)
+        df = df.drop('log_filepath', axis=1)
 
-                    if 'timing_timedelta' not in log_data:
-                        log_data['timing_timedelta'] = [None] * len(valid_logfilepaths)
-                    log_data['timing_timedelta'][t] = timing_timedelta
+        if 'timing' in df:
+            df['timing_timedelta'] = [parse_timing_timedelta(timing) for timing in df['timing']]
 
-        self.df = pd.DataFrame(log_data)
+        self.df = df
 
     def to_csv(self, ofilepath):
         self.df.to_csv(ofilepath)
 
 
 class BuildModelsLogs(ModelingLogs):
-    def __init__(self, targetid, project_dir='.'):
+    def __init__(self, targetid, project_dir='.', nprocesses=None, use_cache=True):
         self.logfilename = 'modeling-log.yaml'
-        super(BuildModelsLogs, self).__init__(targetid, project_dir=project_dir)
+        super(BuildModelsLogs, self).__init__(targetid, project_dir=project_dir, nprocesses=nprocesses, use_cache=use_cache)
 
 
 class RefineImplicitLogs(ModelingLogs):
-    def __init__(self, targetid, project_dir='.'):
+    def __init__(self, targetid, project_dir='.', nprocesses=None, use_cache=True):
         self.logfilename = 'implicit-log.yaml'
-        super(RefineImplicitLogs, self).__init__(targetid, project_dir=project_dir)
+        super(RefineImplicitLogs, self).__init__(targetid, project_dir=project_dir, nprocesses=nprocesses, use_cache=use_cache)
 
 
 class RefineExplicitLogs(ModelingLogs):
-    def __init__(self, targetid, project_dir='.'):
+    def __init__(self, targetid, project_dir='.', nprocesses=None, use_cache=True):
         self.logfilename = 'explicit-log.yaml'
-        super(RefineExplicitLogs, self).__init__(targetid, project_dir=project_dir)
\ No newline at end of file
+        super(RefineExplicitLogs, self).__init__(targetid, project_dir=project_dir, nprocesses=nprocesses, use_cache=use_cache)
+
+
+def parse_timing_seconds(timing_str):
+    """
+    Parameters
+    ----------
+    timing_str : str
+        e.g. '0:01:23' (hours:minutes:seconds)
+    """
+    timing_hours, timing_minutes, timing_seconds = map(int, timing_str.split(':'))
+    return timing_hours*3600 + timing_minutes*60 + timing_seconds
+
+
+def parse_timing_timedelta(timing_str):
+    try:
+        if re.match('[0-9]+:[0-9]+:[0-9]+', timing_str):
+            return datetime.timedelta(seconds=parse_timing_seconds(timing_str))
+    except TypeError:
+        # missing from the log
+        pass
+    return None
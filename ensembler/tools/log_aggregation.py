@@ -0,0 +1,268 @@
+"""
+Aggregation of per-model YAML log files (e.g. models/[targetid]/[templateid]/implicit-log.yaml)
+into pandas DataFrames, for the ensembler.tools.inspect classes.
+
+Logs are parsed in parallel (using the libyaml-based loader, if available), and the parsed
+logs are cached as a DataFrame in the .inspect-cache directory at the top level of the project.
+Each cached row is keyed by the mtime and size of its log file, so that subsequent aggregations
+only reparse logs which have changed. Any updates held in the run log (see ensembler.runlog) are
+applied on top of the cached data.
+"""
+import os
+import warnings
+import multiprocessing
+import yaml
+import pandas as pd
+import ensembler.utils
+import ensembler.runlog
+from ensembler.core import YamlLoader, logger
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+log_cache_dirname = '.inspect-cache'
+
+log_cache_format_version = 1
+
+# Below this number of logs to parse, the cost of starting worker processes outweighs the
+# speedup from parsing in parallel.
+min_logs_for_parallel_parse = 200
+
+stat_columns = ['log_filepath', 'log_mtime', 'log_size']
+
+
+def gen_log_cache_filepath(name, project_dir='.'):
+    return os.path.join(project_dir, log_cache_dirname, '%s.pkl' % name)
+
+
+def read_log_file(log_filepath):
+    """
+    Defined at module level so that it can be run by a multiprocessing pool.
+
+    Returns
+    -------
+    log_data : dict or None
+        None if the file could not be read or parsed, e.g. if it is partially written.
+    """
+    try:
+        with open(log_filepath) as log_file:
+            log_data = yaml.load(log_file, Loader=YamlLoader)
+    except (IOError, OSError, yaml.YAMLError) as e:
+        warnings.warn('Could not parse log file %s: %s' % (log_filepath, e))
+        return None
+    if not isinstance(log_data, dict):
+        return None
+    return log_data
+
+
+def read_log_files(log_filepaths, nprocesses=None):
+    """
+    Parameters
+    ----------
+    log_filepaths : list of str
+    nprocesses : int
+        default: the number of CPUs
+
+    Returns
+    -------
+    logs : list of (dict or None)
+    """
+    if nprocesses is None:
+        nprocesses = multiprocessing.cpu_count()
+    if nprocesses > 1 and len(log_filepaths) >= min_logs_for_parallel_parse:
+        pool = multiprocessing.Pool(processes=nprocesses)
+        try:
+            chunksize = max(1, len(log_filepaths) // (nprocesses * 4))
+            return pool.map(read_log_file, log_filepaths, chunksize=chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    return [read_log_file(log_filepath) for log_filepath in log_filepaths]
+
+
+def stat_log_files(log_filepaths):
+    """
+    Returns a DataFrame with columns log_filepath, log_mtime and log_size, with a row for each
+    log file which exists.
+    """
+    stats = []
+    for log_filepath in log_filepaths:
+        try:
+            stat = os.stat(log_filepath)
+        except OSError:
+            continue
+        stats.append((log_filepath, stat.st_mtime, stat.st_size))
+    return pd.DataFrame(stats, columns=stat_columns)
+
+
+def gen_logs_df(log_filepaths, logs):
+    """
+    Builds a DataFrame with a row for each parsed log and a column for each log key, plus the
+    log_filepath column.
+    """
+    records = []
+    for log_filepath, log_data in zip(log_filepaths, logs):
+        record = dict(log_data)
+        record['log_filepath'] = log_filepath
+        records.append(record)
+    return pd.DataFrame(records)
+
+
+class LogAggregator(object):
+    def __init__(self, cache_name=None, project_dir='.', nprocesses=None, apply_run_log=True):
+        """
+        Parameters
+        ----------
+        cache_name : str
+            Name of the cache file within the .inspect-cache directory, e.g.
+            'models-EGFR_HUMAN_D0-implicit-log'. If None, parsed logs are not cached.
+        project_dir : str
+        nprocesses : int
+            Number of processes used to parse logs (default: the number of CPUs).
+        apply_run_log : bool
+            Apply any updates held in the run log to the parsed logs.
+        """
+        self.project_dir = project_dir
+        if cache_name is not None:
+            self.cache_filepath = gen_log_cache_filepath(cache_name, project_dir=project_dir)
+        else:
+            self.cache_filepath = None
+        self.nprocesses = nprocesses
+        self.apply_run_log = apply_run_log
+        self.nparsed = 0
+
+    def aggregate(self, log_filepaths):
+        """
+        Parameters
+        ----------
+        log_filepaths : list of str
+
+        Returns
+        -------
+        df : pandas.DataFrame
+            A row for each log which exists, in the order given by log_filepaths, with a column
+            for each log key, plus the log_filepath column.
+        """
+        stats_df = stat_log_files(log_filepaths)
+        cached_df = self._load_cache()
+
+        if cached_df is not None and len(cached_df) > 0:
+            merged = stats_df.merge(
+                cached_df[stat_columns], on='log_filepath', how='left', suffixes=('', '_cached')
+            )
+            unchanged = (
+                (merged['log_mtime'] == merged['log_mtime_cached'])
+                & (merged['log_size'] == merged['log_size_cached'])
+            ).values
+            unchanged_filepaths = set(stats_df['log_filepath'].values[unchanged])
+            reused_df = cached_df[cached_df['log_filepath'].isin(unchanged_filepaths)]
+            changed_stats_df = stats_df[~unchanged]
+        else:
+            reused_df = None
+            changed_stats_df = stats_df
+
+        changed_filepaths = list(changed_stats_df['log_filepath'])
+        logs = read_log_files(changed_filepaths, nprocesses=self.nprocesses)
+        self.nparsed = len(changed_filepaths)
+        parsed = [log_data is not None for log_data in logs]
+        parsed_df = gen_logs_df(
+            [log_filepath for log_filepath, is_parsed in zip(changed_filepaths, parsed) if is_parsed],
+            [log_data for log_data in logs if log_data is not None],
+        )
+        if len(parsed_df) > 0:
+            parsed_df = parsed_df.merge(changed_stats_df, on='log_filepath')
+
+        # Logs which could not be parsed are not cached, so are reparsed next time
+        frames = [frame for frame in [reused_df, parsed_df] if frame is not None and len(frame) > 0]
+        if frames:
+            df = pd.concat(frames)
+        else:
+            df = pd.DataFrame(columns=stat_columns)
+        if self.nparsed > 0 or (cached_df is not None and len(cached_df) != len(df)):
+            self._write_cache(df)
+
+        if self.apply_run_log:
+            df = self._apply_run_log(df, log_filepaths)
+
+        order = dict([(log_filepath, index) for index, log_filepath in enumerate(log_filepaths)])
+        df = df.iloc[df['log_filepath'].map(order).argsort().values]
+        df = df.drop(['log_mtime', 'log_size'], axis=1)
+        return df.reset_index(drop=True)
+
+    def _apply_run_log(self, df, log_filepaths):
+        events_by_log = ensembler.runlog.get_run_log_reader(self.project_dir).update()
+        if not events_by_log:
+            return df
+
+        updated_filepaths = []
+        updated_logs = []
+        rows = dict([(log_filepath, index) for index, log_filepath in enumerate(df['log_filepath'])])
+        for log_filepath in log_filepaths:
+            events = events_by_log.get(ensembler.runlog.gen_run_log_key(log_filepath, self.project_dir))
+            if events:
+                events = ensembler.runlog.discard_superseded_events(events, log_filepath)
+            if not events:
+                continue
+            if events[0]['event'] == 'start' or log_filepath not in rows:
+                log_data = ensembler.runlog.merge_log_events(events)
+            else:
+                row = df.iloc[rows[log_filepath]].drop(stat_columns)
+                log_data = ensembler.runlog.merge_log_events(events, log_data=dict(row.dropna()))
+            updated_filepaths.append(log_filepath)
+            updated_logs.append(log_data)
+
+        if not updated_filepaths:
+            return df
+        updated_df = gen_logs_df(updated_filepaths, updated_logs)
+        updated_df['log_mtime'] = None
+        updated_df['log_size'] = None
+        df = df[~df['log_filepath'].isin(set(updated_filepaths))]
+        return pd.concat([df, updated_df])
+
+    def _load_cache(self):
+        if self.cache_filepath is None or not os.path.exists(self.cache_filepath):
+            return None
+        try:
+            with open(self.cache_filepath, 'rb') as cache_file:
+                cache = pickle.load(cache_file)
+        except Exception as e:
+            logger.debug('Ignoring unreadable log cache %s: %s' % (self.cache_filepath, e))
+            return None
+        if cache.get('format_version') != log_cache_format_version:
+            return None
+        return cache['df']
+
+    def _write_cache(self, df):
+        if self.cache_filepath is None:
+            return
+        ensembler.utils.create_dir(os.path.dirname(self.cache_filepath))
+        temp_filepath = '%s.%d.tmp' % (self.cache_filepath, os.getpid())
+        with open(temp_filepath, 'wb') as cache_file:
+            pickle.dump({'format_version': log_cache_format_version, 'df': df}, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filepath, self.cache_filepath)
+
+
+def aggregate_logs(log_filepaths, cache_name=None, project_dir='.', nprocesses=None):
+    """
+    See LogAggregator.
+    """
+    aggregator = LogAggregator(cache_name=cache_name, project_dir=project_dir, nprocesses=nprocesses)
+    return aggregator.aggregate(log_filepaths)
+
+
+def list_model_dirs(target_models_dir):
+    """
+    Lists the contents of each model directory for a target with a single listdir call each,
+    rather than testing for each file of interest separately.
+
+    Returns
+    -------
+    model_dir_contents : list of (str, set of str)
+        [(templateid, filenames), ...], in os.walk order
+    """
+    root, templateids, filenames = next(os.walk(target_models_dir))
+    return [
+        (templateid, set(os.listdir(os.path.join(target_models_dir, templateid))))
+        for templateid in templateids
+    ]
@@ -49,8 +49,10 @@ class RenumberResidues(object):
         self.model_seq = ''.join([Bio.SeqUtils.seq1(r.name) for r in self.model['implicit'].top.residues])
 
     def _get_uniprot_seq(self):
-        uniprot_query_string = 'mnemonic: {0}'.format(self.uniprot_mnemonic)
-        self._uniprot_xml = ensembler.uniprot.get_uniprot_xml(uniprot_query_string)
+        uniprot_entry = ensembler.uniprot.UniProtClient().get_entry_by_name(self.uniprot_mnemonic)
+        if uniprot_entry is None:
+            raise Exception('UniProt entry not found: {0}'.format(self.uniprot_mnemonic))
+        self._uniprot_xml = ensembler.uniprot.gen_uniprot_xml([uniprot_entry])
         seq_rawtext = self._uniprot_xml.find('entry/sequence').text
         self.uniprot_seq = ''.join(seq_rawtext.split())
 
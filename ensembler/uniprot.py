@@ -3,10 +3,21 @@ if sys.version_info > (3, 0):
     from urllib.request import urlopen
 else:
     from urllib2 import urlopen
+import os
+import io
+import time
+import tempfile
 import ensembler
+import ensembler.utils
+import ensembler.pdb
+from ensembler.core import logger
 from lxml import etree
 
 
+uniprot_query_base_url = 'http://www.uniprot.org/uniprot/?query='
+uniprot_cache_env_var = 'ENSEMBLER_UNIPROT_CACHE'
+
+
 def query_uniprot(search_string, maxreadlength=100000000):
     """Searches the UniProt database given a search string, and retrieves an XML
     file, which is returned as a string.
@@ -17,15 +28,95 @@ def query_uniprot(search_string, maxreadlength=100000000):
     The function also removes the xmlns attribute from <uniprot> tag, as this
     makes xpath searching annoying
     """
-    base_url = 'http://www.uniprot.org/uniprot/?query='
-    search_string_encoded = ensembler.core.encode_url_query(search_string.replace('=', ':'))
-    query_url = base_url + search_string_encoded + '&format=xml'
-    response = urlopen(query_url)
+    response = open_uniprot_query(search_string)
     page = response.read(maxreadlength)
     page = remove_uniprot_xmlns(page)
     return page
 
 
+def open_uniprot_query(search_string):
+    """Searches the UniProt database given a search string, and returns the HTTP response as a
+    file-like object, so that the XML can be parsed incrementally as it is received.
+    Example search string: 'domain:"Protein kinase" AND reviewed:yes'
+    """
+    return urlopen(gen_uniprot_query_url(search_string))
+
+
+def gen_uniprot_query_url(search_string, base_url=None):
+    if base_url is None:
+        base_url = uniprot_query_base_url
+    search_string_encoded = ensembler.core.encode_url_query(search_string.replace('=', ':'))
+    return base_url + search_string_encoded + '&format=xml'
+
+
+class TeeReader(object):
+    """File-like wrapper which copies all data read from a file object to a second file object."""
+    def __init__(self, source_file, copy_file):
+        self.source_file = source_file
+        self.copy_file = copy_file
+
+    def read(self, size=-1):
+        data = self.source_file.read(size)
+        self.copy_file.write(data)
+        return data
+
+
+def iter_uniprot_entries(uniprot_xml_source, write_to_filepath=None):
+    """Incrementally parses UniProt XML, yielding one <entry> element at a time.
+
+    The UniProt namespace is removed from the tags of each entry, so that it can be searched with
+    the same xpath expressions as XML returned by get_uniprot_xml. Each entry (and any preceding
+    siblings) is cleared once the caller moves on to the next entry, so memory use does not grow
+    with the number of entries. Elements yielded previously must therefore not be retained.
+
+    Parameters
+    ----------
+    uniprot_xml_source: str or file-like
+        Path to a saved UniProt XML file, or a file-like object such as an HTTP response.
+    write_to_filepath: str
+        Optionally save a copy of the raw XML as it is read.
+    """
+    opened_files = []
+    if write_to_filepath:
+        if not hasattr(uniprot_xml_source, 'read'):
+            uniprot_xml_source = open(uniprot_xml_source, 'rb')
+            opened_files.append(uniprot_xml_source)
+        copy_file = open(write_to_filepath, 'wb')
+        opened_files.append(copy_file)
+        uniprot_xml_source = TeeReader(uniprot_xml_source, copy_file)
+    try:
+        for event, entry in etree.iterparse(uniprot_xml_source, events=('end',), tag='{*}entry', huge_tree=True):
+            strip_xml_namespaces(entry)
+            yield entry
+            entry.clear()
+            while entry.getprevious() is not None:
+                del entry.getparent()[0]
+    finally:
+        for opened_file in opened_files:
+            opened_file.close()
+
+
+def strip_xml_namespaces(element):
+    """Removes namespaces from the tags of an element and its descendants, in-place."""
+    for descendant in element.iter(tag=etree.Element):
+        descendant.tag = etree.QName(descendant).localname
+    return element
+
+
+def iter_uniprot_query_entries(uniprot_query_string, write_to_filepath=None):
+    """Streams the results of a UniProt query, yielding one <entry> element at a time (see
+    iter_uniprot_entries).
+    """
+    response = open_uniprot_query(uniprot_query_string)
+    nentries = 0
+    for entry in iter_uniprot_entries(response, write_to_filepath=write_to_filepath):
+        nentries += 1
+        yield entry
+    if nentries == 0:
+        raise Exception('UniProt query returned no entries. Query string may have failed to match'
+                        ' any UniProt entries, or may have been malformed.')
+
+
 def build_uniprot_query_string_from_acs(acs):
     ac_query_string = ' OR '.join(['acc:%s' % ac for ac in acs])
     return ac_query_string
@@ -44,6 +135,259 @@ def get_uniprot_xml(uniprot_query_string, write_to_filepath=None):
     return uniprotxml
 
 
+def split_acs_into_batches(acs, max_batch_size=100, max_query_length=2000):
+    """Splits a list of UniProt ACs into batches for "acc:X OR acc:Y ..." queries, limiting both the
+    number of ACs per batch and the length of the encoded query (to stay within URL length limits).
+
+    Returns
+    -------
+    batches: list of list of str
+    """
+    separator_length = len(ensembler.core.encode_url_query(' OR '))
+    batches = []
+    batch = []
+    batch_query_length = 0
+    for ac in acs:
+        ac_query_length = len(ensembler.core.encode_url_query(build_uniprot_query_string_from_acs([ac])))
+        if len(batch) > 0 and (len(batch) >= max_batch_size or batch_query_length + separator_length + ac_query_length > max_query_length):
+            batches.append(batch)
+            batch = []
+            batch_query_length = 0
+        if len(batch) > 0:
+            batch_query_length += separator_length
+        batch.append(ac)
+        batch_query_length += ac_query_length
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def get_default_uniprot_cache_dir():
+    """
+    The UniProt entry cache directory can be set with the ENSEMBLER_UNIPROT_CACHE environment
+    variable, so that it is shared across projects by default.
+    """
+    return os.environ.get(uniprot_cache_env_var)
+
+
+class UniProtEntryCache(object):
+    """
+    On-disk cache of UniProt entries, keyed by accession and entry version.
+
+    Each entry is stored as [cache_dir]/entries/[primary AC]_v[version].xml. An index file
+    ([cache_dir]/index.json) maps each primary AC to its current version and file, and maps all
+    ACs (primary and secondary) and entry names (mnemonics) to primary ACs. When a newer version of
+    an entry is added, the file for the previous version is removed.
+
+    Parameters
+    ----------
+    cache_dir: str
+    """
+    index_filename = 'index.json'
+    lock_filename = 'index.lock'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.entries_dir = os.path.join(self.cache_dir, 'entries')
+        ensembler.utils.create_dir(self.entries_dir)
+        self.index_filepath = os.path.join(self.cache_dir, self.index_filename)
+        self.lock_filepath = os.path.join(self.cache_dir, self.lock_filename)
+
+    def _locked_index(self, write=True):
+        return ensembler.utils.locked_json_file(self.index_filepath, self.lock_filepath, write=write)
+
+    def _read_entry(self, index, primary_ac):
+        filepath = os.path.join(self.entries_dir, index['entries'][primary_ac]['filename'])
+        if not os.path.exists(filepath):
+            return None
+        with open(filepath, 'rb') as entry_file:
+            return strip_xml_namespaces(etree.fromstring(entry_file.read()))
+
+    def get_entries(self, acs=(), names=()):
+        """
+        Parameters
+        ----------
+        acs: list of str
+        names: list of str
+            UniProt entry names (mnemonics), e.g. 'EGFR_HUMAN'
+
+        Returns
+        -------
+        entries: dict
+            {ac or name: lxml.etree.Element}, for cached entries only
+        """
+        entries = {}
+        with self._locked_index(write=False) as index:
+            for key, key_type in [(ac, 'accessions') for ac in acs] + [(name, 'names') for name in names]:
+                primary_ac = index.get(key_type, {}).get(key)
+                if primary_ac is None or primary_ac not in index.get('entries', {}):
+                    continue
+                entry = self._read_entry(index, primary_ac)
+                if entry is not None:
+                    entries[key] = entry
+        return entries
+
+    def add_entries(self, entries):
+        """
+        Parameters
+        ----------
+        entries: list of lxml.etree.Element
+            UniProt <entry> elements (with namespaces removed)
+        """
+        staged = []
+        for entry in entries:
+            accessions = [accession.text for accession in entry.findall('accession')]
+            primary_ac = accessions[0]
+            version = entry.get('version', '0')
+            filename = '%s_v%s.xml' % (primary_ac, version)
+            temp_fd, temp_filepath = tempfile.mkstemp(dir=self.entries_dir, suffix='.tmp')
+            with os.fdopen(temp_fd, 'wb') as temp_file:
+                temp_file.write(etree.tostring(entry))
+            staged.append((primary_ac, accessions, entry.find('name').text, version, filename, temp_filepath))
+
+        with self._locked_index() as index:
+            for key_type in ['entries', 'accessions', 'names']:
+                index.setdefault(key_type, {})
+            for primary_ac, accessions, name, version, filename, temp_filepath in staged:
+                previous = index['entries'].get(primary_ac)
+                os.rename(temp_filepath, os.path.join(self.entries_dir, filename))
+                if previous is not None and previous['filename'] != filename:
+                    previous_filepath = os.path.join(self.entries_dir, previous['filename'])
+                    if os.path.exists(previous_filepath):
+                        os.remove(previous_filepath)
+                index['entries'][primary_ac] = {'version': version, 'filename': filename, 'added': time.time()}
+                for accession in accessions:
+                    index['accessions'][accession] = primary_ac
+                if name is not None:
+                    index['names'][name] = primary_ac
+
+
+class UniProtClient(object):
+    """
+    Retrieves UniProt entries by AC or entry name, using an optional local entry cache
+    (UniProtEntryCache), so that only entries which have not been seen before are requested from
+    UniProt. ACs are requested in batches of limited size, which are fetched concurrently.
+
+    Parameters
+    ----------
+    cache_dir: str or None
+        default: the ENSEMBLER_UNIPROT_CACHE environment variable, if set; otherwise no cache is used
+    max_batch_size: int
+    max_query_length: int
+        Maximum length of the encoded query string for each batch.
+    fetcher: ensembler.pdb.HTTPFetcher
+    base_url: str
+    """
+    def __init__(self, cache_dir=None, max_batch_size=100, max_query_length=2000, fetcher=None, base_url=None):
+        if cache_dir is None:
+            cache_dir = get_default_uniprot_cache_dir()
+        self.cache = UniProtEntryCache(cache_dir) if cache_dir else None
+        self.max_batch_size = max_batch_size
+        self.max_query_length = max_query_length
+        if fetcher is None:
+            fetcher = ensembler.pdb.HTTPFetcher(nthreads=4)
+        self.fetcher = fetcher
+        self.base_url = base_url
+
+    def _fetch_query_entries(self, query_strings):
+        """
+        Returns
+        -------
+        entries: list of lxml.etree.Element
+        """
+        urls = [gen_uniprot_query_url(query_string, base_url=self.base_url) for query_string in query_strings]
+        results, failures = self.fetcher.fetch_all(urls)
+        if len(failures) > 0:
+            raise Exception('Failed to retrieve UniProt entries: %s' % ', '.join(
+                ['%s (%r)' % (url, error) for url, error in failures.items()]
+            ))
+        entries = []
+        for url in urls:
+            if len(results[url]) == 0:
+                continue
+            for entry in iter_uniprot_entries(io.BytesIO(results[url])):
+                # entries are cleared once the next is parsed, so make an independent copy
+                entries.append(strip_xml_namespaces(etree.fromstring(etree.tostring(entry))))
+        if self.cache is not None and len(entries) > 0:
+            self.cache.add_entries(entries)
+        return entries
+
+    def get_entries(self, acs):
+        """
+        Parameters
+        ----------
+        acs: list of str
+
+        Returns
+        -------
+        entries: list of lxml.etree.Element
+            One <entry> for each unique UniProt entry, in order of first appearance of its ACs.
+            ACs which do not match any entry are logged and skipped.
+        """
+        entries_by_ac = {}
+        if self.cache is not None:
+            entries_by_ac.update(self.cache.get_entries(acs=acs))
+        missing_acs = [ac for ac in sorted(set(acs)) if ac not in entries_by_ac]
+        logger.debug('%d UniProt entries found in cache; fetching %d' % (len(entries_by_ac), len(missing_acs)))
+        if len(missing_acs) > 0:
+            batches = split_acs_into_batches(missing_acs, max_batch_size=self.max_batch_size, max_query_length=self.max_query_length)
+            fetched_entries = self._fetch_query_entries([build_uniprot_query_string_from_acs(batch) for batch in batches])
+            for entry in fetched_entries:
+                for accession in entry.findall('accession'):
+                    entries_by_ac[accession.text] = entry
+
+        entries = []
+        primary_acs = set()
+        for ac in acs:
+            entry = entries_by_ac.get(ac)
+            if entry is None:
+                logger.warning('No UniProt entry found for AC %s' % ac)
+                continue
+            primary_ac = entry.find('accession').text
+            if primary_ac not in primary_acs:
+                primary_acs.add(primary_ac)
+                entries.append(entry)
+        return entries
+
+    def get_entry_by_name(self, name):
+        """
+        Parameters
+        ----------
+        name: str
+            UniProt entry name (mnemonic), e.g. 'EGFR_HUMAN'
+
+        Returns
+        -------
+        entry: lxml.etree.Element or None
+        """
+        if self.cache is not None:
+            cached_entries = self.cache.get_entries(names=[name])
+            if name in cached_entries:
+                return cached_entries[name]
+        entries = self._fetch_query_entries(['mnemonic:%s' % name])
+        for entry in entries:
+            if entry.find('name').text == name:
+                return entry
+        return None
+
+    def get_uniprot_xml(self, acs):
+        """
+        Returns
+        -------
+        uniprotxml: lxml.etree.Element
+            <uniprot> element containing the entries for the given ACs, in the same form as returned
+            by get_uniprot_xml
+        """
+        return gen_uniprot_xml(self.get_entries(acs))
+
+
+def gen_uniprot_xml(entries):
+    uniprotxml = etree.Element('uniprot')
+    for entry in entries:
+        uniprotxml.append(entry)
+    return uniprotxml
+
+
 def remove_uniprot_xmlns(uniprot_xml_string):
     return uniprot_xml_string.replace('xmlns="http://uniprot.org/uniprot" ', '', 1)
 
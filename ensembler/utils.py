@@ -4,7 +4,14 @@ import logging
 import functools
 import shutil
 import tempfile
+import hashlib
+import gzip
+import json
 from ensembler.core import logger, mpistate
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 def nonefn():
@@ -114,4 +121,135 @@ def debug_method(fn):
 def set_arg_with_default(arg, default_arg):
     if arg is None:
         arg = default_arg
-    return arg
\ No newline at end of file
+    return arg
+
+
+def sha1_hexdigest(contents):
+    """
+    Parameters
+    ----------
+    contents: str
+
+    Returns
+    -------
+    str
+    """
+    if not isinstance(contents, bytes):
+        contents = contents.encode('utf-8')
+    return hashlib.sha1(contents).hexdigest()
+
+
+def sha1_of_file(filepath, chunk_size=1024*1024):
+    """
+    Calculate the sha1 hash of a file's (raw) contents, reading it in chunks.
+    """
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def gen_content_addressed_filepath(store_dir, sha1, compress=True):
+    """
+    Content-addressed files are named by the sha1 hash of their (uncompressed) contents, e.g.
+    [store_dir]/[sha1].xml.gz
+    """
+    extension = '.xml.gz' if compress else '.xml'
+    return os.path.join(store_dir, sha1 + extension)
+
+
+def write_content_addressed_file(store_dir, contents, compress=True, sha1=None):
+    """
+    Write contents (e.g. a serialized OpenMM System) to a content-addressed store directory, unless
+    a file with identical contents is already present.
+
+    The file is written to a temporary path and then renamed, so that concurrent writers (e.g.
+    other MPI ranks) never see a partially written file.
+
+    Parameters
+    ----------
+    store_dir: str
+    contents: str
+    compress: bool
+        gzip the stored file
+    sha1: str
+        key under which to store the contents, if this should be derived from something other than
+        the contents themselves (e.g. from the source files they were generated from)
+
+    Returns
+    -------
+    filepath: str
+        path of the stored file
+    """
+    create_dir(store_dir)
+    if sha1 is None:
+        sha1 = sha1_hexdigest(contents)
+    filepath = gen_content_addressed_filepath(store_dir, sha1, compress=compress)
+    if os.path.exists(filepath):
+        return filepath
+
+    temp_fd, temp_filepath = tempfile.mkstemp(dir=store_dir, suffix='.tmp')
+    os.close(temp_fd)
+    try:
+        opener = gzip.open if compress else open
+        with opener(temp_filepath, 'wb') as temp_file:
+            temp_file.write(contents if isinstance(contents, bytes) else contents.encode('utf-8'))
+        os.chmod(temp_filepath, 0o644)
+        os.rename(temp_filepath, filepath)
+    except:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise
+    return filepath
+
+
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def link_file(source_filepath, dest_filepath):
+    """
+    Hardlink source_filepath to dest_filepath, replacing any existing file. Falls back to copying
+    if a hardlink cannot be created (e.g. across filesystems).
+    """
+    if os.path.lexists(dest_filepath):
+        os.remove(dest_filepath)
+    try:
+        os.link(source_filepath, dest_filepath)
+    except OSError:
+        shutil.copyfile(source_filepath, dest_filepath)
+
+
+@contextlib.contextmanager
+def locked_json_file(filepath, lock_filepath=None, write=True):
+    """
+    Context manager which reads a JSON file (as an empty dict if it does not yet exist) while
+    holding an exclusive lock on lock_filepath (default: [filepath].lock), and yields the data for
+    modification. If write is set, the data is written back atomically (via a temporary file) when
+    the context exits.
+    """
+    if lock_filepath is None:
+        lock_filepath = filepath + '.lock'
+    with open(lock_filepath, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            data = {}
+            if os.path.exists(filepath):
+                with open(filepath) as json_file:
+                    data = json.load(json_file)
+            yield data
+            if write:
+                temp_fd, temp_filepath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)), suffix='.tmp')
+                with os.fdopen(temp_fd, 'w') as temp_file:
+                    json.dump(data, temp_file, indent=0, sort_keys=True)
+                # mkstemp creates files readable only by the owner; use the permissions of a
+                # regular new file, so that the data can be shared with other users
+                os.chmod(temp_filepath, 0o666 & ~get_umask())
+                os.rename(temp_filepath, filepath)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)